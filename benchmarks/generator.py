@@ -0,0 +1,114 @@
+import random
+
+# Condition kinds supported by the generator and their default weights
+DEFAULT_MIX = {'String': 1, 'Numeric': 1, 'Bool': 1, 'List': 1, 'Dict': 1}
+
+# Boolean operators used to combine conditions into ConditionGroups
+DEFAULT_GROUP_OPERATORS = ('AND', 'OR')
+
+# Attributes every generated Entity has, their DSL types and random value generators
+entity_attributes = {
+    'i': ('int', lambda rng: rng.randint(0, 100)),
+    'f': ('float', lambda rng: round(rng.uniform(0, 100), 2)),
+    's': ('string', lambda rng: rng.choice(['on', 'off', 'idle'])),
+    'b': ('bool', lambda rng: rng.random() < 0.5),
+    'l': ('list', lambda rng: rng.choice([[], [1, 2], [3]])),
+}
+
+
+# Returns a random payload for a generated Entity, covering all of its Attributes
+def random_payload(rng):
+    payload = {name: generate(rng) for name, (_, generate) in entity_attributes.items()}
+    payload['d'] = {'x': rng.randint(0, 10)}
+    return payload
+
+
+# Returns the DSL source of a random primitive condition of the given kind on an Entity
+def primitive_condition(rng, kind, entity):
+    if kind == 'String':
+        return f"{entity}.s {rng.choice(['==', '!=', '~', '!~'])} \"{rng.choice(['on', 'off', 'idle'])}\""
+    elif kind == 'Numeric':
+        attribute = rng.choice(['i', 'f'])
+        constant = rng.randint(0, 100) if attribute == 'i' else round(rng.uniform(0, 100), 1)
+        return f"{entity}.{attribute} {rng.choice(['>', '<'])} {constant}"
+    elif kind == 'Bool':
+        return f"{entity}.b {rng.choice(['AND', 'OR', 'NOT', 'XOR'])} {rng.choice(['true', 'false'])}"
+    elif kind == 'List':
+        return f"{entity}.l {rng.choice(['==', '!='])} {rng.choice(['[]', '[1, 2]', '[3]'])}"
+    elif kind == 'Dict':
+        return f"{entity}.d {rng.choice(['==', '!='])} {{\"x\": {rng.randint(0, 10)}}}"
+    raise ValueError(f"Unknown condition kind '{kind}'")
+
+
+# Returns the DSL source of a random condition tree of the given depth
+def condition(rng, depth, entities, kinds, weights, group_operators):
+    # Leaves are primitive conditions
+    if depth == 0:
+        kind = rng.choices(kinds, weights)[0]
+        return primitive_condition(rng, kind, rng.choice(entities))
+    left = condition(rng, depth - 1, entities, kinds, weights, group_operators)
+    right = condition(rng, depth - 1, entities, kinds, weights, group_operators)
+    return f"({left}) {rng.choice(group_operators)} ({right})"
+
+
+# Generate a synthetic full_metamodel.tx model
+def generate_model(brokers=1, entities=100, automations=100, depth=2, mix=None,
+                   group_operators=DEFAULT_GROUP_OPERATORS, seed=0):
+    """
+    Generates the source of a synthetic configuration model conforming to lang/full_metamodel.tx.
+    :param brokers: Number of MQTT Brokers. Entities are distributed among them round-robin
+    :param entities: Number of Entities. Every Entity has an int, float, string, bool, list and dict Attribute
+    :param automations: Number of Automations. All of them are continuous and have a single action
+    :param depth: Depth of each Automation's condition tree. Depth 0 is a single primitive condition, depth D has
+        2^D primitive conditions
+    :param mix: Dictionary of relative weights of the condition kinds. Keys are the keys of DEFAULT_MIX
+    :param group_operators: Boolean operators used to combine conditions
+    :param seed: Random seed. The same arguments and seed always produce the same model
+    :return: Model source as a string
+    """
+    rng = random.Random(seed)
+    mix = DEFAULT_MIX if mix is None else mix
+    kinds = [kind for kind, weight in mix.items() if weight > 0]
+    weights = [mix[kind] for kind in kinds]
+
+    lines = []
+    # Brokers
+    broker_names = [f"broker_{index}" for index in range(brokers)]
+    for name in broker_names:
+        lines += ["mqtt:",
+                  f"    name: {name}",
+                  "    host: '127.0.0.1'",
+                  "    port: 1883",
+                  "    credentials:",
+                  "        username: 'bench'",
+                  "        password: 'bench'",
+                  ""]
+
+    # Entities
+    entity_names = [f"entity_{index}" for index in range(entities)]
+    for index, name in enumerate(entity_names):
+        broker = broker_names[index % brokers]
+        lines += ["entity:",
+                  f"    name: {name}",
+                  f"    topic: \"bench.{broker}.{name}\"",
+                  f"    broker: {broker}",
+                  "    attributes:"]
+        lines += [f"        - {attribute}: {attribute_type}"
+                  for attribute, (attribute_type, _) in entity_attributes.items()]
+        lines += ["        - d: {",
+                  "            - x: int",
+                  "        }",
+                  ""]
+
+    # Automations
+    for index in range(automations):
+        lines += ["automation:",
+                  f"    name: automation_{index}",
+                  f"    condition: {condition(rng, depth, entity_names, kinds, weights, group_operators)}",
+                  "    enabled: true",
+                  "    continuous: true",
+                  "    actions:",
+                  f"        - {rng.choice(entity_names)}.i: {rng.randint(0, 100)}",
+                  ""]
+
+    return '\n'.join(lines)
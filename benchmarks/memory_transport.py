@@ -0,0 +1,100 @@
+from commlib.endpoints import EndpointType
+
+
+# Returns True if a topic matches a subscription pattern. e.g: 'home.kitchen.gas' matches 'home.*', '*' and itself
+def topic_matches(pattern, topic):
+    if pattern == '*' or pattern == topic:
+        return True
+    return pattern.endswith('.*') and topic.startswith(pattern[:-1])
+
+
+# A class representing an in-memory message bus shared by all in-memory endpoints
+class MemoryBus:
+    """
+    The MemoryBus class delivers published messages synchronously to the in-memory subscribers whose pattern matches
+    the topic, so that HA-Auto can run without a broker.
+    ...
+
+    Attributes
+    ----------
+        subscribers: list
+            List of running MemorySubscriber objects
+        published: int
+            Number of messages published on the bus
+
+    Methods
+    -------
+        publish(self, topic, data): Delivers a message to all matching subscribers.
+    """
+
+    def __init__(self):
+        self.subscribers = []
+        self.published = 0
+
+    # Deliver a message to all matching subscribers
+    def publish(self, topic, data):
+        """
+        Delivers a message to all subscribers whose pattern matches the topic.
+        :param topic: Topic to publish on. e.g: 'kitchen.gas'
+        :param data: Dictionary containing the message
+        :return:
+        """
+        self.published += 1
+        for subscriber in self.subscribers:
+            if topic_matches(subscriber.topic, topic):
+                subscriber.receive(data, topic)
+
+
+# Bus used by all in-memory endpoints
+bus = MemoryBus()
+
+
+# In-memory replacement of commlib-py's Subscriber and PSubscriber
+class MemorySubscriber:
+    def __init__(self, topic=None, conn_params=None, on_message=None, pattern=False, **kwargs):
+        self.topic = topic
+        self.on_message = on_message
+        self.pattern = pattern
+
+    # Pattern subscribers receive the topic along with the data, like commlib-py's PSubscriber
+    def receive(self, data, topic):
+        if self.pattern:
+            self.on_message(data, topic)
+        else:
+            self.on_message(data)
+
+    def run(self):
+        bus.subscribers.append(self)
+
+    def stop(self):
+        if self in bus.subscribers:
+            bus.subscribers.remove(self)
+
+
+# In-memory replacement of commlib-py's Publisher and MPublisher
+class MemoryPublisher:
+    def __init__(self, topic=None, conn_params=None, **kwargs):
+        self.topic = topic
+
+    # MPublisher style publishing takes the topic as an argument
+    def publish(self, msg, topic=None):
+        bus.publish(self.topic if topic is None else topic, msg)
+
+
+# Drop-in replacement of commlib-py's endpoint_factory returning in-memory endpoints for every transport
+def memory_endpoint_factory(etype, etransport):
+    """
+    Returns an in-memory endpoint class for the given endpoint type. The transport is ignored. Meant to be passed to
+    lib.connection.set_endpoint_factory().
+    :param etype: commlib-py EndpointType
+    :param etransport: commlib-py TransportType
+    :return: Endpoint class
+    """
+    if etype in (EndpointType.Publisher, EndpointType.MPublisher):
+        return MemoryPublisher
+    elif etype == EndpointType.Subscriber:
+        return MemorySubscriber
+    elif etype == EndpointType.PSubscriber:
+        return lambda **kwargs: MemorySubscriber(pattern=True, **kwargs)
+    else:
+        raise ValueError(f"Endpoint type {etype} is not supported by the in-memory transport")
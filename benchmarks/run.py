@@ -0,0 +1,277 @@
+# Benchmark suite measuring how HA-Auto scales with model size. Run from the repository root, e.g:
+# python -m benchmarks.run --entities 1000 --automations 1000 --depth 3 --out results.json
+
+import json
+import marshal
+import os
+import platform
+import random
+import statistics
+import tempfile
+import time
+
+import click
+
+from textx import metamodel_from_file
+
+from lib.automation import Automation, List, Dict, Action, IntAction, FloatAction, StringAction, BoolAction
+from lib.broker import Broker, MQTTBroker, AMQPBroker, RedisBroker, BrokerAuthPlain
+from lib.cache import serialize_model, restore_model
+from lib.connection import set_endpoint_factory, start_connections, stop_connections, clear_connections
+from lib.entity import Entity, Attribute, \
+    IntAttribute, FloatAttribute, StringAttribute, BoolAttribute, ListAttribute, DictAttribute
+from lib.vectorized import VectorEvaluator, np
+from lib.network import ConditionNetwork
+from lib.state import state_store
+from lib.timers import TimeWindow, TimeAt, TimeDelay, TimeInterval
+from lib.aggregates import Aggregate
+
+from .generator import generate_model, random_payload, DEFAULT_MIX
+from .memory_transport import bus, memory_endpoint_factory
+
+
+# Times a function over a number of repetitions
+def timed(function, repeat, operations=1):
+    """
+    Runs a function repeatedly and returns timing statistics.
+    :param function: Function to time. Called without arguments
+    :param repeat: Number of repetitions
+    :param operations: Number of operations performed by a single call, used to compute per-operation figures
+    :return: Dictionary with min/median/mean seconds per call, seconds per operation and operations per second
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {
+        'repeat': repeat,
+        'operations': operations,
+        'min_s': best,
+        'median_s': statistics.median(times),
+        'mean_s': statistics.mean(times),
+        'per_operation_us': best / operations * 1e6,
+        'operations_per_s': operations / best if best > 0 else None
+    }
+
+
+# Creates the full metamodel used by main.py
+def create_metamodel():
+    return metamodel_from_file('lang/full_metamodel.tx', classes=[Entity, Attribute, IntAttribute, FloatAttribute,
+                                                                  StringAttribute, BoolAttribute, ListAttribute,
+                                                                  DictAttribute, Broker, MQTTBroker, AMQPBroker,
+                                                                  RedisBroker, BrokerAuthPlain, Automation, Action,
+                                                                  IntAction, FloatAction, StringAction, BoolAction,
+                                                                  List, Dict, TimeWindow, TimeAt, TimeDelay,
+                                                                  TimeInterval, Aggregate])
+
+
+# Run all benchmarks
+def run_benchmarks(brokers, entities, automations, depth, mix, messages, repeat, seed):
+    """
+    Generates a synthetic model and benchmarks parsing, condition building, evaluation, ingestion and triggering
+    against the in-memory transport.
+    :return: Dictionary with the benchmark parameters and results, ready to be dumped as JSON
+    """
+    rng = random.Random(seed)
+    results = {}
+
+    # Use the in-memory transport for all Broker connections
+    set_endpoint_factory(memory_endpoint_factory)
+
+    # Generate model
+    model_str = generate_model(brokers=brokers, entities=entities, automations=automations, depth=depth, mix=mix,
+                               seed=seed)
+    metamodel = create_metamodel()
+
+    # metamodel.model_from_file
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = os.path.join(directory, 'bench.model')
+        with open(model_path, 'w') as f:
+            f.write(model_str)
+        parsed = []
+
+        def parse():
+            clear_connections()
+            parsed.append(metamodel.model_from_file(model_path))
+
+        results['model_from_file'] = timed(parse, repeat)
+
+    # Restoring the model from its cached runtime form, as done by lib.cache.ModelLoader on startup. The remaining
+    # benchmarks run on the restored model, like the runtime does when the cache is warm
+    cached = marshal.dumps(serialize_model(parsed[-1]))
+    restored = []
+
+    def restore():
+        clear_connections()
+        restored.append(restore_model(marshal.loads(cached)))
+
+    results['model_from_cache'] = timed(restore, repeat)
+    model = restored[-1]
+    model.entities_dict = {entity.name: entity for entity in model.entities}
+    start_connections()
+
+    # build_condition
+    def build():
+        for automation in model.automations:
+            automation.build_condition()
+
+    results['build_condition'] = timed(build, repeat, len(model.automations))
+
+    # Entity.update_state, called directly
+    updates = [(rng.choice(model.entities), random_payload(rng)) for _ in range(messages)]
+
+    def update_state():
+        for entity, payload in updates:
+            entity.update_state(payload)
+
+    results['update_state'] = timed(update_state, repeat, messages)
+
+    # Ingestion through the Broker connection, from publishing on the bus to update_state
+    publications = [(entity.topic, payload) for entity, payload in updates]
+
+    def ingest():
+        for topic, payload in publications:
+            bus.publish(topic, payload)
+
+    results['ingest'] = timed(ingest, repeat, messages)
+
+    # StateStore.snapshot, taken at the start of every evaluation cycle. Copies nothing once no message is pending
+    results['snapshot'] = timed(state_store.snapshot, repeat)
+
+    # Automation.evaluate. Every Attribute has a value after the ingestion benchmarks
+    def evaluate():
+        for automation in model.automations:
+            automation.evaluate()
+
+    results['evaluate'] = timed(evaluate, repeat, len(model.automations))
+
+    # VectorEvaluator.evaluate, computing the conditions of all Automations in one pass. Requires NumPy
+    if np is not None:
+        evaluator = VectorEvaluator(model)
+        evaluator.build()
+
+        def evaluate_vectorized():
+            for automation, result in evaluator.evaluate():
+                automation.evaluate(result)
+
+        results['evaluate_vectorized'] = timed(evaluate_vectorized, repeat, len(model.automations))
+
+    # ConditionNetwork.evaluate after a batch of updates to 1% of the Entities, so that only the shared conditions
+    # reading the changed Attributes are recomputed. Includes the ingestion of the batch
+    network = ConditionNetwork(model)
+    network.build()
+    batch = max(1, len(model.entities) // 100)
+    position = [0]
+
+    def evaluate_network():
+        start = position[0]
+        position[0] = (start + batch) % len(updates)
+        for entity, payload in updates[start:start + batch]:
+            entity.update_state(payload)
+        state_store.snapshot()
+        for automation, result in network.evaluate():
+            automation.evaluate(result)
+
+    results['evaluate_network'] = timed(evaluate_network, repeat, len(model.automations))
+
+    # History.append with an avg, min, max and count Aggregate over a numeric Attribute, per appended sample. The
+    # samples are a second apart, so that the one minute windows stay full
+    attribute = next((attribute for entity in model.entities for attribute in entity.attributes
+                      if attribute.kind in ('int', 'float')), None)
+    if attribute is not None:
+        aggregates = [Aggregate(None, function, attribute, '1m') for function in ('avg', 'min', 'max', 'count')]
+        for aggregate in aggregates:
+            aggregate.start()
+        samples = [rng.random() for _ in range(messages)]
+        clock = [0.0]
+
+        def aggregate_append():
+            writer = state_store.begin()
+            try:
+                for value in samples:
+                    clock[0] += 1.0
+                    attribute.history.append(clock[0], value)
+            finally:
+                state_store.end(writer)
+
+        results['aggregate_append'] = timed(aggregate_append, repeat, messages)
+        for aggregate in aggregates:
+            aggregate.stop()
+
+    # Automation.trigger, measuring message building and publishing. Subscribers are stopped so that published actions
+    # are not ingested back
+    stop_connections()
+
+    def trigger():
+        for automation in model.automations:
+            automation.trigger()
+
+    results['trigger'] = timed(trigger, repeat, len(model.automations))
+
+    clear_connections()
+    set_endpoint_factory(None)
+
+    return {
+        'parameters': {
+            'brokers': brokers,
+            'entities': entities,
+            'automations': automations,
+            'depth': depth,
+            'mix': mix,
+            'messages': messages,
+            'repeat': repeat,
+            'seed': seed,
+            'model_bytes': len(model_str)
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine()
+        },
+        'results': results,
+        'condition_network': network.stats()
+    }
+
+
+# Parses a mix option. e.g: "Numeric=3,Bool=1" -> {'String': 0, 'Numeric': 3, 'Bool': 1, 'List': 0, 'Dict': 0}
+def parse_mix(mix):
+    if not mix:
+        return dict(DEFAULT_MIX)
+    weights = {kind: 0 for kind in DEFAULT_MIX}
+    for item in mix.split(','):
+        kind, weight = item.split('=')
+        if kind not in weights:
+            raise click.BadParameter(f"Unknown condition kind '{kind}'. Use one of {list(DEFAULT_MIX)}")
+        weights[kind] = float(weight)
+    return weights
+
+
+# Benchmark CLI Command
+@click.command()
+@click.option('--brokers', default=1, help="Number of brokers")
+@click.option('--entities', default=100, help="Number of entities")
+@click.option('--automations', default=100, help="Number of automations")
+@click.option('--depth', default=2, help="Depth of each automation's condition tree")
+@click.option('--mix', default="", help="Condition kind weights. e.g: Numeric=3,Bool=1")
+@click.option('--messages', default=10000, help="Number of messages used by the ingestion benchmarks")
+@click.option('--repeat', default=5, help="Repetitions of each benchmark")
+@click.option('--seed', default=0, help="Random seed")
+@click.option('--out', default="", help="Output JSON file. Prints to stdout if not set")
+def benchmark(brokers, entities, automations, depth, mix, messages, repeat, seed, out):
+    """
+    Runs the benchmark suite on a generated model and reports the results as JSON.
+    """
+    report = run_benchmarks(brokers, entities, automations, depth, parse_mix(mix), messages, repeat, seed)
+    report_json = json.dumps(report, indent=2)
+    if out:
+        with open(out, 'w') as f:
+            f.write(report_json)
+    else:
+        click.echo(report_json)
+
+
+# CLI Utility Entry Point
+if __name__ == '__main__':
+    benchmark()
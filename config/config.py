@@ -1,6 +1,119 @@
 # Run Mode Setting: Set to "MQTT" to use the Node-RED integration, or to "Local" for a local configuration model.
 RUN_MODE = "MQTT"
 
+# Runtime Setting: Set to "Threaded" to handle broker messages on their transport threads and evaluate Automations in a
+# blocking loop, or to "Asyncio" to receive the model, ingest messages, evaluate Automations and publish actions on a
+# single asyncio event loop. The "Asyncio" runtime always dispatches actions asynchronously.
+RUNTIME = "Threaded"
+
+# Evaluation Mode Setting: Set to "Polling" to evaluate all Automations once every second, or to "Event" to evaluate
+# Automations only when one of the Attributes they read is updated.
+EVAL_MODE = "Polling"
+
+# Evaluation Backend Setting: Set to "Scalar" to evaluate each Automation's compiled condition separately, to
+# "Vectorized" to evaluate the conditions of all Automations in one NumPy pass per cycle, or to "Network" to share
+# identical conditions between Automations and only recompute the ones reading changed Attributes. "Vectorized" requires
+# NumPy, an optional dependency listed in requirements-optional.txt, and is only used in "Polling" evaluation mode.
+EVAL_BACKEND = "Scalar"
+
+# Sharding Setting: Number of worker processes evaluating Automations, or 0 to evaluate them in the main process. The
+# Automations are partitioned by the Entities they read, and the main process forwards Entity messages to the workers
+# that need them. Only used by the "Threaded" runtime.
+SHARDS = 0
+
+# Asynchronous Dispatch Settings: When enabled, actions are merged per Entity during each evaluation cycle and published
+# by worker threads from bounded per-broker queues, so that a slow broker does not stall evaluation. When disabled,
+# actions are published by the evaluation loop as they trigger. The "Asyncio" runtime uses the queue settings below.
+DISPATCH_ASYNC = False
+# Maximum number of messages waiting to be published per broker
+DISPATCH_QUEUE_SIZE = 1000
+# Policy when a broker's queue is full: "block" waits for space so that no action is lost, "drop_oldest" and
+# "drop_newest" keep evaluation running but drop actions
+DISPATCH_OVERFLOW = "block"
+
+# Ingestion Queue Settings: When enabled, broker callbacks only queue received messages and the evaluation loop applies
+# them in one batch at the start of every cycle. Each Entity keeps one pending message, into which newer messages are
+# merged, so a sensor publishing faster than Automations are evaluated costs one state update per cycle. Only used by the "Threaded"
+# runtime without SHARDS.
+INGEST_QUEUE = False
+# Maximum number of Entities with a pending message
+INGEST_QUEUE_SIZE = 10000
+# Policy when a message for another Entity arrives while the queue is full: "drop_oldest", "drop_newest" or "block"
+INGEST_OVERFLOW = "drop_oldest"
+# Merge a new message into the Entity's pending message key by key, so that partial updates (e.g: one Attribute per
+# message) are not lost. Set to False to replace the pending message with the newest one instead
+INGEST_MERGE = True
+
+# Model Cache Settings: When enabled, the runtime form of parsed models is cached and reused on startup as long as the
+# grammar and the model are unchanged, skipping textX parsing.
+MODEL_CACHE = False
+# Directory where cached models are stored
+MODEL_CACHE_DIR = "config/cache"
+# Number of cached models kept. The least recently used ones are removed first, e.g: models of past Node-RED deploys
+MODEL_CACHE_SIZE = 16
+
+# Metrics Settings: When enabled, message ingestion, Automation evaluation and action publishing are measured with
+# counters and latency histograms per Entity, Automation and Broker, along with queue depth and connection gauges. When
+# disabled, instrumented code only checks a flag.
+METRICS = False
+# Set to "HTTP" to serve the metrics in the Prometheus text format on the local host, or to "File" to write them to a
+# file periodically, e.g: for the node exporter's textfile collector
+METRICS_EXPORT = "HTTP"
+# Port of the local HTTP endpoint, serving the metrics on /metrics
+METRICS_PORT = 9464
+# Path of the metrics file and seconds between writes
+METRICS_FILE = "metrics.prom"
+METRICS_INTERVAL = 10
+
+# Profiling Settings: When enabled, every evaluation cycle is broken down into the time spent ingesting messages,
+# evaluating, triggering and publishing, slow Automation evaluations are logged, and a JSON report ranking the most
+# expensive Automations and Entities is written on exit or when the process receives SIGUSR1. Enables the metrics
+# instrumentation, without exporting the metrics unless METRICS is set.
+PROFILE = False
+# Seconds a single Automation evaluation may take before it is flagged as slow
+PROFILE_BUDGET = 0.001
+# Number of Automations, Entities and cycles listed in the report
+PROFILE_TOP = 10
+# Path of the JSON report
+PROFILE_REPORT = "profile.json"
+# Path of an optional sampling trace in the collapsed stack format read by flame graph tools (e.g: flamegraph.pl,
+# speedscope), or None. Stacks of all threads are sampled every PROFILE_SAMPLE_INTERVAL seconds
+PROFILE_TRACE = None
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# Record Setting: Path of a traffic log every message received by an Entity is appended to, or None to not record.
+# Recorded traffic can be replayed against a model without a broker, e.g: to load test a new rule set, using
+# python -m lib.replay run lang/full_metamodel.tx my_config.model traffic.log --speed 10
+RECORD_PATH = None
+
+# Event Log Settings: Automation triggers, changes of condition results and errors are recorded as structured events
+# in a ring buffer of the most recent events, and written in batches by a background thread.
+# Destination of the events: "stdout" prints them as text lines, a file path appends them as JSON lines, and a
+# "tcp://host:port" or "udp://host:port" address sends them as JSON lines, e.g: to a log collector. None only keeps
+# the ring buffer
+EVENT_LOG_TARGET = "stdout"
+# Minimum level of recorded events: "debug" (also records every evaluation), "info", "warning" or "error"
+EVENT_LOG_LEVEL = "info"
+# Fraction of the events of each kind that are recorded, e.g: {"evaluation": 0.01}. Kinds not listed are all recorded
+EVENT_LOG_SAMPLING = {}
+# Number of recent events kept in the ring buffer
+EVENT_LOG_SIZE = 10000
+# Maximum seconds between batched writes
+EVENT_LOG_INTERVAL = 1
+# Serve the recent events as JSON on /events of the metrics HTTP endpoint (METRICS_PORT), e.g:
+# http://127.0.0.1:9464/events?kind=trigger&automation=gasAlert&count=20
+EVENT_LOG_HTTP = False
+
+# State Persistence Settings: The Attribute values and the enabled flags of Automations are saved to a state file every
+# STATE_INTERVAL seconds, when they changed, and restored on startup before the Broker connections start. Automations
+# then start from the last known device states instead of waiting for every device to publish again. Restored values
+# are applied like received messages, so Automations may trigger at startup on values that are no longer current, and
+# Automations that disabled themselves stay disabled. With SHARDS, only the Attribute values are persisted. Path of the
+# state file, e.g: "config/state.bin", or None to disable persistence
+STATE_PATH = None
+# Seconds between saves of the state file
+STATE_INTERVAL = 5
+
 # Node-RED integration broker settings. Configure this if you have RUN_MODE = "MQTT".
 nr_mqtt = {
     "host": "127.0.0.1",
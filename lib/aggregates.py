@@ -0,0 +1,357 @@
+import math
+import logging
+import threading
+from array import array
+from collections import deque
+
+from .entity import Attribute
+from .metrics import metrics
+from .state import state_store
+from .timers import timers, parse_duration
+
+# Initial number of samples kept per Attribute. The ring doubles while its oldest sample is still inside a window
+HISTORY_SIZE = 256
+# Maximum number of samples kept per Attribute. Past it, samples still inside a window are dropped and counted
+HISTORY_LIMIT = 1 << 20
+
+# Aggregate functions
+AGGREGATE_FUNCTIONS = ('avg', 'min', 'max', 'count')
+
+
+# A class keeping the recent values of a numeric Attribute
+class History:
+    """
+    The History class keeps the most recent values received by a numeric Attribute, and when they were received, in a
+    ring buffer backed by two arrays. It is created for an Attribute when an Aggregate over it is started, and every
+    Aggregate over the Attribute is updated as samples are appended, so evaluating them reads a single slot. Samples
+    are numbered in the order they are appended: sample n is stored at index n % size. The ring doubles when a sample
+    would overwrite one still inside a window, so it ends up sized for the longest window and the Attribute's rate,
+    up to limit samples. Past the limit, the oldest samples leave their windows early and are counted in truncated.
+    ...
+
+    Attributes
+    ----------
+        attribute: Attribute object
+            The recorded Attribute
+        size: int
+            Number of samples kept
+        limit: int
+            Maximum number of samples kept
+        times: array
+            Time each sample was received at, on the timer wheel's clock
+        values: array
+            Value of each sample
+        count: int
+            Number of samples appended so far. The next sample is numbered count
+        truncated: int
+            Number of samples removed from a window they were still inside, because the ring was at its limit
+        aggregates: list
+            Aggregate objects computed over the samples
+        lock: threading.Lock
+            Lock guarding the samples and the Aggregates, which ingestion threads and timer callbacks both update
+
+    Methods
+    -------
+        record(self, message): Appends the Attribute's value if a message set it.
+        append(self, now, value): Appends a sample and updates the Aggregates.
+    """
+
+    def __init__(self, attribute, size=HISTORY_SIZE, limit=HISTORY_LIMIT):
+        """
+        Creates and returns a History object
+        :param attribute: The numeric Attribute to record
+        :param size: Initial number of samples kept
+        :param limit: Maximum number of samples kept
+        """
+        self.attribute = attribute
+        self.size = min(size, limit)
+        self.limit = limit
+        self.times = array('d', bytes(8 * self.size))
+        self.values = array('d', bytes(8 * self.size))
+        self.count = 0
+        self.truncated = 0
+        self.aggregates = []
+        self.lock = threading.Lock()
+
+    # Record the Attribute's value if a message set it
+    def record(self, message):
+        """
+        Appends the Attribute's value as a sample if a message received by its Entity set it. Meant to be called by
+        Entity.update_state() after the message is applied, while it is still being applied to the state store.
+        :param message: Dictionary applied to the Entity
+        :return: List of the Aggregates whose value changed
+        """
+        if self.attribute.name not in message:
+            return []
+        value = self.attribute.value
+        # Values that are not numbers, e.g: not coercible to the declared type, are not samples
+        if type(value) is not int and type(value) is not float:
+            return []
+        return self.append(timers.clock(), value)
+
+    # Append a sample
+    def append(self, now, value):
+        """
+        Appends a sample and updates the Aggregates, in O(1) amortized time per Aggregate. Must be called while a
+        message is being applied to the state store, see StateStore.begin().
+        :param now: Time the sample was received at
+        :param value: Value of the sample
+        :return: List of the Aggregates whose value changed
+        """
+        with self.lock:
+            # Samples that left the windows since the timers last removed them do not hold the ring
+            for aggregate in self.aggregates:
+                aggregate.evict(now)
+            sample = self.count
+            # The ring is full: grow it if the oldest sample is still inside a window, otherwise overwrite it
+            if sample >= self.size:
+                oldest = sample - self.size
+                if any(aggregate.first <= oldest for aggregate in self.aggregates):
+                    if self.size < self.limit:
+                        self.grow()
+                    else:
+                        self.truncate(oldest)
+            self.times[sample % self.size] = now
+            self.values[sample % self.size] = value
+            self.count += 1
+            changed = []
+            for aggregate in self.aggregates:
+                aggregate.add(sample)
+                aggregate.arm()
+                if aggregate.refresh():
+                    changed.append(aggregate)
+            return changed
+
+    # Double the ring, keeping the samples at their index in the larger one
+    def grow(self):
+        size = min(2 * self.size, self.limit)
+        times = array('d', bytes(8 * size))
+        values = array('d', bytes(8 * size))
+        for sample in range(max(self.count - self.size, 0), self.count):
+            times[sample % size] = self.times[sample % self.size]
+            values[sample % size] = self.values[sample % self.size]
+        self.times, self.values, self.size = times, values, size
+
+    # Remove the oldest sample, about to be overwritten, from the windows still holding it
+    def truncate(self, oldest):
+        if not self.truncated:
+            logging.warning(f"History of {self.attribute.parent.name}.{self.attribute.name} reached {self.limit} "
+                            f"samples. Samples leave its aggregate windows early")
+        self.truncated += 1
+        if metrics.enabled:
+            metrics.truncated_samples.inc(f"{self.attribute.parent.name}.{self.attribute.name}")
+        for aggregate in self.aggregates:
+            aggregate.drop(oldest)
+
+
+# Returns the History of an Attribute, creating it if needed
+def history_of(attribute):
+    if getattr(attribute, 'history', None) is None:
+        attribute.history = History(attribute)
+        attribute.parent.histories.append(attribute.history)
+    return attribute.history
+
+
+# An aggregate of an Attribute's recent values, used as a condition operand
+class Aggregate(Attribute):
+    """
+    The Aggregate class represents the average, minimum, maximum or count of the values a numeric Attribute received
+    within a trailing time window, e.g: avg(porch.temperature, 10m). Conditions read an Aggregate like an Attribute:
+    its value is kept in a state store slot, updated as samples enter and leave the window, and a change schedules the
+    Automations reading it. Samples enter when they are received, see History, and leave when they are older than the
+    window, at the deadlines of a timer on the timer wheel. The sum of the samples in the window is kept for averages,
+    and a monotonic deque of sample numbers for minimums and maximums, so each sample is added and removed once.
+    The avg, min and max of an empty window are NaN, so comparisons with them are false, and its count is 0.
+    ...
+
+    Attributes
+    ----------
+        function: str
+            One of AGGREGATE_FUNCTIONS
+        attribute: Attribute object
+            The aggregated numeric Attribute
+        window: str
+            Window duration as written in the model. e.g: '10m'
+        span: float
+            Window duration in seconds
+        history: History object
+            History of the aggregated Attribute. None until started
+        first: int
+            Number of the oldest sample in the window. Samples first to history.count are in the window
+        total: float
+            Sum of the samples in the window
+        extremes: deque
+            Numbers of the samples that may become the window's minimum (or maximum), their values increasing (or
+            decreasing). The first one is the current minimum (or maximum)
+        expiry: Timer object
+            Timer due when the oldest sample leaves the window. None while the window is empty
+
+    Methods
+    -------
+        start(self): Starts maintaining the Aggregate from the Attribute's history.
+        stop(self): Stops maintaining the Aggregate and releases its state store slot.
+        describe(self): Returns the Aggregate as written in the model.
+    """
+
+    # The slot is allocated by start(), in the column of the function's result
+    kind = None
+    value_type = None
+
+    def __init__(self, parent, function, attribute, window):
+        """
+        Creates and returns an Aggregate object. It is only maintained once started
+        :param parent: Parameter required for Custom Class compatibility in textX
+        :param function: One of AGGREGATE_FUNCTIONS
+        :param attribute: The numeric Attribute aggregated
+        :param window: Window duration. e.g: '10m'
+        """
+        super().__init__(parent, f"{function}({window})")
+        self.function = function
+        self.attribute = attribute
+        self.window = window
+        self.span = parse_duration(window)
+        if self.span <= 0:
+            raise ValueError(f"Aggregate window must be positive: '{window}'")
+        self.history = None
+        self.first = 0
+        self.total = 0.0
+        self.extremes = deque()
+        self.expiry = None
+
+    # Start maintaining the Aggregate
+    def start(self):
+        """
+        Allocates the Aggregate's state store slot and starts maintaining it from the history of its Attribute, which is
+        created if needed. Samples already in the history and within the window are added. Restarts a started Aggregate.
+        :return:
+        """
+        self.stop()
+        self.kind = 'int' if self.function == 'count' else 'float'
+        self.column, self.slot = state_store.allocate(self.kind)
+        self.history = history_of(self.attribute)
+        now = timers.clock()
+        with self.history.lock:
+            self.first = max(self.history.count - self.history.size, 0)
+            self.total = 0.0
+            self.extremes.clear()
+            for sample in range(self.first, self.history.count):
+                self.add(sample)
+            self.evict(now)
+            self.arm()
+            writer = state_store.begin()
+            try:
+                self.refresh()
+            finally:
+                state_store.end(writer)
+            self.history.aggregates.append(self)
+
+    # Stop maintaining the Aggregate
+    def stop(self):
+        """
+        Stops maintaining the Aggregate and releases its state store slot. Stopping a stopped Aggregate does nothing.
+        :return:
+        """
+        if self.history is None:
+            return
+        with self.history.lock:
+            self.history.aggregates.remove(self)
+            if self.expiry is not None:
+                self.expiry.cancel()
+                self.expiry = None
+        self.release()
+        self.kind = None
+        self.history = None
+
+    # Add a sample, the newest of the history, to the window
+    def add(self, sample):
+        value = self.history.values[sample % self.history.size]
+        if self.function == 'avg':
+            self.total += value
+        elif self.function != 'count':
+            values, size, extremes = self.history.values, self.history.size, self.extremes
+            # Samples that can no longer be the minimum (maximum) while the new one is in the window
+            if self.function == 'min':
+                while extremes and values[extremes[-1] % size] >= value:
+                    extremes.pop()
+            else:
+                while extremes and values[extremes[-1] % size] <= value:
+                    extremes.pop()
+            extremes.append(sample)
+
+    # Remove the oldest sample of the window
+    def remove(self):
+        if self.function == 'avg':
+            self.total -= self.history.values[self.first % self.history.size]
+        self.first += 1
+        if self.extremes and self.extremes[0] < self.first:
+            self.extremes.popleft()
+        # Keep rounding errors of the running sum from accumulating
+        if self.first == self.history.count:
+            self.total = 0.0
+
+    # Remove a sample about to be overwritten, if still in the window
+    def drop(self, sample):
+        if self.first == sample:
+            self.remove()
+
+    # Remove the samples older than the window
+    def evict(self, now):
+        history = self.history
+        limit = now - self.span
+        while self.first < history.count and history.times[self.first % history.size] <= limit:
+            self.remove()
+
+    # Arm the timer removing the oldest sample when it leaves the window
+    def arm(self):
+        if self.expiry is None and self.first < self.history.count:
+            deadline = self.history.times[self.first % self.history.size] + self.span
+            self.expiry = timers.schedule(deadline, self.expire)
+
+    # Timer callback: remove the samples that left the window
+    def expire(self):
+        history = self.history
+        if history is None:
+            return
+        with history.lock:
+            self.expiry = None
+            self.evict(timers.clock())
+            self.arm()
+            writer = state_store.begin()
+            try:
+                changed = self.refresh()
+            finally:
+                state_store.end(writer)
+        # Schedule the Automations reading the Aggregate, if the model runs in event-driven mode
+        scheduler = getattr(self.attribute.parent.parent, 'scheduler', None)
+        if changed and scheduler is not None:
+            scheduler.schedule(self.automations)
+
+    # Returns the value of the Aggregate over the samples in the window
+    def result(self):
+        count = self.history.count - self.first
+        if self.function == 'count':
+            return count
+        if not count:
+            return math.nan
+        if self.function == 'avg':
+            return self.total / count
+        return self.history.values[self.extremes[0] % self.history.size]
+
+    # Store the value in the state store slot. Returns whether it changed
+    def refresh(self):
+        value = self.result()
+        # NaN is not equal to itself, but an empty window staying empty is not a change
+        if value != value and self.value != self.value:
+            return False
+        if self.column.update(self.slot, value):
+            self.column.versions[self.slot] += 1
+            return True
+        return False
+
+    # Returns the Aggregate as written in the model. e.g: 'avg(porch.temperature, 10m)'
+    def describe(self):
+        return f"{self.function}({self.attribute.parent.name}.{self.attribute.name}, {self.window})"
+
+    # Returns the arguments recreating the Aggregate
+    def definition(self):
+        return self.function, self.window
@@ -0,0 +1,498 @@
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from commlib.endpoints import endpoint_factory, EndpointType, TransportType
+
+from .cache import serialize_model
+from .connection import start_connections, stop_connections, broker_key
+from .dispatcher import OVERFLOW_POLICIES
+from .metrics import metrics, watch_model
+from .persistence import StatePersistence
+from .profiling import profiler
+from .recording import TrafficRecorder
+from .reload import ModelReloader
+from .state import state_store
+from .timers import timers
+from .vectorized import VectorEvaluator
+from .network import ConditionNetwork
+
+
+# A class scheduling Automations for evaluation on the event loop
+class AsyncScheduler:
+    """
+    The AsyncScheduler class is the event loop counterpart of Scheduler. Entities schedule the Automations that read
+    their updated Attributes and the evaluation task awaits the next batch. Since the AsyncRuntime bridges all broker
+    callbacks to the event loop, it is only used from the event loop thread and needs no locking.
+    ...
+
+    Attributes
+    ----------
+        pending: dict
+            Automations waiting to be evaluated, in scheduling order. Used as an ordered set
+        event: asyncio.Event
+            Set while pending is not empty
+
+    Methods
+    -------
+        schedule(self, automations): Queues the given Automations for evaluation unless they are already queued.
+        next_batch(self): Waits until Automations are scheduled and returns all of them.
+    """
+
+    def __init__(self):
+        """
+        Creates and returns an AsyncScheduler object. Must be created while the event loop is running.
+        """
+        self.pending = {}
+        self.event = asyncio.Event()
+
+    # Queue Automations for evaluation
+    def schedule(self, automations):
+        """
+        Queues the given Automations for evaluation. Automations that are already waiting are skipped.
+        :param automations: Iterable of Automation objects
+        :return:
+        """
+        for automation in automations:
+            self.pending[automation] = None
+        if self.pending:
+            self.event.set()
+
+    # Get all scheduled Automations
+    async def next_batch(self):
+        """
+        Waits until Automations are scheduled and returns all of them.
+        :return: List of Automation objects
+        """
+        await self.event.wait()
+        self.event.clear()
+        batch = list(self.pending)
+        self.pending.clear()
+        return batch
+
+
+# A class dispatching Automation actions to Brokers from the event loop
+class AsyncDispatcher:
+    """
+    The AsyncDispatcher class is the event loop counterpart of Dispatcher. Messages submitted during an evaluation
+    cycle are merged per Entity and put into bounded per-Broker asyncio queues when the cycle ends. commlib-py
+    publishers are blocking, so each Broker's queue is drained by a task publishing through a single-thread executor
+    dedicated to that Broker. A slow Broker then only delays its own messages.
+    ...
+
+    Attributes
+    ----------
+        maxsize: int
+            Maximum number of queued messages per Broker
+        overflow: str
+            Policy used when a Broker's queue is full. One of OVERFLOW_POLICIES
+        queues: dict
+            Dictionary mapping Broker connection keys to their asyncio.Queue objects. Brokers reloaded with the same
+            connection parameters keep their queue. See lib.connection.broker_key()
+        executors: dict
+            Dictionary mapping Broker connection keys to the executors publishing their messages
+        brokers: dict
+            Dictionary mapping Broker connection keys to the latest Broker object using them
+        pending: dict
+            Messages submitted during the current evaluation cycle, merged per Entity {entity: message}
+        triggered: dict
+            Time the first Automation submitting each pending message triggered at {entity: time}. Only filled while
+            metrics are enabled
+        coalesced: int
+            Number of submitted messages merged into an earlier message for the same Entity
+        published, dropped, errors: dict
+            Per-Broker statistics {broker connection key: count}
+
+    Methods
+    -------
+        submit(self, entity, message, triggered=None): Adds a message to the current evaluation cycle.
+        flush(self): Coroutine ending the evaluation cycle, queueing the merged messages to their Brokers.
+        queue_depths(self): Returns the number of queued messages per Broker.
+        stats(self): Returns the queue statistics per Broker and the number of coalesced messages.
+        stop(self): Cancels the publishing tasks and shuts down the executors.
+    """
+
+    def __init__(self, maxsize=1000, overflow='drop_oldest'):
+        """
+        Creates and returns an AsyncDispatcher object. Must be created while the event loop is running.
+        :param maxsize: Maximum number of queued messages per Broker
+        :param overflow: Policy used when a Broker's queue is full. One of OVERFLOW_POLICIES
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}'. Use one of {OVERFLOW_POLICIES}")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.queues = {}
+        self.executors = {}
+        self.brokers = {}
+        self.tasks = []
+        self.pending = {}
+        self.triggered = {}
+        self.coalesced = 0
+        self.published = {}
+        self.dropped = {}
+        self.errors = {}
+
+    # Add a message to the current evaluation cycle
+    def submit(self, entity, message, triggered=None):
+        """
+        Adds a message to the current evaluation cycle. Messages to an Entity that already has a message in the cycle
+        are merged into it, with later values overriding earlier ones.
+        :param entity: Entity to publish the message to
+        :param message: Dictionary containing the message
+        :param triggered: time.perf_counter() time the submitting Automation triggered at. None if metrics are disabled
+        :return:
+        """
+        if triggered is not None:
+            self.triggered.setdefault(entity, triggered)
+        if entity in self.pending:
+            self.pending[entity].update(message)
+            self.coalesced += 1
+        else:
+            self.pending[entity] = dict(message)
+
+    # End the evaluation cycle
+    async def flush(self):
+        """
+        Ends the current evaluation cycle by putting the merged message of each Entity into its Broker's queue,
+        applying the overflow policy to full queues.
+        :return:
+        """
+        pending, self.pending = self.pending, {}
+        triggered, self.triggered = self.triggered, {}
+        for entity, message in pending.items():
+            key = broker_key(entity.broker)
+            queue = self.get_queue(entity.broker)
+            if queue.full():
+                if self.overflow == 'drop_newest':
+                    self.dropped[key] += 1
+                    continue
+                elif self.overflow == 'drop_oldest':
+                    queue.get_nowait()
+                    queue.task_done()
+                    self.dropped[key] += 1
+            # Waits for space if the policy is 'block'
+            await queue.put((entity, message, triggered.get(entity)))
+
+    # Return the queue of a Broker, creating it and its publishing task if needed
+    def get_queue(self, broker):
+        key = broker_key(broker)
+        self.brokers[key] = broker
+        if key not in self.queues:
+            self.queues[key] = asyncio.Queue(maxsize=self.maxsize)
+            self.executors[key] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"publisher-{broker.name}")
+            self.published[key] = self.dropped[key] = self.errors[key] = 0
+            self.tasks.append(asyncio.get_running_loop().create_task(self.work(key)))
+        return self.queues[key]
+
+    # Task publishing the messages of a Broker's queue
+    async def work(self, key):
+        loop = asyncio.get_running_loop()
+        queue = self.queues[key]
+        while True:
+            entity, message, triggered = await queue.get()
+            broker = entity.broker
+            start = time.perf_counter() if metrics.enabled else None
+            try:
+                await loop.run_in_executor(self.executors[key], entity.publish, message)
+                self.published[key] += 1
+                if start is not None:
+                    end = time.perf_counter()
+                    metrics.publish_duration.observe(broker.name, end - start)
+                    if triggered is not None:
+                        metrics.publish_latency.observe(broker.name, end - triggered)
+            except Exception:
+                self.errors[key] += 1
+                logging.error(f"Publishing to {entity.name} via {broker.name} failed", exc_info=True)
+            finally:
+                queue.task_done()
+
+    # Number of queued messages per Broker
+    def queue_depths(self):
+        """
+        Returns the number of messages waiting to be published per Broker.
+        :return: Dictionary {broker_name: depth}
+        """
+        return {self.brokers[key].name: queue.qsize() for key, queue in self.queues.items()}
+
+    # Queue statistics per Broker
+    def stats(self):
+        """
+        Returns the queue statistics per Broker and the number of coalesced messages.
+        :return: Dictionary {'queues': {broker_name: {'depth': int, 'published': int, 'dropped': int, 'errors': int}},
+            'coalesced': int}
+        """
+        queues = {self.brokers[key].name: {'depth': queue.qsize(), 'published': self.published[key],
+                                           'dropped': self.dropped[key], 'errors': self.errors[key]}
+                  for key, queue in self.queues.items()}
+        return {'queues': queues, 'coalesced': self.coalesced}
+
+    # Stop publishing
+    def stop(self):
+        """
+        Cancels the publishing tasks and shuts down the executors.
+        :return:
+        """
+        for task in self.tasks:
+            task.cancel()
+        for executor in self.executors.values():
+            executor.shutdown(wait=False)
+
+
+# A class running HA-Auto on a single asyncio event loop
+class AsyncRuntime:
+    """
+    The AsyncRuntime class runs model reception, Entity ingestion, Automation evaluation and action publishing on one
+    asyncio event loop. commlib-py has no asyncio transports, so broker callbacks are bridged from the transport
+    threads to the event loop with call_soon_threadsafe() and publishing runs in one executor thread per Broker.
+    All model state is therefore only touched by the event loop thread.
+    ...
+
+    Attributes
+    ----------
+        metamodel: textX metamodel
+            Metamodel used to parse configuration models
+        run_automation: callable
+            Function evaluating an Automation and running its actions, called as run_automation(automation, result).
+            e.g: main.run_automation
+        eval_mode: str
+            "Event" to evaluate Automations when their Attributes change, or "Polling" to evaluate all of them every
+            poll_interval seconds
+        poll_interval: float
+            Seconds between evaluation cycles in "Polling" mode
+        eval_backend: str
+            "Scalar" to evaluate each Automation's condition separately, "Vectorized" to evaluate all conditions in
+            one NumPy pass per cycle in "Polling" mode, or "Network" to update a shared condition network every cycle.
+            See VectorEvaluator and ConditionNetwork
+        model: textX model
+            The running configuration model. Set by load_model()
+        dispatcher: AsyncDispatcher object
+            Dispatcher publishing the Automation actions
+        reloader: ModelReloader object
+            Applies models received after startup to the running model. Set by run()
+        record_path: str
+            Path of the traffic log the received Entity messages are appended to, or None. See TrafficRecorder
+        state_path: str
+            Path of the state file the model's state is saved to and restored from, or None. See StatePersistence
+        state_interval: float
+            Seconds between saves of the state file
+
+    Methods
+    -------
+        subscribe_models(self, conn_params, topic): Subscribes to the models sent by the Node-RED integration.
+        load_model(self, model_str): Parses a model and starts its Broker connections, bridged to the loop.
+        evaluate(self): Coroutine running evaluation cycles forever.
+        reload_models(self, models): Coroutine applying received models to the running model.
+        run_local(self, model_path): Coroutine running a model read from a file.
+        run_remote(self, conn_params, topic): Coroutine running the models received from the Node-RED integration.
+    """
+
+    def __init__(self, metamodel, run_automation, eval_mode="Event", poll_interval=1, eval_backend="Scalar",
+                 dispatch_queue_size=1000, dispatch_overflow='drop_oldest', record_path=None, state_path=None,
+                 state_interval=5):
+        """
+        Creates and returns an AsyncRuntime object
+        :param metamodel: Metamodel used to parse configuration models
+        :param run_automation: Function evaluating an Automation and running its actions
+        :param eval_mode: "Event" or "Polling"
+        :param poll_interval: Seconds between evaluation cycles in "Polling" mode
+        :param eval_backend: "Scalar", "Vectorized" or "Network"
+        :param dispatch_queue_size: Maximum number of queued messages per Broker
+        :param dispatch_overflow: Policy used when a Broker's queue is full. One of OVERFLOW_POLICIES
+        :param record_path: Path of the traffic log the received Entity messages are appended to, or None
+        :param state_path: Path of the state file the model's state is saved to and restored from, or None
+        :param state_interval: Seconds between saves of the state file
+        """
+        self.metamodel = metamodel
+        self.run_automation = run_automation
+        self.eval_mode = eval_mode
+        self.poll_interval = poll_interval
+        self.eval_backend = eval_backend
+        self.dispatch_queue_size = dispatch_queue_size
+        self.dispatch_overflow = dispatch_overflow
+        self.record_path = record_path
+        self.state_path = state_path
+        self.state_interval = state_interval
+        self.model = None
+        self.dispatcher = None
+        self.reloader = None
+        self.loop = None
+
+    # Subscribe to the models sent by the Node-RED integration
+    def subscribe_models(self, conn_params, topic):
+        """
+        Subscribes to the Node-RED integration topic. Received configuration models are put into an asyncio queue, so
+        they can be awaited without polling.
+        :param conn_params: commlib-py MQTT ConnectionParameters of the Node-RED integration broker
+        :param topic: Topic the Node-RED integration publishes the model on
+        :return: The running subscriber and the asyncio.Queue receiving the models as strings
+        """
+        models = asyncio.Queue()
+
+        # Subscriber callback, run on the transport thread. Queues the model on the event loop
+        def on_model(data):
+            logging.info("Configuration Received")
+            self.loop.call_soon_threadsafe(models.put_nowait, data["config"])
+
+        subscriber = endpoint_factory(EndpointType.Subscriber, TransportType.MQTT)(
+            topic=topic,
+            conn_params=conn_params,
+            on_message=on_model
+        )
+        subscriber.run()
+        return subscriber, models
+
+    # Parse a model and connect its Entities
+    def load_model(self, model_str):
+        """
+        Parses a configuration model, builds its Automation conditions and starts its Broker connections with their
+        callbacks bridged to the event loop.
+        :param model_str: Configuration model as a string
+        :return: The parsed model
+        """
+        model = self.metamodel.model_from_str(model_str)
+
+        # Build entities dictionary in model. Needed for evaluating conditions
+        model.entities_dict = {entity.name: entity for entity in model.entities}
+
+        # Definition of the model as parsed, which reloaded models are compared with. Taken before the enabled flags
+        # are restored, so restored flags do not count as changes
+        data = serialize_model(model)
+
+        # Restore the last saved state before the conditions are built and messages received, then keep saving it
+        if self.state_path:
+            persistence = StatePersistence(model, self.state_path, self.state_interval)
+            persistence.restore()
+            persistence.start()
+
+        # Build Conditions for all Automations
+        for automation in model.automations:
+            automation.build_condition()
+            logging.debug(f"{automation.name} condition: {automation.condition.cond_lambda}")
+
+        # Attach the event loop scheduler and dispatcher, and the traffic recorder
+        model.dispatcher = self.dispatcher
+        if self.record_path:
+            model.recorder = TrafficRecorder(self.record_path)
+        if self.eval_mode == "Event":
+            model.scheduler = AsyncScheduler()
+            # Evaluate all Automations once
+            model.scheduler.schedule(model.automations)
+
+        # Run Entity updates on the event loop instead of the transport threads, then start the connections
+        start_connections(bridge=self.loop.call_soon_threadsafe)
+
+        self.model = model
+        self.reloader.attach(model, model_str, data)
+        # Measure the model's queues and connections when metrics are exported
+        watch_model(model)
+        return model
+
+    # Run evaluation cycles forever
+    async def evaluate(self):
+        """
+        Runs evaluation cycles forever. In "Event" mode each cycle evaluates the scheduled Automations, waking up when
+        a timer is due, in "Polling" mode all Automations are evaluated every poll_interval seconds, in one vectorized
+        pass with the "Vectorized" backend. With the "Network" backend the shared condition network is updated at the
+        start of each cycle and provides the results. The actions of each cycle are flushed to the dispatcher at its
+        end.
+        :return:
+        """
+        evaluator = None
+        if self.eval_mode != "Event" and self.eval_backend == "Vectorized":
+            evaluator = VectorEvaluator(self.model)
+        elif self.eval_backend == "Network":
+            evaluator = ConditionNetwork(self.model)
+        while True:
+            # Wait for the next cycle. Due timers set the time conditions they change, scheduling the Automations
+            # reading them in "Event" mode
+            if self.eval_mode == "Event":
+                timers.advance()
+                try:
+                    automations = await asyncio.wait_for(self.model.scheduler.next_batch(), timers.timeout())
+                except asyncio.TimeoutError:
+                    continue
+            else:
+                await asyncio.sleep(self.poll_interval)
+                timers.advance()
+                automations = self.model.automations
+            with profiler.cycle():
+                state_store.snapshot()
+                if evaluator is None:
+                    results = [(automation, None) for automation in automations]
+                elif self.eval_mode == "Event":
+                    evaluator.update()
+                    results = [(automation, evaluator.result(automation)) for automation in automations]
+                else:
+                    results = evaluator.evaluate()
+                for automation, result in results:
+                    self.run_automation(automation, result)
+                await self.dispatcher.flush()
+
+    # Apply received models to the running model
+    async def reload_models(self, models):
+        """
+        Applies the models put into a queue to the running model, forever. Models are loaded on an executor thread, so
+        parsing does not stall the event loop. Loading leaves the new Entities detached (see ModelReloader.load()), so
+        the executor thread never touches the connections or the state store: the new Entities are registered and
+        their slots allocated when the model is applied, on the event loop.
+        :param models: asyncio.Queue of model sources
+        :return:
+        """
+        while True:
+            model_str = await models.get()
+            new_model = await self.loop.run_in_executor(None, self.reloader.load, model_str)
+            if new_model is not None:
+                self.reloader.apply(new_model)
+
+    # Start the runtime for a model
+    async def run(self, model_str, models=None):
+        """
+        Runs a configuration model.
+        :param model_str: Configuration model as a string
+        :param models: Optional asyncio.Queue of models applied to the running model when received
+        :return:
+        """
+        self.loop = asyncio.get_running_loop()
+        self.dispatcher = AsyncDispatcher(maxsize=self.dispatch_queue_size, overflow=self.dispatch_overflow)
+        self.reloader = ModelReloader(self.metamodel, bridge=self.loop.call_soon_threadsafe)
+        self.load_model(model_str)
+        tasks = [self.evaluate()]
+        if models is not None:
+            tasks.append(self.reload_models(models))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            stop_connections()
+            self.dispatcher.stop()
+            if getattr(self.model, 'recorder', None) is not None:
+                self.model.recorder.close()
+
+    # Run a local model
+    async def run_local(self, model_path):
+        """
+        Runs the configuration model stored in a file.
+        :param model_path: Path of the configuration model. e.g: 'config/config_local.model'
+        :return:
+        """
+        with open(model_path) as f:
+            model_str = f.read()
+        await self.run(model_str)
+
+    # Run the models received from the Node-RED integration
+    async def run_remote(self, conn_params, topic):
+        """
+        Waits for a configuration model from the Node-RED integration and runs it. Models received later are applied to
+        the running model.
+        :param conn_params: commlib-py MQTT ConnectionParameters of the Node-RED integration broker
+        :param topic: Topic the Node-RED integration publishes the model on
+        :return:
+        """
+        self.loop = asyncio.get_running_loop()
+        subscriber, models = self.subscribe_models(conn_params, topic)
+        try:
+            model_str = await models.get()
+            await self.run(model_str, models)
+        finally:
+            subscriber.stop()
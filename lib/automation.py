@@ -1,4 +1,9 @@
-from textx import textx_isinstance, get_metamodel
+import time
+
+from .metrics import metrics
+from .ir import IRBuilder, format_ir, compile_ir, read_attributes
+from .timers import TimeCondition, timers, parse_duration
+from .aggregates import Aggregate
 
 # List of primitive types that can be directly printed
 primitives = (int, float, str, bool)
@@ -27,6 +32,30 @@ operators = {
     'NAND': lambda left, right: f"(not ({left} and {right}))"
 }
 
+# Functions applying each operator to two evaluated operand values. Mirror the expressions built by operators
+operator_functions = {
+    # String operators
+    '~': lambda left, right: left in right,
+    '!~': lambda left, right: left not in right,
+
+    # Shared operators
+    '==': lambda left, right: left == right,
+    '!=': lambda left, right: left != right,
+
+    # Numeric operators
+    '>': lambda left, right: left > right,
+    '<': lambda left, right: left < right,
+
+    # Boolean operators
+    'AND': lambda left, right: left and right,
+    'OR': lambda left, right: left or right,
+    'NOT': lambda left, right: left is not right,
+    'XOR': lambda left, right: left ^ right,
+    'NOR': lambda left, right: not (left or right),
+    'XNOR': lambda left, right: (left or right) and (not left or not right),
+    'NAND': lambda left, right: not (left and right)
+}
+
 
 # Returns printed version of operand if operand is a primitive.
 # Else if attribute returns code pointing to the Attribute.
@@ -43,11 +72,102 @@ def print_operand(node):
     # If node is a Dict object just print it out. List has __repr()__ built in
     elif type(node) == Dict:
         return node
+    # If node is an Aggregate, print it as written in the model
+    elif is_aggregate(node):
+        return node.describe()
     # Node is an Attribute, print its full name including Entity
     else:
         return f"model.entities_dict['{node.parent.name}'].attributes_dict['{node.name}'].value"
 
 
+# Returns True if a condition node is a ConditionGroup and False if it is a primitive condition. Only ConditionGroups
+# have r1/r2 sides, so this works for textX parsed conditions as well as conditions restored from the model cache.
+def is_condition_group(node):
+    return hasattr(node, 'r1')
+
+
+# Returns True if a primitive condition is a time condition (e.g: time between 22:00 and 06:00). Their operand1 is the
+# TimerState holding their value, not an Entity Attribute. See lib.timers.TimeCondition
+def is_time_condition(node):
+    return isinstance(node, TimeCondition)
+
+
+# Returns True if a condition operand is an Entity Attribute or an Aggregate, and not a literal
+def is_attribute(node):
+    return type(node) not in primitives and type(node) not in (List, Dict)
+
+
+# Returns True if a condition operand is an Aggregate over an Attribute's recent values (e.g: avg(porch.temperature,
+# 10m)). Aggregates are read like Attributes, but belong to their condition. See lib.aggregates.Aggregate
+def is_aggregate(node):
+    return isinstance(node, Aggregate)
+
+
+# Returns the Entity Attribute a condition operand reads: the operand itself, or the Attribute an Aggregate is
+# computed over
+def source_attribute(node):
+    return node.attribute if is_aggregate(node) else node
+
+
+# Returns the python value of a literal operand. List and Dict objects are converted to python lists and dicts.
+def literal_value(node):
+    if type(node) == List:
+        return [literal_value(item) for item in node.items]
+    elif type(node) == Dict:
+        return {item.name: literal_value(item.value) for item in node.items}
+    else:
+        return node
+
+
+# Functions building primitive condition callables, by the source of their expression. Filled by compile_primitive()
+primitive_factories = {}
+
+
+# Compiles a primitive condition into a callable reading the state store slots of the Attributes it compares. The
+# operands are read inline in the condition's expression, which is built with the same operators used for cond_lambda.
+# Callables of conditions with the same operator and operand kinds share one compiled factory.
+def compile_primitive(operator, operand1, operand2):
+    # Literal compared to literal. The result never changes, so compute it once
+    if not is_attribute(operand1) and not is_attribute(operand2):
+        result = operator_functions[operator](literal_value(operand1), literal_value(operand2))
+        return lambda: result
+
+    sources = []
+    names = {}
+    for prefix, operand in (('left_', operand1), ('right_', operand2)):
+        if is_attribute(operand):
+            source, operand_names = operand.read_source(prefix)
+        else:
+            source, operand_names = f"{prefix}value", {f"{prefix}value": literal_value(operand)}
+        sources.append(source)
+        names.update(operand_names)
+
+    expression = operators[operator](*sources)
+    if expression not in primitive_factories:
+        # The factory takes the names as arguments so that the returned callable reads them as closure variables
+        primitive_factories[expression] = eval(f"lambda {', '.join(names)}: lambda: {expression}")
+    return primitive_factories[expression](**names)
+
+
+# Functions building version readers, by the source of their expression. Filled by compile_versions()
+version_factories = {}
+
+
+# Compiles a callable returning the versions of Attributes in the state store snapshot as a tuple
+def compile_versions(attributes):
+    sources = []
+    names = {}
+    for index, attribute in enumerate(attributes):
+        source, attribute_names = attribute.version_source(f"input{index}_")
+        sources.append(source)
+        names.update(attribute_names)
+
+    expression = f"({''.join(f'{source}, ' for source in sources)})"
+    if expression not in version_factories:
+        version_factories[expression] = eval(f"lambda {', '.join(names)}: lambda: {expression}")
+    return version_factories[expression](**names)
+
+
 # A class representing an Automation
 class Automation:
     """
@@ -66,13 +186,38 @@ class Automation:
             A list of Action objects to be executed upon successful condition evaluation
         continuous: bool
             Indicates if the Automation should remain enabled after actions are run. e.g: True->Remain Enabled.
+        trigger_mode: str
+            'level' to report the Automation as triggered on every evaluation its condition is true, or 'rising' to
+            only report it when the condition changes from false to true.
+        dependencies: set
+            Set of the Attribute objects read by the Automation's condition. Populated by build_condition().
+        input_versions: tuple
+            Versions of the dependencies when the condition was last evaluated. None if it has not been evaluated.
+        read_versions: function
+            Returns the current versions of the dependencies, read from the state store snapshot.
+        last_result: bool
+            Result of the last condition evaluation.
+        debounce: float
+            Seconds the condition must stay true before the Automation triggers. 0 triggers immediately.
+        min_interval: float
+            Minimum seconds between two triggers. 0 does not limit the trigger rate.
+        true_since: float
+            Time the condition last changed to true. None while it is false.
+        last_trigger: float
+            Time of the last trigger.
+        fired: bool
+            Whether the Automation triggered since its condition last changed to true. Used by the 'rising' mode.
+        wake: Timer object
+            Timer scheduling the Automation for evaluation once a deferred trigger is due. None if none is deferred.
     Methods
     -------
         evaluate(self): Evaluates the Automation's conditions and runs the actions. Meant to be run by the
             update_state() function in the Entities listed in condition_entities upon them updating their states.
+        trigger(self): Runs the Automation's actions, skipping those that would not change their target Attribute.
     """
 
-    def __init__(self, parent, name, condition, actions, enabled, continuous):
+    def __init__(self, parent, name, condition, actions, enabled, continuous, trigger_mode='level', debounce='',
+                 min_interval=''):
         """
         Creates and returns an Automation object
         :param name: Automation name. e.g: 'open_lights'
@@ -80,6 +225,9 @@ class Automation:
         :param condition: A condition object evaluated to determine if the Automation's actions should be executed
         :param actions: List of Action objects to be executed upon successful condition evaluation
         :param continuous: Boolean variable indicating if the Automation should remain enabled after actions are run
+        :param trigger_mode: 'level' or 'rising'. textX passes an empty string if the model does not set it
+        :param debounce: Duration the condition must stay true before triggering. e.g: '30s'. Empty for none
+        :param min_interval: Minimum duration between two triggers. e.g: '5m'. Empty for none
         """
         # TextX parent attribute. Required to use Automation as a custom class during metamodel instantiation
         self.parent = parent
@@ -94,32 +242,114 @@ class Automation:
         self.continuous = continuous
         # Action function
         self.actions = actions
+        # Trigger on every evaluation the condition is true ('level') or only on false to true transitions ('rising')
+        self.trigger_mode = trigger_mode or 'level'
+        # Attributes read by the condition. Used to only evaluate the Automation when one of them changes
+        self.dependencies = set()
+        # Dependencies in a fixed order, their versions at the last evaluation and the last evaluation's result
+        self.inputs = ()
+        self.input_versions = None
+        self.read_versions = tuple
+        self.last_result = False
+        # Debounce and rate limit, in seconds
+        self.debounce = parse_duration(debounce) if debounce else 0.0
+        self.min_interval = parse_duration(min_interval) if min_interval else 0.0
+        # State of the trigger gate. See ready()
+        self.true_since = None
+        self.last_trigger = float('-inf')
+        self.fired = False
+        self.wake = None
 
     # Evaluate the Automation's conditions and run the actions
-    def evaluate(self):
+    def evaluate(self, result=None):
         """
             Evaluates the Automation's conditions if enabled is True and returns the result and the activation message.
+            The condition is only computed if one of the Attributes it reads changed since the last evaluation.
+            Otherwise the last result is reused. In 'rising' trigger mode the Automation is only triggered when the
+            result changes from false to true. Triggers held back by debounce or min_interval are deferred, see ready().
+        :param result: Condition result already computed by a batch evaluation backend (e.g: VectorEvaluator). None
+            computes it using the compiled condition
         :return: (Boolean showing the evaluation's success, A string message regarding evaluation's status)
         """
-        # Check if condition has been build using build_expression
+        # Check if condition has been build using build_condition
         if self.enabled:
-            if hasattr(self.condition, 'cond_lambda'):
-                # Evaluate condition providing the textX model as global context for evaluation
-                if eval(self.condition.cond_lambda, {'model': self.parent}):
+            if hasattr(self.condition, 'cond_func'):
+                # Use the result of the batch evaluation
+                if result is not None:
+                    # The result was computed without checking input versions
+                    self.input_versions = None
+                    self.last_result = result
+                else:
+                    versions = self.read_versions()
+                    # Evaluate the compiled condition, unless its inputs are unchanged and so is the result
+                    if versions != self.input_versions:
+                        self.last_result = bool(self.condition.cond_func())
+                        self.input_versions = versions
+                if self.ready():
                     return True, f"{self.name}: triggered."
                 else:
                     return False, f"{self.name}: not triggered."
             else:
-                return False, f"{self.name}: condition not built. Please build using build_expression."
+                return False, f"{self.name}: condition not built. Please build using build_condition."
         else:
             return False, f"{self.name}: Automation disabled."
 
+    # Decide whether the Automation triggers on its latest condition result
+    def ready(self):
+        """
+        Returns whether the Automation triggers on its latest condition result. In 'rising' trigger mode it triggers
+        once per period the condition is true. A trigger before the condition has been true for debounce seconds, or
+        within min_interval seconds of the last trigger, is deferred: a timer on the timer wheel schedules the
+        Automation for evaluation when it is due, and it triggers then if the condition is still true.
+        :return: True if the Automation triggers
+        """
+        if not self.last_result:
+            self.true_since = None
+            self.fired = False
+            if self.wake is not None:
+                self.wake.cancel()
+                self.wake = None
+            return False
+        if self.fired and self.trigger_mode == 'rising':
+            return False
+        # Neither debounced nor rate limited
+        if not self.debounce and not self.min_interval:
+            self.fired = True
+            return True
+        now = timers.clock()
+        if self.true_since is None:
+            self.true_since = now
+        due = max(self.true_since + self.debounce, self.last_trigger + self.min_interval)
+        if now < due:
+            # Keep the timer already armed for the same deadline
+            if self.wake is None or self.wake.cancelled or self.wake.deadline != due:
+                if self.wake is not None:
+                    self.wake.cancel()
+                self.wake = timers.schedule(due, self.resume)
+            if metrics.enabled:
+                metrics.deferred_triggers.inc(self.name)
+            return False
+        self.fired = True
+        self.last_trigger = now
+        return True
+
+    # Schedule the Automation for evaluation once a deferred trigger is due
+    def resume(self):
+        self.wake = None
+        # Polling loops evaluate every Automation anyway
+        scheduler = getattr(self.parent, 'scheduler', None)
+        if scheduler is not None:
+            scheduler.schedule((self,))
+
     # Run Automation's actions
     def trigger(self):
         """
-        Runs the Automation's actions.
+        Runs the Automation's actions. Actions setting an Attribute to the value its Entity last reported would not
+        change anything and are skipped, and no message is sent to an Entity whose actions were all skipped.
         :return:
         """
+        # Trigger time, from which the publishing latency is measured if metrics are enabled
+        triggered = time.perf_counter() if metrics.enabled else None
         # If continuous is false, disable automation until it is manually re-enabled
         if not self.continuous:
             self.enabled = False
@@ -133,42 +363,89 @@ class Automation:
                 value = value.to_dict()
             elif type(value) is List:
                 value = value.print_item(value)
+            # Skip actions that would not change the Attribute. Unset Attributes read None and are always sent
+            current = action.attribute.value
+            if type(current) is type(value) and current == value:
+                if metrics.enabled:
+                    metrics.suppressed_actions.inc(self.name)
+                continue
             # If entity of action already in messages, update the message. Else insert it.
             if action.attribute.parent in messages.keys():
                 messages[action.attribute.parent].update({action.attribute.name: value})
             else:
                 messages[action.attribute.parent] = {action.attribute.name: value}
 
+        # If the model has a Dispatcher, hand the messages over to it to be published asynchronously
+        dispatcher = getattr(self.parent, 'dispatcher', None)
+
         # Iterate over Entities and their corresponding messages
         for entity, message in messages.items():
-            # Send message via Entity's publisher
-            entity.publisher.publish(message)
-
-    # Post-Order traversal of Condition tree, generating the condition for each node
-    def process_node_condition(self, cond_node):
+            if dispatcher is not None:
+                dispatcher.submit(entity, message, triggered)
+            else:
+                # Send message via Entity's Broker connection
+                entity.publish(message)
+                if triggered is not None:
+                    metrics.publish_latency.observe(entity.broker.name, time.perf_counter() - triggered)
 
-        # Get the full metamodel
-        metamodel = get_metamodel(self.parent)
+    # Post-Order traversal of Condition tree, lowering it into the condition IR. Each primitive condition node gets a
+    # cond_lambda expression string, used for printing and debugging, and a compiled cond_func callable. Returns the
+    # node's IRNode
+    def process_node_condition(self, cond_node, builder):
 
         # If we are in a ConditionGroup node, recursively visit the left and right sides
-        if textx_isinstance(cond_node, metamodel.namespaces['automation']['ConditionGroup']):
+        if is_condition_group(cond_node):
 
             # Visit left node
-            self.process_node_condition(cond_node.r1)
+            left = self.process_node_condition(cond_node.r1, builder)
             # Visit right node
-            self.process_node_condition(cond_node.r2)
-            # Build lambda
-            cond_node.cond_lambda = (operators[cond_node.operator])(cond_node.r1.cond_lambda, cond_node.r2.cond_lambda)
+            right = self.process_node_condition(cond_node.r2, builder)
+            # Lower the operator
+            return builder.group(cond_node.operator, left, right)
+
+        # Time conditions read the value the timer wheel sets. Start them first, allocating their state store slot
+        elif is_time_condition(cond_node):
+            cond_node.start(self)
+            cond_node.cond_lambda = f"({cond_node.describe()})"
+            cond_node.cond_func = compile_primitive(cond_node.operator, cond_node.operand1, cond_node.operand2)
+            return builder.test(cond_node, [cond_node.operand1])
 
         # If we are in a primitive condition node, form conditions using operands
         else:
+            # Start the Aggregates it compares, allocating their state store slots
+            for operand in (cond_node.operand1, cond_node.operand2):
+                if is_aggregate(operand):
+                    operand.start()
             operand1 = print_operand(cond_node.operand1)
             operand2 = print_operand(cond_node.operand2)
             cond_node.cond_lambda = (operators[cond_node.operator])(operand1, operand2)
+            # Compile
+            cond_node.cond_func = compile_primitive(cond_node.operator, cond_node.operand1, cond_node.operand2)
+
+            # Literal compared to literal: compile_primitive() already computed the result
+            attributes = [operand for operand in (cond_node.operand1, cond_node.operand2) if is_attribute(operand)]
+            if not attributes:
+                return builder.const(cond_node.cond_func())
+            return builder.test(cond_node, attributes)
 
-    # Builds Automation Condition into Python expression string so that it can later be evaluated using eval()
+    # Builds Automation Condition into an optimized IR, printed into a Python expression string and compiled into the
+    # callable used by evaluate()
     def build_condition(self):
-        self.process_node_condition(self.condition)
+        program = self.process_node_condition(self.condition, IRBuilder())
+        self.condition.cond_lambda = format_ir(program)
+        self.condition.cond_func = compile_ir(program)
+        # Attributes read by the optimized condition. Removed branches are not dependencies
+        self.dependencies = read_attributes(program)
+        # Reset the last evaluation in case the condition is rebuilt
+        self.inputs = tuple(self.dependencies)
+        self.read_versions = compile_versions(self.inputs)
+        self.input_versions = None
+        self.last_result = False
+        self.fired = False
+        # Register the Automation to the Attributes it depends on so that their Entities can schedule it for evaluation
+        for attribute in self.dependencies:
+            if self not in attribute.automations:
+                attribute.automations.append(self)
 
 
 # List class for List type
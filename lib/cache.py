@@ -0,0 +1,370 @@
+import glob
+import hashlib
+import logging
+import marshal
+import os
+import sys
+
+from textx import metamodel_from_file
+
+from .automation import Automation, List, Dict, Action, IntAction, FloatAction, StringAction, BoolAction, \
+    is_attribute, is_aggregate, is_condition_group, is_time_condition
+from .aggregates import Aggregate
+from .broker import MQTTBroker, AMQPBroker, RedisBroker, BrokerAuthPlain
+from .entity import Entity, IntAttribute, FloatAttribute, StringAttribute, BoolAttribute, ListAttribute, \
+    DictAttribute
+from .timers import time_condition_classes
+
+# Version of the cached model format. Bump when the format produced by serialize_model() changes
+CACHE_VERSION = 5
+
+# Default directory where cached models are stored
+DEFAULT_CACHE_DIR = 'config/cache'
+
+# Default number of cached models kept. The least recently used ones are removed first
+DEFAULT_CACHE_ENTRIES = 16
+
+# Classes used to restore cached objects, by class name
+broker_classes = {cls.__name__: cls for cls in (MQTTBroker, AMQPBroker, RedisBroker)}
+attribute_classes = {cls.__name__: cls for cls in (IntAttribute, FloatAttribute, StringAttribute, BoolAttribute,
+                                                   ListAttribute, DictAttribute)}
+action_classes = {cls.__name__: cls for cls in (IntAction, FloatAction, StringAction, BoolAction)}
+
+
+# Minimal stand-ins for the textX objects that have no custom class
+class CachedModel:
+    def __init__(self, brokers, entities, automations):
+        self.brokers = brokers
+        self.entities = entities
+        self.automations = automations
+
+
+class ConditionGroup:
+    def __init__(self, parent, r1, operator, r2):
+        self.parent = parent
+        self.r1 = r1
+        self.operator = operator
+        self.r2 = r2
+
+
+class PrimitiveCondition:
+    def __init__(self, parent, operand1, operator, operand2):
+        self.parent = parent
+        self.operand1 = operand1
+        self.operator = operator
+        self.operand2 = operand2
+
+
+class DictItem:
+    def __init__(self, parent, name, value):
+        self.parent = parent
+        self.name = name
+        self.value = value
+
+
+# Returns the cache key of a model: a hash of the cache format, the Python version (marshal's format depends on it),
+# every grammar file next to the top level grammar file and the model source
+def model_key(grammar_path, model_str):
+    digest = hashlib.sha256()
+    digest.update(f"{CACHE_VERSION}:{sys.version}".encode())
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(grammar_path)), '*.tx'))):
+        with open(path, 'rb') as f:
+            digest.update(os.path.basename(path).encode())
+            digest.update(f.read())
+    digest.update(model_str.encode())
+    return digest.hexdigest()
+
+
+# === Serialization to plain data ===
+
+def serialize_literal(node):
+    if type(node) == List:
+        return ('list', [serialize_literal(item) for item in node.items])
+    elif type(node) == Dict:
+        return ('dict', [(item.name, serialize_literal(item.value)) for item in node.items])
+    else:
+        return ('value', node)
+
+
+def serialize_operand(node):
+    if is_aggregate(node):
+        return ('aggregate', node.function, node.attribute.parent.name, node.attribute.name, node.window)
+    if is_attribute(node):
+        return ('attribute', node.parent.name, node.name)
+    return serialize_literal(node)
+
+
+def serialize_condition(node):
+    if is_condition_group(node):
+        return ('group', node.operator, serialize_condition(node.r1), serialize_condition(node.r2))
+    if is_time_condition(node):
+        return ('time', type(node).__name__, node.definition())
+    return ('primitive', node.operator, serialize_operand(node.operand1), serialize_operand(node.operand2))
+
+
+def serialize_attribute(attribute):
+    # NumericAttribute is abstract, so the class name is always one of attribute_classes
+    items = [serialize_attribute(item) for item in attribute.items] if type(attribute) is DictAttribute else []
+    return (type(attribute).__name__, attribute.name, items)
+
+
+def serialize_broker(broker):
+    return {
+        'type': type(broker).__name__,
+        'name': broker.name,
+        'host': broker.host,
+        'port': broker.port,
+        'username': broker.credentials.username,
+        'password': broker.credentials.password,
+        'vhost': getattr(broker, 'vhost', ''),
+        'exchange': getattr(broker, 'exchange', ''),
+        'db': getattr(broker, 'db', 0)
+    }
+
+
+def serialize_model(model):
+    """
+    Converts a parsed model into plain data (dicts, lists, tuples and primitives) that marshal can store.
+    :param model: Model parsed by textX
+    :return: Plain data representation of the model's brokers, entities and automations
+    """
+    return {
+        'brokers': [serialize_broker(broker) for broker in model.brokers],
+        'entities': [{'name': entity.name, 'topic': entity.topic, 'broker': entity.broker.name,
+                      'attributes': [serialize_attribute(attribute) for attribute in entity.attributes]}
+                     for entity in model.entities],
+        'automations': [{'name': automation.name, 'enabled': automation.enabled,
+                         'continuous': automation.continuous, 'trigger_mode': automation.trigger_mode,
+                         'debounce': automation.debounce, 'min_interval': automation.min_interval,
+                         'condition': serialize_condition(automation.condition),
+                         'actions': [(type(action).__name__, action.attribute.parent.name, action.attribute.name,
+                                      serialize_literal(action.value)) for action in automation.actions]}
+                        for automation in model.automations]
+    }
+
+
+# === Restoring from plain data ===
+
+def restore_literal(data, parent=None):
+    kind, value = data
+    if kind == 'list':
+        literal = List(parent, [])
+        literal.items = [restore_literal(item, literal) for item in value]
+        return literal
+    elif kind == 'dict':
+        literal = Dict(parent, [])
+        literal.items = [DictItem(literal, name, restore_literal(item, literal)) for name, item in value]
+        return literal
+    return value
+
+
+def restore_operand(data, entities):
+    if data[0] == 'attribute':
+        return entities[data[1]].attributes_dict[data[2]]
+    if data[0] == 'aggregate':
+        return Aggregate(None, data[1], entities[data[2]].attributes_dict[data[3]], data[4])
+    return restore_literal(data)
+
+
+def restore_condition(data, parent, entities):
+    if data[0] == 'group':
+        node = ConditionGroup(parent, None, data[1], None)
+        node.r1 = restore_condition(data[2], node, entities)
+        node.r2 = restore_condition(data[3], node, entities)
+        return node
+    if data[0] == 'time':
+        return time_condition_classes[data[1]](parent, *data[2])
+    return PrimitiveCondition(parent, restore_operand(data[2], entities), data[1], restore_operand(data[3], entities))
+
+
+def restore_attribute(data):
+    class_name, name, items = data
+    if class_name == 'DictAttribute':
+        attribute = DictAttribute(None, name, [restore_attribute(item) for item in items])
+        for item in attribute.items:
+            item.parent = attribute
+        return attribute
+    return attribute_classes[class_name](None, name)
+
+
+def restore_broker(data):
+    credentials = BrokerAuthPlain(None, data['username'], data['password'])
+    if data['type'] == 'AMQPBroker':
+        return AMQPBroker(None, data['name'], data['host'], data['port'], data['vhost'], credentials,
+                          exchange=data['exchange'])
+    elif data['type'] == 'RedisBroker':
+        return RedisBroker(None, data['name'], data['host'], data['port'], credentials, db=data['db'])
+    return broker_classes[data['type']](None, data['name'], data['host'], data['port'], credentials)
+
+
+def restore_model(data):
+    """
+    Rebuilds a model from the plain data produced by serialize_model(). Entities, Attributes, Brokers, Automations and
+    Actions are instances of the same classes used when parsing with textX, so the runtime can use both alike.
+    :param data: Plain data representation of a model
+    :return: CachedModel object
+    """
+    model = CachedModel([], [], [])
+
+    # Brokers
+    brokers = {}
+    for broker_data in data['brokers']:
+        broker = restore_broker(broker_data)
+        broker.parent = model
+        brokers[broker.name] = broker
+        model.brokers.append(broker)
+
+    # Entities
+    entities = {}
+    for entity_data in data['entities']:
+        attributes = [restore_attribute(attribute) for attribute in entity_data['attributes']]
+        entity = Entity(model, entity_data['name'], entity_data['topic'], brokers[entity_data['broker']], attributes)
+        for attribute in attributes:
+            attribute.parent = entity
+        entities[entity.name] = entity
+        model.entities.append(entity)
+
+    # Automations
+    for automation_data in data['automations']:
+        automation = Automation(model, automation_data['name'], None, [], automation_data['enabled'],
+                                automation_data['continuous'], automation_data['trigger_mode'])
+        # Stored in seconds
+        automation.debounce = automation_data['debounce']
+        automation.min_interval = automation_data['min_interval']
+        automation.condition = restore_condition(automation_data['condition'], automation, entities)
+        for class_name, entity_name, attribute_name, value in automation_data['actions']:
+            action = action_classes.get(class_name, Action)(automation,
+                                                            entities[entity_name].attributes_dict[attribute_name],
+                                                            None)
+            action.value = restore_literal(value, action)
+            automation.actions.append(action)
+        model.automations.append(automation)
+
+    return model
+
+
+# A class loading models through the cache
+class ModelLoader:
+    """
+    The ModelLoader class loads configuration models, skipping textX when possible. The runtime form of each parsed
+    model is stored in a cache directory, keyed by a hash of the grammar files and the model source, and is restored
+    directly when the hash matches. The metamodel is only created, and the model only parsed, on cache misses. Only
+    the max_entries most recently used models are kept, and a cache that cannot be written is skipped, not fatal.
+    Conditions are cached as their definition: their compiled form reads the state store slots of the Entities it is
+    built against, so build_condition() must still be called on restored models.
+    ModelLoader provides model_from_str() and model_from_file() so it can be used in place of a textX metamodel.
+    ...
+
+    Attributes
+    ----------
+        grammar_path: str
+            Path of the top level grammar file. e.g: 'lang/full_metamodel.tx'
+        classes: list
+            Custom classes passed to textX when creating the metamodel
+        cache_dir: str
+            Directory where cached models are stored. None disables caching
+        max_entries: int
+            Number of cached models kept
+        hits: int
+            Number of models restored from the cache
+        misses: int
+            Number of models parsed with textX
+
+    Methods
+    -------
+        metamodel(self): Returns the textX metamodel, creating it on first use.
+        model_from_str(self, model_str): Returns the model of a model source.
+        model_from_file(self, model_path): Returns the model of a model file.
+    """
+
+    def __init__(self, grammar_path, classes, cache_dir=DEFAULT_CACHE_DIR, max_entries=DEFAULT_CACHE_ENTRIES):
+        """
+        Creates and returns a ModelLoader object
+        :param grammar_path: Path of the top level grammar file. e.g: 'lang/full_metamodel.tx'
+        :param classes: Custom classes passed to textX when creating the metamodel
+        :param cache_dir: Directory where cached models are stored. None disables caching
+        :param max_entries: Number of cached models kept
+        """
+        self.grammar_path = grammar_path
+        self.classes = classes
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._metamodel = None
+        self.hits = 0
+        self.misses = 0
+
+    # Create the metamodel on first use
+    def metamodel(self):
+        if self._metamodel is None:
+            self._metamodel = metamodel_from_file(self.grammar_path, classes=self.classes)
+        return self._metamodel
+
+    # Return the path of a cache entry
+    def cache_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.model.cache")
+
+    # Read a cache entry, marking it as recently used
+    def read(self, key):
+        try:
+            with open(self.cache_path(key), 'rb') as f:
+                data = marshal.load(f)
+            os.utime(self.cache_path(key))
+            return data
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    # Write a cache entry atomically, so that concurrent readers never see a partial file
+    def write(self, key, data):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temporary_path = f"{self.cache_path(key)}.{os.getpid()}.tmp"
+            with open(temporary_path, 'wb') as f:
+                marshal.dump(data, f)
+            os.replace(temporary_path, self.cache_path(key))
+            self.evict()
+        except OSError:
+            logging.warning(f"Cannot write the model cache in {self.cache_dir}. Continuing without it", exc_info=True)
+
+    # Remove the least recently used cache entries beyond max_entries
+    def evict(self):
+        entries = glob.glob(os.path.join(self.cache_dir, '*.model.cache'))
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # Load a model from its source
+    def model_from_str(self, model_str):
+        """
+        Returns the model of a model source, restoring it from the cache if the grammar and the model are unchanged
+        and parsing it with textX otherwise.
+        :param model_str: Configuration model source
+        :return: Parsed or restored model
+        """
+        if self.cache_dir is None:
+            return self.metamodel().model_from_str(model_str)
+
+        key = model_key(self.grammar_path, model_str)
+        data = self.read(key)
+        if data is not None:
+            self.hits += 1
+            return restore_model(data)
+
+        self.misses += 1
+        model = self.metamodel().model_from_str(model_str)
+        self.write(key, serialize_model(model))
+        return model
+
+    # Load a model from a file
+    def model_from_file(self, model_path):
+        """
+        Returns the model of a model file. See model_from_str().
+        :param model_path: Path of the configuration model. e.g: 'config/config_local.model'
+        :return: Parsed or restored model
+        """
+        with open(model_path) as f:
+            return self.model_from_str(f.read())
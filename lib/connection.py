@@ -0,0 +1,285 @@
+import threading
+
+from commlib.endpoints import endpoint_factory, EndpointType, TransportType
+
+from .broker import MQTTBroker, AMQPBroker, RedisBroker
+from .transports import subscriber_factory, endpoint_subscriber_factory
+
+# Broker classes and their corresponding TransportType
+broker_tt = {
+    MQTTBroker: TransportType.MQTT,
+    AMQPBroker: TransportType.AMQP,
+    RedisBroker: TransportType.REDIS
+}
+
+# An index of the shared connections of each Broker {broker_key: BrokerConnection}. Populated by get_connection().
+connection_index = {}
+
+# Lock guarding connection_index
+connection_index_lock = threading.Lock()
+
+# Function returning the endpoint class for an EndpointType and TransportType. Replaced using set_endpoint_factory(),
+# e.g: by an in-memory transport when benchmarking
+active_endpoint_factory = endpoint_factory
+
+# Function returning the multi-topic subscriber class of a TransportType. See lib.transports
+active_subscriber_factory = subscriber_factory
+
+
+# Replace the function used to create endpoints
+def set_endpoint_factory(factory):
+    """
+    Replaces the function used by BrokerConnections to create their endpoints. Affects connections started afterwards.
+    :param factory: Function with the signature of commlib-py's endpoint_factory(etype, etransport). None restores
+        commlib-py's endpoint_factory. Subscribers are then made of one pattern subscriber of the factory per topic,
+        see lib.transports.EndpointSubscriber, which suits in-process transports only
+    :return:
+    """
+    global active_endpoint_factory, active_subscriber_factory
+    if factory is None:
+        active_endpoint_factory = endpoint_factory
+        active_subscriber_factory = subscriber_factory
+    else:
+        active_endpoint_factory = factory
+        active_subscriber_factory = endpoint_subscriber_factory(factory)
+
+
+# Returns the key identifying a Broker's connection. Brokers with the same type and connection settings share a
+# connection, so that reloading a model with an unchanged Broker reuses its connection.
+def broker_key(broker):
+    return (type(broker).__name__, broker.host, broker.port, broker.credentials.username,
+            broker.credentials.password, getattr(broker, 'vhost', None), getattr(broker, 'db', None))
+
+
+# A class representing a connection to a Broker shared by all Entities using that Broker
+class BrokerConnection:
+    """
+    The BrokerConnection class multiplexes all Entities of a Broker over a single multi-topic publisher and a single
+    subscriber client subscribed to the topic of every Entity (see lib.transports), instead of opening a subscriber and
+    a publisher per Entity. Received messages are demultiplexed to the Entities by topic.
+    ...
+
+    Attributes
+    ----------
+        broker: Broker object
+            The Broker this connection communicates with
+        entities: dict
+            Dispatch table mapping topics to the Entities communicating on them. e.g: {'kitchen.gas': [kitchen_gas]}
+        subscriber:
+            Multi-topic subscriber receiving the messages of the registered topics over one client. Created by run()
+        topics: set
+            Topics the subscriber is subscribed to
+        publisher:
+            commlib-py multi-topic publisher shared by all registered Entities. Created by run().
+        bridge: callable
+            Optional function used to run message delivery on another thread, called as bridge(function, *args).
+            e.g: loop.call_soon_threadsafe to deliver messages on an asyncio event loop. None delivers on the
+            subscriber's thread.
+
+    Methods
+    -------
+        register(self, entity): Adds an Entity to the dispatch table.
+        unregister(self, entity): Removes an Entity from the dispatch table.
+        run(self, subscribe=True): Creates the publisher and starts the subscriber for the registered topics.
+        stop(self): Stops the subscriber.
+        dispatch(self, data, topic): Subscriber callback passing a received message to deliver(), through the bridge
+            if one is set.
+        deliver(self, data, topic): Passes a received message to the Entities of its topic.
+        publish(self, topic, message): Publishes a message on a topic using the shared publisher.
+    """
+
+    def __init__(self, broker):
+        """
+        Creates and returns a BrokerConnection object
+        :param broker: The Broker this connection communicates with
+        """
+        # Broker
+        self.broker = broker
+        # Dispatch table {topic: [Entities]}
+        self.entities = {}
+        # Shared endpoints. Created by run()
+        self.subscriber = None
+        self.topics = set()
+        self.publisher = None
+        # Optional function running message delivery on another thread
+        self.bridge = None
+
+    # Add an Entity to the dispatch table
+    def register(self, entity):
+        """
+        Adds an Entity to the dispatch table so that it receives the messages of its topic.
+        :param entity: Entity object
+        :return:
+        """
+        self.entities.setdefault(entity.topic, []).append(entity)
+
+    # Remove an Entity from the dispatch table
+    def unregister(self, entity):
+        """
+        Removes an Entity from the dispatch table.
+        :param entity: Entity object
+        :return:
+        """
+        entities = self.entities.get(entity.topic, [])
+        if entity in entities:
+            entities.remove(entity)
+        if not entities:
+            self.entities.pop(entity.topic, None)
+
+    # Create the shared publisher and start the shared subscriber
+    def run(self, subscribe=True):
+        """
+        Creates the shared publisher and starts the shared subscriber, subscribed to all registered topics. A running
+        subscriber is kept, and only subscribes to new topics and unsubscribes from the topics no longer registered.
+        :param subscribe: Whether to start the subscriber. Shard worker processes only publish, since the main process
+            receives the messages and forwards them. See lib.sharding
+        :return:
+        """
+        # Create the shared publisher once
+        if self.publisher is None:
+            self.publisher = active_endpoint_factory(EndpointType.MPublisher, broker_tt[type(self.broker)])(
+                conn_params=self.broker.conn_params
+            )
+
+        # Nothing to subscribe to
+        if not subscribe or not self.entities:
+            return
+
+        # Update the subscriptions of the running subscriber, or start one subscribed to all topics
+        topics = set(self.entities)
+        started = self.subscriber is None
+        if started:
+            self.subscriber = active_subscriber_factory(broker_tt[type(self.broker)])(
+                conn_params=self.broker.conn_params,
+                on_message=self.dispatch
+            )
+        for topic in self.topics - topics:
+            self.subscriber.unsubscribe(topic)
+        for topic in topics - self.topics:
+            self.subscriber.subscribe(topic)
+        self.topics = topics
+        if started:
+            self.subscriber.run()
+
+    # Stop the shared subscriber
+    def stop(self):
+        """
+        Stops the shared subscriber.
+        :return:
+        """
+        if self.subscriber is not None:
+            self.subscriber.stop()
+        self.subscriber = None
+        self.topics = set()
+
+    # Subscriber callback dispatching messages to Entities
+    def dispatch(self, data, topic):
+        """
+        Callback used by the shared subscriber. Delivers the message to the Entities on its topic, through the bridge
+        if one is set.
+        :param data: Dictionary containing the received message
+        :param topic: Topic the message was received on
+        :return:
+        """
+        if self.bridge is not None:
+            self.bridge(self.deliver, data, topic)
+        else:
+            self.deliver(data, topic)
+
+    # Deliver a message to the Entities of its topic
+    def deliver(self, data, topic):
+        """
+        Passes a message to the receive() of all Entities on the message's topic. Messages on topics without
+        Entities, e.g: received right after their Entities were removed by a reload, are ignored.
+        :param data: Dictionary containing the received message, or its raw JSON payload
+        :param topic: Topic the message was received on. MQTT topics are separated by '/' and converted to '.'
+        :return:
+        """
+        for entity in self.entities.get(topic.replace('/', '.'), ()):
+            entity.receive(data)
+
+    # Publish a message on a topic
+    def publish(self, topic, message):
+        """
+        Publishes a message on a topic using the shared publisher.
+        :param topic: Topic to publish on. e.g: 'bedroom.aircondition'
+        :param message: Dictionary containing the message
+        :return:
+        """
+        self.publisher.publish(message, topic)
+
+
+# Return the shared connection of a Broker, creating it if needed
+def get_connection(broker):
+    """
+    Returns the BrokerConnection shared by all Entities of a Broker, creating it on first use.
+    :param broker: Broker object
+    :return: BrokerConnection object
+    """
+    key = broker_key(broker)
+    with connection_index_lock:
+        if key not in connection_index:
+            connection_index[key] = BrokerConnection(broker)
+        return connection_index[key]
+
+
+# Start all shared connections
+def start_connections(bridge=None, subscribe=True):
+    """
+    Starts the shared subscribers and publishers of all Brokers. Meant to be called once the model has been parsed and
+    all Entities have registered, so that each Broker's subscriber connects once with all its topics. Already running
+    subscribers are only updated with the topics that changed.
+    :param bridge: Optional function set as the bridge of every connection before starting it. See BrokerConnection.
+    :param subscribe: Whether to start the subscribers. False only creates the publishers
+    :return:
+    """
+    for connection in list(connection_index.values()):
+        if bridge is not None:
+            connection.bridge = bridge
+        connection.run(subscribe=subscribe)
+
+
+# Number of running endpoints per Broker
+def live_connections():
+    """
+    Returns the number of running endpoints (shared subscriber and publisher) of each Broker connection.
+    :return: Dictionary {broker_name: count}
+    """
+    return {connection.broker.name: (connection.subscriber is not None) + (connection.publisher is not None)
+            for connection in list(connection_index.values())}
+
+
+# Stop and forget connections without Entities
+def prune_connections():
+    """
+    Stops and removes the connections that no longer have any registered Entities, e.g: after a model reload removed
+    all Entities of a Broker.
+    :return:
+    """
+    with connection_index_lock:
+        for key, connection in list(connection_index.items()):
+            if not connection.entities:
+                connection.stop()
+                del connection_index[key]
+
+
+# Stop all shared connections
+def stop_connections():
+    """
+    Stops the shared subscriber of every Broker.
+    :return:
+    """
+    for connection in list(connection_index.values()):
+        connection.stop()
+
+
+# Stop and forget all shared connections
+def clear_connections():
+    """
+    Stops the shared subscribers of all Brokers and empties connection_index, so that Entities parsed afterwards
+    register with new connections.
+    :return:
+    """
+    stop_connections()
+    with connection_index_lock:
+        connection_index.clear()
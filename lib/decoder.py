@@ -0,0 +1,208 @@
+import logging
+
+# ujson is optional. The standard library parser is used if it is not installed
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from .metrics import metrics
+from .state import TYPED
+
+# Marks keys missing from a message
+missing = object()
+
+# Strings accepted as bool values, compared in lower case
+bool_strings = {'true': True, 'false': False, '1': True, '0': False, 'on': True, 'off': False}
+
+
+# Coercions of values whose type differs from the declared type of their Attribute. Each raises ValueError, TypeError
+# or OverflowError when the value cannot be converted without loss, in which case it is stored as received
+def to_int(value):
+    if type(value) is float and value.is_integer():
+        return int(value)
+    if type(value) is str:
+        return int(value)
+    raise TypeError(f"Cannot convert {type(value).__name__} to int")
+
+
+def to_float(value):
+    if type(value) is int or type(value) is str:
+        return float(value)
+    raise TypeError(f"Cannot convert {type(value).__name__} to float")
+
+
+def to_bool(value):
+    if type(value) is int and value in (0, 1):
+        return value == 1
+    if type(value) is str and value.lower() in bool_strings:
+        return bool_strings[value.lower()]
+    raise TypeError(f"Cannot convert {type(value).__name__} to bool")
+
+
+def to_str(value):
+    if type(value) is int or type(value) is float:
+        return str(value)
+    raise TypeError(f"Cannot convert {type(value).__name__} to str")
+
+
+# Coercion per declared value type. Types without one, e.g: lists, are stored as received
+coercions = {int: to_int, float: to_float, bool: to_bool, str: to_str}
+
+# Functions building decode functions, by their source. Filled by PayloadDecoder.compile(). Entities declaring the same
+# keys with the same kinds share one compiled factory
+decoder_factories = {}
+
+
+# A class decoding the messages received by an Entity
+class PayloadDecoder:
+    """
+    The PayloadDecoder class applies the messages received by an Entity to its Attributes. It is built once per Entity
+    from the Attributes declared in the model: a decode function is generated that looks up every declared key, coerces
+    its value to the Attribute's declared type and writes it straight to the Attribute's state store slot. Keys the
+    Entity does not declare are counted and ignored, so a device sending extra fields cannot break ingestion, and only
+    declared fields are ever written. Raw payloads (bytes or str) are parsed with ujson when it is installed.
+    ...
+
+    Attributes
+    ----------
+        entity: Entity object
+            The decoded Entity
+        unknown: int
+            Number of keys received that the Entity does not declare
+        mismatched: int
+            Number of values whose type differed from the declared one and could not be coerced. Values are stored as
+            received, except non dictionary values of Dict Attributes, which are ignored
+
+    Methods
+    -------
+        parse(self, payload): Returns the dictionary of a message, parsing raw payloads.
+        decode(self, message): Applies a message to the Entity's Attributes and returns the changed ones.
+    """
+
+    def __init__(self, entity):
+        """
+        Creates and returns a PayloadDecoder object
+        :param entity: The Entity whose messages are decoded. Its Attributes must have their state store slots
+        """
+        self.entity = entity
+        self.unknown = 0
+        self.mismatched = 0
+        self.decode_fields = self.compile(entity.attributes)
+
+    # Generates the function applying a dictionary to a list of Attributes. It returns the Attributes whose value
+    # changed, after increasing their version in the state store. Dict Attributes are applied by the function generated
+    # for their items
+    def compile(self, attributes):
+        names = {'missing': missing, 'coerce': self.coerce, 'mismatch': self.mismatch, 'ignore': self.ignore,
+                 'declared': frozenset(attribute.name for attribute in attributes)}
+        lines = []
+        for index, attribute in enumerate(attributes):
+            prefix = f"field{index}_"
+            names[f"{prefix}attribute"] = attribute
+            lines += [f"value = get({attribute.name!r}, missing)", "if value is not missing:", "    found += 1"]
+
+            # Dicts have no slot of their own, their items do. The Dict changes if any of its items changed, and its
+            # version is computed from theirs
+            if attribute.kind is None:
+                names[f"{prefix}apply"] = self.compile(attribute.items)
+                lines += ["    if type(value) is dict:", f"        if {prefix}apply(value):",
+                          f"            changed.append({prefix}attribute)",
+                          "    elif value is not None:", "        mismatch()"]
+                continue
+
+            column = attribute.column
+            # Same as Column.touch(), listing the written slot for the next snapshot, without the method call
+            change = [f"{prefix}versions[{prefix}slot] += 1", f"changed.append({prefix}attribute)",
+                      f"if not {prefix}marked[{prefix}slot]:", f"    {prefix}marked[{prefix}slot] = 1",
+                      f"    {prefix}dirty.append({prefix}slot)"]
+            names.update({f"{prefix}data": column.data, f"{prefix}versions": column.versions,
+                          f"{prefix}marked": column.marked, f"{prefix}dirty": column.dirty,
+                          f"{prefix}slot": attribute.slot})
+            if attribute.value_type is not None:
+                names.update({f"{prefix}type": attribute.value_type,
+                              f"{prefix}coerce": coercions[attribute.value_type]})
+                lines += [f"    if type(value) is not {prefix}type and value is not None:",
+                          f"        value = coerce({prefix}coerce, value)"]
+
+            if attribute.kind == 'object':
+                lines += [f"    old = {prefix}data[{prefix}slot]", f"    {prefix}data[{prefix}slot] = value",
+                          "    if type(old) is not type(value) or old != value:"]
+                lines += [f"        {line}" for line in change]
+            else:
+                # Same fast path as TypedColumn.update(), without the method call
+                names.update({f"{prefix}states": column.states, f"{prefix}update": column.update})
+                lines += [f"    if type(value) is {prefix}type and {prefix}states[{prefix}slot] == {TYPED}:",
+                          f"        if {prefix}data[{prefix}slot] != value:",
+                          "            try:",
+                          f"                {prefix}data[{prefix}slot] = value",
+                          "            except OverflowError:",
+                          f"                {prefix}update({prefix}slot, value)"]
+                lines += [f"            {line}" for line in change]
+                lines += [f"    elif {prefix}update({prefix}slot, value):"]
+                lines += [f"        {line}" for line in change]
+
+        body = '\n'.join(f"        {line}" for line in lines)
+        source = f"def decode(message):\n" \
+                 f"        changed = []\n" \
+                 f"        found = 0\n" \
+                 f"        get = message.get\n" \
+                 f"{body}\n" \
+                 f"        if found != len(message):\n" \
+                 f"            ignore(message, declared)\n" \
+                 f"        return changed"
+        if source not in decoder_factories:
+            # The factory takes the names as arguments so that the decode function reads them as closure variables
+            namespace = {}
+            exec(f"def factory({', '.join(names)}):\n    {source}\n    return decode", namespace)
+            decoder_factories[source] = namespace['factory']
+        return decoder_factories[source](**names)
+
+    # Coerce a value, keeping it as received if it cannot be converted
+    def coerce(self, coerce, value):
+        try:
+            return coerce(value)
+        except (ValueError, TypeError, OverflowError):
+            self.mismatch()
+            return value
+
+    # Count a value that could not be coerced
+    def mismatch(self):
+        self.mismatched += 1
+        if metrics.enabled:
+            metrics.mismatched_values.inc(self.entity.name)
+
+    # Count the undeclared keys of a message. The first one received by the Entity is logged
+    def ignore(self, message, declared):
+        for name in message:
+            if name in declared:
+                continue
+            self.unknown += 1
+            if self.unknown == 1:
+                logging.warning(f"Entity {self.entity.name} received undeclared key '{name}'. Undeclared keys are "
+                                f"ignored")
+            if metrics.enabled:
+                metrics.unknown_keys.inc(self.entity.name)
+
+    # Parse a message
+    def parse(self, payload):
+        """
+        Returns the dictionary of a message. Raw payloads are parsed as JSON.
+        :param payload: Dictionary, or JSON object as bytes or str
+        :return: Dictionary containing the message
+        """
+        if isinstance(payload, (bytes, bytearray, str)):
+            payload = json.loads(payload)
+        if type(payload) is not dict:
+            raise ValueError(f"Entity {self.entity.name} received a message that is not a JSON object")
+        return payload
+
+    # Apply a message
+    def decode(self, message):
+        """
+        Applies a parsed message to the Entity's Attributes, coercing values to their declared types and ignoring
+        undeclared keys.
+        :param message: Dictionary containing the message, as returned by parse()
+        :return: List of the top level Attributes whose value changed
+        """
+        return self.decode_fields(message)
@@ -0,0 +1,290 @@
+import time
+import logging
+import threading
+from collections import deque
+
+from .connection import broker_key
+from .events import events
+from .metrics import metrics
+
+# Supported policies for publishing to a full queue
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+
+# A class representing the bounded queue of messages waiting to be published to a Broker
+class BrokerQueue:
+    """
+    The BrokerQueue class is a bounded queue of (Entity, message, trigger time) items waiting to be published to a
+    single Broker, drained by its own worker threads so that a slow Broker only delays its own messages.
+    ...
+
+    Attributes
+    ----------
+        broker: Broker object
+            The Broker the queued messages are published to. Replaced by the latest Broker object with the same
+            connection parameters, e.g: after a model reload
+        maxsize: int
+            Maximum number of queued messages
+        overflow: str
+            Policy used when the queue is full. One of OVERFLOW_POLICIES:
+            'drop_oldest' drops the oldest queued message, 'drop_newest' drops the new message and 'block' waits until
+            a worker frees up space.
+        published: int
+            Number of messages published
+        dropped: int
+            Number of messages dropped due to the overflow policy
+        errors: int
+            Number of messages whose publishing raised an exception
+
+    Methods
+    -------
+        put(self, entity, message, triggered=None): Queues a message applying the overflow policy.
+        get(self): Blocks until a message is queued and returns it.
+        run(self, workers): Starts the worker threads.
+        stop(self): Signals the worker threads to exit.
+    """
+
+    def __init__(self, broker, maxsize, overflow):
+        """
+        Creates and returns a BrokerQueue object
+        :param broker: The Broker the queued messages are published to
+        :param maxsize: Maximum number of queued messages
+        :param overflow: Policy used when the queue is full. One of OVERFLOW_POLICIES
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}'. Use one of {OVERFLOW_POLICIES}")
+        self.broker = broker
+        self.maxsize = maxsize
+        self.overflow = overflow
+        # Queued (Entity, message, trigger time) items
+        self.items = deque()
+        # Condition used by workers to wait for messages and by blocked producers to wait for space
+        self.condition = threading.Condition()
+        # Statistics
+        self.published = 0
+        self.dropped = 0
+        self.errors = 0
+        # Worker threads
+        self.workers = []
+        self.running = False
+
+    # Number of queued messages
+    def __len__(self):
+        return len(self.items)
+
+    # Queue a message
+    def put(self, entity, message, triggered=None):
+        """
+        Queues a message to be published on an Entity's topic, applying the overflow policy if the queue is full.
+        :param entity: Entity to publish the message to
+        :param message: Dictionary containing the message
+        :param triggered: time.perf_counter() time the message's Automation triggered at, used to measure the publishing
+            latency. None if metrics are disabled
+        :return: True if the message was queued, False if it was dropped
+        """
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                if self.overflow == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                elif self.overflow == 'drop_oldest':
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    # Block until a worker frees up space
+                    while len(self.items) >= self.maxsize:
+                        self.condition.wait()
+            self.items.append((entity, message, triggered))
+            self.condition.notify_all()
+            return True
+
+    # Get the next message
+    def get(self):
+        """
+        Blocks until a message is queued and returns it.
+        :return: (Entity, message, trigger time) item, or None if the queue has been stopped
+        """
+        with self.condition:
+            while not self.items and self.running:
+                self.condition.wait()
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            # Wake up producers blocked on a full queue
+            self.condition.notify_all()
+            return item
+
+    # Worker thread loop publishing queued messages
+    def work(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            entity, message, triggered = item
+            start = time.perf_counter() if metrics.enabled else None
+            try:
+                entity.publish(message)
+                self.published += 1
+                if start is not None:
+                    end = time.perf_counter()
+                    metrics.publish_duration.observe(self.broker.name, end - start)
+                    if triggered is not None:
+                        metrics.publish_latency.observe(self.broker.name, end - triggered)
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Publishing to {entity.name} via {self.broker.name} failed", exc_info=True)
+                events.emit('error', 'error', entity=entity.name, broker=self.broker.name, error=repr(e))
+
+    # Start worker threads
+    def run(self, workers=1):
+        """
+        Starts the worker threads draining the queue. With more than one worker, messages to the same Entity may be
+        published out of order.
+        :param workers: Number of worker threads
+        :return:
+        """
+        self.running = True
+        for index in range(workers):
+            worker = threading.Thread(target=self.work, name=f"dispatcher-{self.broker.name}-{index}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    # Stop worker threads
+    def stop(self):
+        """
+        Signals the worker threads to exit once the queued messages have been published.
+        :return:
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+
+# A class dispatching Automation actions to Brokers asynchronously
+class Dispatcher:
+    """
+    The Dispatcher class decouples Automation actions from publishing. Messages submitted during an evaluation cycle
+    are merged per Entity and, when the cycle ends, put into bounded per-Broker queues drained by worker threads. An
+    unreachable Broker then only fills its own queue instead of stalling the evaluation loop.
+    ...
+
+    Attributes
+    ----------
+        maxsize: int
+            Maximum number of queued messages per Broker
+        overflow: str
+            Policy used when a Broker's queue is full. One of OVERFLOW_POLICIES
+        workers: int
+            Number of worker threads per Broker
+        queues: dict
+            Dictionary mapping Broker connection keys to their BrokerQueue objects. Brokers reloaded with the same
+            connection parameters keep their queue. See lib.connection.broker_key()
+        pending: dict
+            Messages submitted during the current evaluation cycle, merged per Entity {entity: message}
+        triggered: dict
+            Time the first Automation submitting each pending message triggered at {entity: time}. Only filled while
+            metrics are enabled
+        coalesced: int
+            Number of submitted messages merged into an earlier message for the same Entity
+
+    Methods
+    -------
+        submit(self, entity, message, triggered=None): Adds a message to the current evaluation cycle.
+        flush(self): Ends the evaluation cycle, queueing the merged messages to their Brokers.
+        queue_depths(self): Returns the number of queued messages per Broker.
+        stats(self): Returns the queue statistics per Broker and the number of coalesced messages.
+        stop(self): Stops all worker threads.
+    """
+
+    def __init__(self, maxsize=1000, overflow='drop_oldest', workers=1):
+        """
+        Creates and returns a Dispatcher object
+        :param maxsize: Maximum number of queued messages per Broker
+        :param overflow: Policy used when a Broker's queue is full. One of OVERFLOW_POLICIES
+        :param workers: Number of worker threads per Broker
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}'. Use one of {OVERFLOW_POLICIES}")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.workers = workers
+        # Per-Broker queues. Created on first use
+        self.queues = {}
+        # Messages of the current evaluation cycle
+        self.pending = {}
+        self.triggered = {}
+        self.coalesced = 0
+        # Lock guarding pending and queues
+        self.lock = threading.Lock()
+
+    # Add a message to the current evaluation cycle
+    def submit(self, entity, message, triggered=None):
+        """
+        Adds a message to the current evaluation cycle. Messages to an Entity that already has a message in the cycle
+        are merged into it, with later values overriding earlier ones.
+        :param entity: Entity to publish the message to
+        :param message: Dictionary containing the message
+        :param triggered: time.perf_counter() time the submitting Automation triggered at. None if metrics are disabled
+        :return:
+        """
+        with self.lock:
+            if triggered is not None:
+                self.triggered.setdefault(entity, triggered)
+            if entity in self.pending:
+                self.pending[entity].update(message)
+                self.coalesced += 1
+            else:
+                self.pending[entity] = dict(message)
+
+    # End the evaluation cycle
+    def flush(self):
+        """
+        Ends the current evaluation cycle by putting the merged message of each Entity into its Broker's queue.
+        :return:
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            triggered, self.triggered = self.triggered, {}
+        for entity, message in pending.items():
+            self.get_queue(entity.broker).put(entity, message, triggered.get(entity))
+
+    # Return the queue of a Broker, creating and starting it if needed
+    def get_queue(self, broker):
+        key = broker_key(broker)
+        with self.lock:
+            if key not in self.queues:
+                broker_queue = BrokerQueue(broker, self.maxsize, self.overflow)
+                broker_queue.run(self.workers)
+                self.queues[key] = broker_queue
+            broker_queue = self.queues[key]
+            broker_queue.broker = broker
+            return broker_queue
+
+    # Number of queued messages per Broker
+    def queue_depths(self):
+        """
+        Returns the number of messages waiting to be published per Broker.
+        :return: Dictionary {broker_name: depth}
+        """
+        return {broker_queue.broker.name: len(broker_queue) for broker_queue in list(self.queues.values())}
+
+    # Queue statistics per Broker
+    def stats(self):
+        """
+        Returns the queue statistics per Broker and the number of coalesced messages.
+        :return: Dictionary {'queues': {broker_name: {'depth': int, 'published': int, 'dropped': int, 'errors': int}},
+            'coalesced': int}
+        """
+        queues = {broker_queue.broker.name: {'depth': len(broker_queue), 'published': broker_queue.published,
+                                             'dropped': broker_queue.dropped, 'errors': broker_queue.errors}
+                  for broker_queue in list(self.queues.values())}
+        return {'queues': queues, 'coalesced': self.coalesced}
+
+    # Stop all worker threads
+    def stop(self):
+        """
+        Stops the worker threads of all Broker queues.
+        :return:
+        """
+        for broker_queue in list(self.queues.values()):
+            broker_queue.stop()
@@ -1,13 +1,35 @@
-from commlib.endpoints import endpoint_factory, EndpointType, TransportType
+import time
+import threading
+import contextlib
 
-from .broker import MQTTBroker, AMQPBroker, RedisBroker
+from .connection import get_connection
+from .decoder import PayloadDecoder
+from .metrics import metrics
+from .state import state_store
 
-# Broker classes and their corresponding TransportType
-broker_tt = {
-    MQTTBroker: TransportType.MQTT,
-    AMQPBroker: TransportType.AMQP,
-    RedisBroker: TransportType.REDIS
-}
+# Whether the Entities and Attributes created by the current thread are left detached. See detached_construction()
+construction = threading.local()
+
+
+# Context manager leaving the Entities and Attributes created inside it detached from the runtime
+@contextlib.contextmanager
+def detached_construction():
+    """
+    Entities created by the calling thread inside the context are not registered with their Broker connection, and
+    their Attributes get no state store slots, until Entity.attach() is called. Used to load a model that replaces
+    parts of a running one, so that loading has no effect on the running model, e.g: if it fails. See lib.reload
+    :return:
+    """
+    construction.detached = True
+    try:
+        yield
+    finally:
+        construction.detached = False
+
+
+# Whether the Entities and Attributes created by the calling thread are left detached
+def constructing_detached():
+    return getattr(construction, 'detached', False)
 
 
 # A class representing an entity communicating via an MQTT broker on a specific topic
@@ -23,16 +45,22 @@ class Entity:
         topic: str
             Topic on which entity communicates. e.g: 'sensors.temp_sensor' corresponds to topic sensors/temp_sensor
         state: dictionary
-            Dictionary from the entity's state JSON. Initial state is a blank dictionary {}
-        subscriber:
-            Communication endpoint built using commlib-py used to subscribe to the Entity's topic
+            Current values of the Entity's Attributes, read from the state store. Unset Attributes are None
+        connection: BrokerConnection object
+            Connection shared by all Entities of the Entity's Broker. Used to receive and publish on the Entity's topic
+        histories: list
+            History objects recording the values of the Entity's Attributes that are aggregated over time windows
 
     Methods
     -------
         add_automation(self, automation): Adds an Automation reference to this Entity. Meant to be called by the
             Automation constructor
-        update_state(self, new_state): Function for updating Entity state. Meant to be used as a callback function by
-            the Entity's subscriber object (commlib-py).
+        receive(self, message): Handles a message received on the Entity's topic. Meant to be used as a callback
+            function by the Entity's shared Broker connection.
+        update_state(self, new_state): Function for updating Entity state.
+        publish(self, message): Publishes a message on the Entity's topic.
+        attach(self): Allocates its Attribute slots and registers the Entity with its connection.
+        detach(self): Unregisters the Entity from its connection and releases its Attribute slots.
 
 
 
@@ -57,9 +85,6 @@ class Entity:
         # MQTT topic for Entity
         self.topic = topic
 
-        # Entity state
-        self.state = {}
-
         # Set Entity's MQTT Broker
         self.broker = broker
 
@@ -69,78 +94,211 @@ class Entity:
         # Attributes Dictionary
         self.attributes_dict = {attribute.name: attribute for attribute in self.attributes}
 
-        # Inspect Attributes and if an attribute is a DictAttribute, create its items dictionary for easy updating
-        for attr_name, attribute in self.attributes_dict.items():
-            if type(attribute) is DictAttribute:
-                attribute.items_dict = {item.name: item for item in attribute.items}
-
-        # Create and start communications subscriber on Entity's topic
-        self.subscriber = endpoint_factory(EndpointType.Subscriber, broker_tt[type(self.broker)])(
-            topic=topic,
-            conn_params=self.broker.conn_params,
-            on_message=self.update_state
-        )
-        self.subscriber.run()
-
-        # Create communications publisher on Entity's topic
-        self.publisher = endpoint_factory(EndpointType.Publisher, broker_tt[type(self.broker)])(
-            topic=topic,
-            conn_params=self.broker.conn_params,
-            # TODO: Remove debug flag
-            debug=True
-        )
-
-    # Callback function for updating Entity state and triggering automations evaluation
-    def update_state(self, new_state):
+        # Decoder of the messages received by the Entity, built once from its declared Attributes by attach()
+        self.decoder = None
+
+        # Recent values of the Attributes read by aggregates. See lib.aggregates
+        self.histories = []
+
+        # Connection shared by all Entities of the Broker. Set by attach()
+        self.connection = None
+        if not constructing_detached():
+            self.attach()
+
+    # Current Attribute values
+    @property
+    def state(self):
+        return {attribute.name: attribute.value for attribute in self.attributes}
+
+    # Callback function for messages received on the Entity's topic
+    def receive(self, message):
         """
-        Function for updating Entity state. Meant to be used as a callback function by the Entity's subscriber object
-        (commlib-py).
-        :param new_state: Dictionary containing the Entity's state
+        Handles a message received on the Entity's topic. Meant to be used as a callback function by the Entity's
+        shared Broker connection. The message is applied with update_state(), or queued for the evaluation loop to
+        apply if the model has an ingestion queue.
+        :param message: Dictionary containing the Entity's state, or the raw JSON payload as bytes or str
         :return:
         """
+        message = self.decoder.parse(message)
 
-        # Update state
-        self.state = new_state
+        # If the model's traffic is being recorded, append the message to the traffic log
+        recorder = getattr(self.parent, 'recorder', None)
+        if recorder is not None:
+            recorder.record(self, message)
 
-        # Update attributes based on state
-        self.update_attributes(self.attributes_dict, new_state)
+        ingestion = getattr(self.parent, 'ingestion', None)
+        if ingestion is not None:
+            ingestion.put(self, message)
+        else:
+            self.update_state(message)
 
-    # Recursive function used by update_state() mainly to updated dictionaries/objects and normal Attributes
-    @staticmethod
-    def update_attributes(root, state_dict):
-        # Update attributes
-        for attribute, value in state_dict.items():
+    # Function for updating Entity state and triggering automations evaluation
+    def update_state(self, new_state):
+        """
+        Function for updating Entity state. Called by receive(), or by the model's ingestion queue when it is drained.
+        :param new_state: Dictionary containing the Entity's state, or the raw JSON payload as bytes or str
+        :return:
+        """
+        # Time the update if metrics are enabled
+        start = time.perf_counter() if metrics.enabled else None
+
+        # Parse raw payloads
+        new_state = self.decoder.parse(new_state)
+
+        # Update the declared Attributes, coercing values to their declared types. Evaluation cycles wait for the
+        # update to complete before taking their snapshot of the state store, so they never see half of a message
+        writer = state_store.begin()
+        try:
+            changed = self.decoder.decode(new_state)
+            # Append the received values to the histories of aggregated Attributes, updating their aggregates
+            for history in self.histories:
+                changed += history.record(new_state)
+        finally:
+            state_store.end(writer)
+
+        # If the model runs in event-driven mode, schedule the Automations that read the changed Attributes
+        scheduler = getattr(self.parent, 'scheduler', None)
+        if scheduler is not None:
+            scheduler.schedule(automation for attribute in changed for automation in attribute.automations)
+
+        # If the model's Automations run in shard worker processes, forward the message to the ones reading the Entity.
+        # Messages that changed nothing still reach the workers aggregating the Entity's Attributes
+        router = getattr(self.parent, 'router', None)
+        if router is not None:
+            router.route(self, new_state, bool(changed))
+
+        # Record the ingested message
+        if start is not None:
+            metrics.messages.inc(self.name)
+            metrics.update_state_duration.observe(self.name, time.perf_counter() - start)
+
+    # Publish a message on the Entity's topic
+    def publish(self, message):
+        """
+        Publishes a message on the Entity's topic using the Broker's shared connection.
+        :param message: Dictionary containing the message. e.g: {'on': True}
+        :return:
+        """
+        self.connection.publish(self.topic, message)
 
-            # If value is a dictionary, also update the Dict's subattributes/items
-            if type(value) is dict:
-                Entity.update_attributes(root[attribute].value, value)
-            else:
-                root[attribute].value = value
+    # Add the Entity to the runtime
+    def attach(self):
+        """
+        Allocates the state store slots of the Entity's Attributes, builds its decoder and registers it with the
+        connection shared by all Entities of its Broker. Once started, the connection's subscriber passes the messages
+        received on the Entity's topic to receive(). Called on creation, unless created detached, e.g: by a model
+        reload, which attaches the Entities it adds when applying them. See detached_construction()
+        :return:
+        """
+        for attribute in self.attributes:
+            attribute.allocate()
+        self.decoder = PayloadDecoder(self)
+        self.connection = get_connection(self.broker)
+        self.connection.register(self)
+
+    # Remove the Entity from the runtime
+    def detach(self):
+        """
+        Unregisters the Entity from its Broker connection and releases the state store slots of its Attributes, e.g:
+        when a model reload removes or replaces it. Detaching an Entity that was never attached does nothing.
+        :return:
+        """
+        if self.connection is None:
+            return
+        self.connection.unregister(self)
+        # Drop a message still waiting in the model's ingestion queue
+        ingestion = getattr(self.parent, 'ingestion', None)
+        if ingestion is not None:
+            ingestion.discard(self)
+        for attribute in self.attributes:
+            attribute.release()
 
 
 class Attribute:
+    # Column of the state store holding the Attribute's value
+    kind = 'object'
+    # Type received values are coerced to by the Entity's PayloadDecoder. None stores values as received
+    value_type = None
+
     def __init__(self, parent, name, value=None):
         self.parent = parent
         self.name = name
-        self.value = value
+        # The value is stored in a fixed slot of the state store. Set by allocate()
+        self.column = self.slot = None
+        if self.kind is not None and not constructing_detached():
+            self.allocate(value)
+        # Automations whose conditions read this Attribute. Populated by Automation.build_condition()
+        self.automations = []
+
+    # Allocate the Attribute's slot in the state store
+    def allocate(self, value=None):
+        if self.kind is not None and self.column is None:
+            self.column, self.slot = state_store.allocate(self.kind)
+            self.value = value
+
+    # Latest value. Conditions read the value in the state store snapshot instead
+    @property
+    def value(self):
+        return self.column.read(self.slot)
+
+    @value.setter
+    def value(self, value):
+        self.column.write(self.slot, value)
+
+    # Version in the state store snapshot. Increased every time the value changes. Lets Automations skip evaluation
+    # when none of their inputs changed
+    @property
+    def version(self):
+        return self.column.snapshot_versions[self.slot]
+
+    # Returns a Python expression reading the Attribute's version in the state store snapshot and the values of the
+    # names it uses. Used to compile the version checks of Automations
+    def version_source(self, prefix):
+        return f"{prefix}versions[{prefix}slot]", {f"{prefix}versions": self.column.snapshot_versions,
+                                                   f"{prefix}slot": self.slot}
+
+    # Returns a function returning the Attribute's value
+    def reader(self):
+        return self.column.reader(self.slot)
+
+    # Returns a Python expression reading the Attribute's value and the values of the names it uses. Used by compiled
+    # conditions. See TypedColumn.read_source()
+    def read_source(self, prefix):
+        return self.column.read_source(self.slot, prefix)
+
+    # Release the Attribute's slot in the state store
+    def release(self):
+        if self.column is not None:
+            self.column.release(self.slot)
 
 
 class IntAttribute(Attribute):
+    kind = 'int'
+    value_type = int
+
     def __init__(self, parent, name):
         super().__init__(parent, name)
 
 
 class FloatAttribute(Attribute):
+    kind = 'float'
+    value_type = float
+
     def __init__(self, parent, name):
         super().__init__(parent, name)
 
 
 class StringAttribute(Attribute):
+    value_type = str
+
     def __init__(self, parent, name):
         super().__init__(parent, name)
 
 
 class BoolAttribute(Attribute):
+    kind = 'bool'
+    value_type = bool
+
     def __init__(self, parent, name):
         super().__init__(parent, name)
 
@@ -151,8 +309,44 @@ class ListAttribute(Attribute):
 
 
 class DictAttribute(Attribute):
+    # A Dict has no slot of its own, its items do
+    kind = None
+
     def __init__(self, parent, name, items):
-        # Create dictionary structure from items
-        value = {item.name: item for item in items}
-        super().__init__(parent, name, value=value)
+        super().__init__(parent, name)
         self.items = items
+        # Items dictionary for easy updating
+        self.items_dict = {item.name: item for item in items}
+
+    # The value of a Dict is a dictionary of the values of its items
+    @property
+    def value(self):
+        return {name: item.value for name, item in self.items_dict.items()}
+
+    # A Dict changes when any of its items does
+    @property
+    def version(self):
+        return sum(item.version for item in self.items)
+
+    def reader(self):
+        readers = [(name, item.reader()) for name, item in self.items_dict.items()]
+        return lambda: {name: read() for name, read in readers}
+
+    def read_source(self, prefix):
+        return f"{prefix}read()", {f"{prefix}read": self.reader()}
+
+    def version_source(self, prefix):
+        sources, names = [], {}
+        for index, item in enumerate(self.items):
+            source, item_names = item.version_source(f"{prefix}{index}_")
+            sources.append(source)
+            names.update(item_names)
+        return f"({' + '.join(sources) or '0'})", names
+
+    def allocate(self, value=None):
+        for item in self.items:
+            item.allocate()
+
+    def release(self):
+        for item in self.items:
+            item.release()
@@ -0,0 +1,311 @@
+import sys
+import json
+import time
+import atexit
+import random
+import socket
+import logging
+import threading
+from collections import deque
+from urllib.parse import urlparse
+
+from colorama import Fore, Style
+
+# Event levels, ordered by severity
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+# Colors of console lines per event kind
+console_colors = {'trigger': Fore.MAGENTA, 'error': Fore.RED}
+
+
+# Returns the console line of an event. e.g: '12:00:01 trigger gasAlert'
+def format_console(event):
+    fields = ' '.join(f"{name}={value}" for name, value in event.items()
+                      if name not in ('time', 'kind', 'level', 'automation'))
+    line = f"{time.strftime('%H:%M:%S', time.localtime(event['time']))} {event['kind']} " \
+           f"{event.get('automation', '')} {fields}".rstrip()
+    color = console_colors.get(event['kind'])
+    return f"{color}{line}{Style.RESET_ALL}\n" if color is not None else f"{line}\n"
+
+
+# A class writing batches of events to their destination
+class EventSink:
+    """
+    The EventSink class writes batches of events to the console, to a file or to a socket. The console receives text
+    lines, files and sockets receive JSON lines.
+    ...
+
+    Attributes
+    ----------
+        target: str
+            "stdout", a "tcp://host:port" or "udp://host:port" address, or a file path
+
+    Methods
+    -------
+        write(self, batch): Writes a list of events.
+        close(self): Closes the file or socket.
+    """
+
+    def __init__(self, target):
+        """
+        Creates and returns an EventSink object. Files are opened for appending, sockets are connected on first write
+        :param target: "stdout", "tcp://host:port", "udp://host:port" or a file path
+        """
+        self.target = target
+        self.address = urlparse(target) if target.startswith(('tcp://', 'udp://')) else None
+        self.file = None
+        self.socket = None
+        if self.address is None and target != "stdout":
+            self.file = open(target, 'a')
+
+    # Write a batch of events
+    def write(self, batch):
+        """
+        Writes a list of events with a single write call.
+        :param batch: List of event dictionaries
+        :return:
+        """
+        if self.target == "stdout":
+            sys.stdout.write(''.join(format_console(event) for event in batch))
+            sys.stdout.flush()
+            return
+        data = ''.join(json.dumps(event, default=str) + '\n' for event in batch)
+        if self.file is not None:
+            self.file.write(data)
+            self.file.flush()
+        elif self.address.scheme == 'udp':
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # One datagram per event, so that each stays a complete JSON document
+            for line in data.splitlines(keepends=True):
+                self.socket.sendto(line.encode(), (self.address.hostname, self.address.port))
+        else:
+            if self.socket is None:
+                self.socket = socket.create_connection((self.address.hostname, self.address.port), timeout=5)
+            try:
+                self.socket.sendall(data.encode())
+            except OSError:
+                # Reconnect on the next batch
+                self.socket.close()
+                self.socket = None
+                raise
+
+    # Close the file or socket
+    def close(self):
+        """
+        Closes the file or socket.
+        :return:
+        """
+        if self.file is not None:
+            self.file.close()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+# A class recording runtime events
+class EventLog:
+    """
+    The EventLog class records structured runtime events (Automation triggers, changes of condition results, errors)
+    instead of printing every evaluation. Events are dictionaries with a time, a kind, a level and the fields given by
+    the emitter. Each recorded event is kept in a ring buffer of the most recent events, which recent() queries, and
+    queued for a background thread that writes them in batches to an EventSink. Events below the minimum level are
+    skipped with a single comparison, and the events of chatty kinds can be sampled.
+    ...
+
+    Attributes
+    ----------
+        level: int
+            Minimum level of recorded events. See LEVELS
+        sample_rates: dict
+            Fraction of the events of each kind that are recorded {kind: rate}. Kinds not listed are all recorded
+        buffer: deque
+            The most recent events
+        outbox: deque
+            Events waiting to be written. Bounded, so a stalled sink cannot grow it without limit
+        sink: EventSink object
+            Destination of the written events. None only keeps the ring buffer
+        emitted: int
+            Number of recorded events
+        written: int
+            Number of events written to the sink
+        dropped: int
+            Number of events dropped because the outbox was full or the sink failed
+
+    Methods
+    -------
+        emit(self, kind, level='info', **fields): Records an event.
+        recent(self, count=100, kind=None, level=None, **match): Returns the most recent events.
+        start(self, target, interval=1.0): Starts writing events to a sink.
+        flush(self): Writes the queued events.
+        stop(self): Stops the writer after writing the queued events.
+        stats(self): Returns the event log statistics.
+    """
+
+    def __init__(self, capacity=10000, level='info', sample_rates=None, batch_size=500, max_pending=100000):
+        """
+        Creates and returns an EventLog object. Events are only written once start() is called
+        :param capacity: Number of recent events kept in the ring buffer
+        :param level: Minimum level of recorded events. One of LEVELS
+        :param sample_rates: Fraction of the events of each kind that are recorded {kind: rate}
+        :param batch_size: Number of queued events that wakes the writer before its interval elapses
+        :param max_pending: Maximum number of events waiting to be written
+        """
+        self.level = LEVELS[level]
+        self.sample_rates = dict(sample_rates or {})
+        self.batch_size = batch_size
+        self.buffer = deque(maxlen=capacity)
+        self.outbox = deque()
+        self.max_pending = max_pending
+        self.sink = None
+        self.interval = 1.0
+        self.emitted = 0
+        self.written = 0
+        self.dropped = 0
+        # Set to wake the writer, e.g: when a full batch is queued
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        # Serializes writes to the sink between the writer thread and flush()
+        self.lock = threading.Lock()
+
+    # Record an event
+    def emit(self, kind, level='info', **fields):
+        """
+        Records an event if its level is enabled and it is sampled.
+        :param kind: Event kind. e.g: 'trigger', 'change', 'error'
+        :param level: Event level. One of LEVELS
+        :param fields: Fields of the event. e.g: automation='gasAlert'
+        :return:
+        """
+        if LEVELS[level] < self.level:
+            return
+        rate = self.sample_rates.get(kind)
+        if rate is not None and random.random() >= rate:
+            return
+        event = {'time': time.time(), 'kind': kind, 'level': level}
+        event.update(fields)
+        self.emitted += 1
+        self.buffer.append(event)
+        if self.sink is None:
+            return
+        if len(self.outbox) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.outbox.append(event)
+        if len(self.outbox) >= self.batch_size:
+            self.wake.set()
+
+    # Query the ring buffer
+    def recent(self, count=100, kind=None, level=None, **match):
+        """
+        Returns the most recent events, oldest first, optionally filtered.
+        :param count: Maximum number of events returned
+        :param kind: Only return events of this kind
+        :param level: Only return events of this level or higher. One of LEVELS
+        :param match: Only return events with these field values. e.g: automation='gasAlert'
+        :return: List of event dictionaries
+        """
+        minimum = LEVELS[level] if level is not None else 0
+        selected = []
+        for event in reversed(list(self.buffer)):
+            if len(selected) >= count:
+                break
+            if kind is not None and event['kind'] != kind or LEVELS[event['level']] < minimum:
+                continue
+            if all(str(event.get(name)) == str(value) for name, value in match.items()):
+                selected.append(event)
+        selected.reverse()
+        return selected
+
+    # Start the writer
+    def start(self, target, interval=1.0):
+        """
+        Starts writing the recorded events to a sink from a background thread. Queued events are written on exit.
+        :param target: "stdout", "tcp://host:port", "udp://host:port" or a file path
+        :param interval: Maximum seconds between batched writes
+        :return:
+        """
+        self.sink = EventSink(target)
+        self.interval = interval
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="event-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    # Thread loop writing batches
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    # Write the queued events
+    def flush(self):
+        """
+        Writes the queued events to the sink in one batch. Events the sink fails to write are dropped.
+        :return:
+        """
+        with self.lock:
+            if self.sink is None:
+                return
+            batch = []
+            while self.outbox:
+                batch.append(self.outbox.popleft())
+            if not batch:
+                return
+            try:
+                self.sink.write(batch)
+                self.written += len(batch)
+            except OSError:
+                self.dropped += len(batch)
+                logging.error(f"Writing {len(batch)} events to {self.sink.target} failed", exc_info=True)
+
+    # Stop the writer
+    def stop(self):
+        """
+        Stops the writer thread, writes the queued events and closes the sink.
+        :return:
+        """
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.wake.set()
+        self.thread.join()
+        self.thread = None
+        self.flush()
+        with self.lock:
+            self.sink.close()
+            self.sink = None
+
+    # Event log statistics
+    def stats(self):
+        """
+        Returns the event log statistics.
+        :return: Dictionary {'buffered': int, 'pending': int, 'emitted': int, 'written': int, 'dropped': int}
+        """
+        return {'buffered': len(self.buffer), 'pending': len(self.outbox), 'emitted': self.emitted,
+                'written': self.written, 'dropped': self.dropped}
+
+
+# The event log of the running process. Keeps the ring buffer only, unless started with start_event_log()
+events = EventLog()
+
+
+# Configure and start the event log of the running process
+def start_event_log(target, level='info', sample_rates=None, capacity=10000, interval=1.0):
+    """
+    Configures the event log of the running process and starts writing it to a sink. See EventLog.
+    :param target: "stdout", "tcp://host:port", "udp://host:port" or a file path. None only keeps the ring buffer
+    :param level: Minimum level of recorded events. One of LEVELS
+    :param sample_rates: Fraction of the events of each kind that are recorded {kind: rate}
+    :param capacity: Number of recent events kept in the ring buffer
+    :param interval: Maximum seconds between batched writes
+    :return: The event log
+    """
+    events.level = LEVELS[level]
+    events.sample_rates = dict(sample_rates or {})
+    events.buffer = deque(events.buffer, maxlen=capacity)
+    if target is not None:
+        events.start(target, interval)
+    return events
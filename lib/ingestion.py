@@ -0,0 +1,185 @@
+import logging
+import threading
+
+from .dispatcher import OVERFLOW_POLICIES
+from .events import events
+from .metrics import metrics
+
+
+# Merges a message into the pending message of an Entity, in place. Values of nested dictionaries (e.g: Dict
+# Attributes) are merged key by key too, so that partial updates of their items are kept
+def merge_message(pending, message):
+    for name, value in message.items():
+        old = pending.get(name)
+        if type(value) is dict and type(old) is dict:
+            merged = dict(old)
+            merge_message(merged, value)
+            pending[name] = merged
+        else:
+            pending[name] = value
+
+
+# A class decoupling message reception from state updates
+class IngestionQueue:
+    """
+    The IngestionQueue class decouples Broker callbacks from Entity state updates. Callbacks only queue the received
+    message and the evaluation loop applies the queued messages with Entity.update_state() in one batch at the start of
+    each cycle. Every Entity holds at most one pending message: a newer message is merged into it key by key, which
+    applies the same values as applying both messages in turn, or replaces it ("latest value wins") if merge is unset.
+    A sensor publishing far faster than Automations are evaluated then costs one state update per cycle. The number of Entities with a pending message is bounded, so bursts cannot grow
+    the queue without limit.
+    ...
+
+    Attributes
+    ----------
+        maxsize: int
+            Maximum number of Entities with a pending message
+        overflow: str
+            Policy used when a message for another Entity arrives while the queue is full. One of OVERFLOW_POLICIES:
+            'drop_oldest' drops the oldest pending message, 'drop_newest' drops the new message and 'block' makes the
+            Broker callback wait until the queue is drained.
+        merge: bool
+            Whether a new message is merged into the Entity's pending message instead of replacing it
+        notify: callable
+            Optional function called without arguments when a message is queued into an empty queue, e.g: to wake up
+            an event-driven evaluation loop
+        pending: dict
+            Pending message of each Entity, oldest first {entity: message}
+        received: int
+            Number of messages queued
+        coalesced: int
+            Number of messages that replaced or were merged into a pending message
+        dropped: int
+            Number of messages dropped due to the overflow policy
+        applied: int
+            Number of pending messages applied to their Entity
+        errors: int
+            Number of pending messages whose Entity failed to apply them
+        batches: int
+            Number of drained batches
+
+    Methods
+    -------
+        put(self, entity, message): Queues a message received by an Entity.
+        discard(self, entity): Drops the pending message of an Entity.
+        drain(self): Applies the pending messages to their Entities.
+        stats(self): Returns the queue statistics.
+    """
+
+    def __init__(self, maxsize=10000, overflow='drop_oldest', merge=True, notify=None):
+        """
+        Creates and returns an IngestionQueue object
+        :param maxsize: Maximum number of Entities with a pending message
+        :param overflow: Policy used when the queue is full. One of OVERFLOW_POLICIES
+        :param merge: Whether to merge a new message into the Entity's pending message. False replaces it
+        :param notify: Optional function called when a message is queued into an empty queue
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}'. Use one of {OVERFLOW_POLICIES}")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.merge = merge
+        self.notify = notify
+        self.pending = {}
+        # Condition guarding pending, also used by blocked Broker callbacks to wait for the queue to be drained
+        self.condition = threading.Condition()
+        # Statistics
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.applied = 0
+        self.errors = 0
+        self.batches = 0
+
+    # Number of Entities with a pending message
+    def __len__(self):
+        return len(self.pending)
+
+    # Queue a message
+    def put(self, entity, message):
+        """
+        Queues a message received by an Entity, replacing or merging into its pending message. Meant to be called by
+        Entity.receive() on the Broker's subscriber thread.
+        :param entity: The Entity receiving the message
+        :param message: Dictionary containing the message
+        :return: True if the message was queued, False if it was dropped
+        """
+        with self.condition:
+            self.received += 1
+            pending = self.pending.get(entity)
+            if pending is not None:
+                if self.merge:
+                    merge_message(pending, message)
+                else:
+                    self.pending[entity] = message
+                self.coalesced += 1
+                if metrics.enabled:
+                    metrics.ingest_coalesced.inc(entity.name)
+                return True
+
+            if len(self.pending) >= self.maxsize:
+                if self.overflow == 'drop_newest':
+                    self.drop(entity)
+                    return False
+                elif self.overflow == 'drop_oldest':
+                    self.drop(self.pending.pop(next(iter(self.pending))))
+                else:
+                    # Block until the evaluation loop drains the queue
+                    while len(self.pending) >= self.maxsize:
+                        self.condition.wait()
+            # The queue owns merged messages, so copy the first one
+            self.pending[entity] = dict(message) if self.merge else message
+            wake = len(self.pending) == 1
+        if wake and self.notify is not None:
+            self.notify()
+        return True
+
+    # Count a dropped message
+    def drop(self, entity):
+        self.dropped += 1
+        if metrics.enabled:
+            metrics.ingest_dropped.inc(entity.name)
+
+    # Drop the pending message of an Entity
+    def discard(self, entity):
+        """
+        Drops the pending message of an Entity, e.g: when a model reload removes it.
+        :param entity: The Entity
+        :return:
+        """
+        with self.condition:
+            self.pending.pop(entity, None)
+
+    # Apply the pending messages
+    def drain(self):
+        """
+        Applies the pending messages to their Entities, oldest first, and wakes up blocked Broker callbacks. Messages
+        an Entity fails to apply are logged and counted. Meant to be called by the evaluation loop at the start of each
+        cycle.
+        :return: Number of applied messages
+        """
+        with self.condition:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            self.condition.notify_all()
+        for entity, message in batch.items():
+            try:
+                entity.update_state(message)
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Entity {entity.name} could not apply a queued message", exc_info=True)
+                events.emit('error', 'error', entity=entity.name, error=repr(e))
+        self.applied += len(batch)
+        self.batches += 1
+        return len(batch)
+
+    # Queue statistics
+    def stats(self):
+        """
+        Returns the queue statistics.
+        :return: Dictionary {'pending': int, 'received': int, 'coalesced': int, 'dropped': int, 'applied': int,
+            'errors': int, 'batches': int}
+        """
+        return {'pending': len(self.pending), 'received': self.received, 'coalesced': self.coalesced,
+                'dropped': self.dropped, 'applied': self.applied, 'errors': self.errors, 'batches': self.batches}
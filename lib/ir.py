@@ -0,0 +1,375 @@
+# Intermediate representation (IR) of Automation conditions. Condition trees are lowered into a DAG of IRNodes where
+# identical subexpressions are a single node, optimized, printed and compiled. Printing and evaluating the IR takes time
+# linear in its size, unlike expanding operators whose expression repeats their operands (e.g: XNOR).
+
+# Primitive condition operators that always produce bools. Boolean primitive conditions (e.g: lights.on AND true)
+# apply and/or/^ to Attribute values as they are, so they may produce other values
+boolean_operators = ('~', '!~', '==', '!=', '>', '<', 'NOT', 'NOR', 'NAND')
+
+# Primitive condition operators that never raise, whatever the Attribute values
+safe_operators = ('==', '!=', 'AND', 'OR', 'NOT', 'NOR', 'NAND', 'XNOR')
+
+# Functions applying IR operations to evaluated operand values. 'xnor' is the expression used for XNOR by lib.automation
+ir_functions = {
+    'and': lambda left, right: left and right,
+    'or': lambda left, right: left or right,
+    'xor': lambda left, right: left ^ right,
+    'is not': lambda left, right: left is not right,
+    'xnor': lambda left, right: (left or right) and (not left or not right),
+    'not': lambda operand: not operand
+}
+
+# Lambdas used to print IR operations. Same format as the expression strings of lib.automation
+ir_formats = {
+    'and': lambda left, right: f"({left} and {right})",
+    'or': lambda left, right: f"({left} or {right})",
+    'xor': lambda left, right: f"({left} ^ {right})",
+    'is not': lambda left, right: f"({left} is not {right})",
+    'xnor': lambda left, right: f"(({left} or {right}) and (not {left} or not {right}))",
+    'not': lambda operand: f"(not {operand})"
+}
+
+# Lambdas combining compiled IR operands into a callable. and/or short-circuit their right side like Python, the other
+# operations evaluate each operand once, left first
+ir_compilers = {
+    'and': lambda left, right: lambda: left() and right(),
+    'or': lambda left, right: lambda: left() or right(),
+    'xor': lambda left, right: lambda: left() ^ right(),
+    'is not': lambda left, right: lambda: left() is not right(),
+    'not': lambda operand: lambda: not operand()
+}
+
+# Lambdas compiling negated and/or nodes (NOR, NAND) into a single callable
+negated_compilers = {
+    'and': lambda left, right: lambda: not (left() and right()),
+    'or': lambda left, right: lambda: not (left() or right())
+}
+
+# Operations whose printed expression repeats their operands
+repeating_operations = ('xnor',)
+
+# Maximum ratio between the lengths of a condition's expression printed on a single line and printed with its shared
+# operations bound to names. Longer single line expressions are printed with names instead. See format_ir()
+INLINE_LIMIT = 2
+
+
+# A node of the condition IR
+class IRNode:
+    """
+    The IRNode class represents an operation of a condition's IR. Nodes are created through an IRBuilder, which shares
+    identical nodes, so a condition's IR is a DAG.
+    ...
+
+    Attributes
+    ----------
+        op: str
+            One of 'const', 'test', 'and', 'or', 'xor', 'is not', 'xnor', 'not'
+        args: tuple
+            Operand IRNodes of operations
+        value:
+            The value of a 'const' node, or the primitive condition of a 'test' node
+        attributes: tuple
+            Attributes read by a 'test' node
+        boolean: bool
+            Whether the node's value is always a bool. Boolean simplifications only apply to such nodes
+        safe: bool
+            Whether evaluating the node can never raise an exception. Unsafe nodes are never removed by the optimizer,
+            so that optimized conditions raise the same errors
+    """
+
+    def __init__(self, op, args=(), value=None, attributes=()):
+        self.op = op
+        self.args = args
+        self.value = value
+        self.attributes = attributes
+        if op == 'const':
+            self.boolean = type(value) is bool
+            self.safe = True
+        elif op == 'test':
+            self.boolean = value.operator in boolean_operators
+            self.safe = value.operator in safe_operators
+        else:
+            self.boolean = op in ('is not', 'not') or all(arg.boolean for arg in args)
+            # ^ raises on e.g: str operands
+            self.safe = all(arg.safe for arg in args) and (op != 'xor' or self.boolean)
+
+
+# A class creating IR nodes, sharing identical ones
+class IRBuilder:
+    """
+    The IRBuilder class creates the IRNodes of conditions. Nodes are hashed by operation, operands and value, so
+    building a node identical to an existing one returns the existing node. Operations are optimized as they are
+    built, so a condition's IR is optimized bottom-up in a single pass: constant folding, boolean simplification and
+    dead branch removal. Nodes that may raise an exception are never removed unless Python's short-circuiting would
+    skip them too.
+    ...
+
+    Attributes
+    ----------
+        nodes: dict
+            Created nodes by key
+        optimize: bool
+            Whether operations are optimized
+
+    Methods
+    -------
+        const(self, value): Returns a constant node.
+        test(self, condition, attributes): Returns a primitive condition node.
+        operation(self, op, *args): Returns an operation node.
+        group(self, operator, left, right): Returns the nodes of a ConditionGroup operator.
+    """
+
+    def __init__(self, optimize=True):
+        """
+        Creates and returns an IRBuilder object
+        :param optimize: Whether operations are optimized. Unoptimized IR prints conditions as written
+        """
+        self.nodes = {}
+        self.optimize = optimize
+
+    # Return the node with the given key, creating it if needed
+    def node(self, key, op, args=(), value=None, attributes=()):
+        if key not in self.nodes:
+            self.nodes[key] = IRNode(op, args, value, attributes)
+        return self.nodes[key]
+
+    # Constant node. Types are part of the key, since e.g: 1 == True
+    def const(self, value):
+        return self.node(('const', type(value).__name__, value), 'const', value=value)
+
+    # Primitive condition node. Primitive conditions are identified by their expression string
+    def test(self, condition, attributes=()):
+        """
+        Returns the node of a primitive condition.
+        :param condition: Primitive condition. Must have a cond_lambda expression string and a compiled cond_func
+        :param attributes: Attributes read by the condition
+        :return: IRNode
+        """
+        return self.node(('test', condition.cond_lambda), 'test', value=condition, attributes=tuple(attributes))
+
+    # Operation node, without optimizing it
+    def raw_operation(self, op, *args):
+        return self.node((op,) + tuple(id(arg) for arg in args), op, args=args)
+
+    # Operation node
+    def operation(self, op, *args):
+        """
+        Returns the node of an operation, optimized if the builder optimizes.
+        :param op: One of 'and', 'or', 'xor', 'is not', 'xnor', 'not'
+        :param args: Operand IRNodes
+        :return: IRNode
+        """
+        if self.optimize:
+            return simplify(self, op, args)
+        return self.raw_operation(op, *args)
+
+    # Nodes of a ConditionGroup operator
+    def group(self, operator, left, right):
+        """
+        Lowers a ConditionGroup operator applied to two IR nodes. NOR and NAND become negations. For bool operands,
+        NOT (left is not right) and XNOR, whose expression is true when exactly one side is, become ^.
+        :param operator: ConditionGroup operator. e.g: 'XNOR'
+        :param left: IRNode of the left side
+        :param right: IRNode of the right side
+        :return: IRNode
+        """
+        if operator == 'AND':
+            return self.operation('and', left, right)
+        elif operator == 'OR':
+            return self.operation('or', left, right)
+        elif operator == 'NOR':
+            return self.operation('not', self.operation('or', left, right))
+        elif operator == 'NAND':
+            return self.operation('not', self.operation('and', left, right))
+        elif operator == 'XOR' or (left.boolean and right.boolean):
+            return self.operation('xor', left, right)
+        elif operator == 'NOT':
+            return self.operation('is not', left, right)
+        return self.operation('xnor', left, right)
+
+
+# Simplifies an operation whose operands are already optimized
+def simplify(builder, op, args):
+    # Constant folding
+    if all(arg.op == 'const' for arg in args):
+        try:
+            return builder.const(ir_functions[op](*(arg.value for arg in args)))
+        except Exception:
+            return builder.raw_operation(op, *args)
+
+    if op == 'not':
+        operand, = args
+        # Double negation
+        if operand.op == 'not' and operand.args[0].boolean:
+            return operand.args[0]
+        return builder.raw_operation(op, operand)
+
+    left, right = args
+    # Dead branch removal. A constant left side of and/or decides whether the right side is evaluated
+    if left.op == 'const' and op in ('and', 'or'):
+        return right if bool(left.value) == (op == 'and') else left
+    # Other simplifications rely on bool operands. Operands that are dropped must be safe
+    if not (left.boolean and right.boolean):
+        return builder.raw_operation(op, left, right)
+    if left.op == 'const' or right.op == 'const':
+        constant, other = (left, right) if left.op == 'const' else (right, left)
+        if op == 'and':
+            return other if constant.value else constant if other.safe else builder.raw_operation(op, left, right)
+        elif op == 'or':
+            return other if not constant.value else constant if other.safe else builder.raw_operation(op, left, right)
+        elif op == 'xor':
+            return simplify(builder, 'not', (other,)) if constant.value else other
+    # Idempotence: x and x, x or x are x, x ^ x is False
+    if left is right:
+        if op != 'xor':
+            return left
+        if left.safe:
+            return builder.const(False)
+    # Complements: x and not x is False, x or not x and x ^ not x are True
+    if left.safe and ((right.op == 'not' and right.args[0] is left) or (left.op == 'not' and left.args[0] is right)):
+        return builder.const(op != 'and')
+    return builder.raw_operation(op, left, right)
+
+
+# Counts the uses of every node of an IR DAG in its printed expression
+def count_references(root):
+    references = {id(root): 1}
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        for arg in node.args:
+            if id(arg) not in references:
+                references[id(arg)] = 0
+                nodes.append(arg)
+            references[id(arg)] += 2 if node.op in repeating_operations else 1
+    return references
+
+
+# Prints an IR DAG with every operation used more than once bound to a name on a line of its own
+def format_named(root):
+    references = count_references(root)
+    names = {}
+    lines = []
+
+    def expression(node):
+        if id(node) in names:
+            return names[id(node)]
+        if node.op == 'const':
+            return repr(node.value)
+        if node.op == 'test':
+            return node.value.cond_lambda
+        text = ir_formats[node.op](*(expression(arg) for arg in node.args))
+        if references[id(node)] > 1:
+            names[id(node)] = f"_{len(names) + 1}"
+            lines.append(f"{names[id(node)]} = {text}")
+            return names[id(node)]
+        return text
+
+    lines.append(expression(root))
+    return "\n".join(lines)
+
+
+# Prints an IR DAG
+def format_ir(root):
+    """
+    Prints an IR DAG as a single line Python expression, shared operations being printed wherever they are used.
+    Inlining shared operations can make the expression exponentially longer than the DAG, e.g: nested XNORs. If it
+    would be more than INLINE_LIMIT times longer than the named form, operations used more than once are instead
+    printed once, bound to a name on a line of their own, keeping the output linear in the size of the DAG.
+    :param root: Root IRNode
+    :return: The expression string
+    """
+    named = format_named(root)
+
+    # Length of each node's inlined expression, computed without printing it
+    lengths = {}
+
+    def length(node):
+        if id(node) not in lengths:
+            if node.op == 'const':
+                lengths[id(node)] = len(repr(node.value))
+            elif node.op == 'test':
+                lengths[id(node)] = len(node.value.cond_lambda)
+            else:
+                uses = 2 if node.op in repeating_operations else 1
+                lengths[id(node)] = len(ir_formats[node.op](*('' for _ in node.args))) + \
+                    uses * sum(length(arg) for arg in node.args)
+        return lengths[id(node)]
+
+    if length(root) > INLINE_LIMIT * len(named):
+        return named
+
+    texts = {}
+
+    def expression(node):
+        if id(node) not in texts:
+            if node.op == 'const':
+                texts[id(node)] = repr(node.value)
+            elif node.op == 'test':
+                texts[id(node)] = node.value.cond_lambda
+            else:
+                texts[id(node)] = ir_formats[node.op](*(expression(arg) for arg in node.args))
+        return texts[id(node)]
+
+    return expression(root)
+
+
+# Compiles an IR DAG into a callable
+def compile_ir(root):
+    """
+    Compiles an IR DAG into a callable returning the condition's value. Each node is compiled once, and negated and/or
+    nodes are compiled together with their operation.
+    :param root: Root IRNode
+    :return: Callable taking no arguments
+    """
+    compiled = {}
+
+    def visit(node):
+        if id(node) not in compiled:
+            if node.op == 'const':
+                value = node.value
+                compiled[id(node)] = lambda: value
+            elif node.op == 'test':
+                compiled[id(node)] = node.value.cond_func
+            elif node.op == 'not' and node.args[0].op in negated_compilers:
+                compiled[id(node)] = negated_compilers[node.args[0].op](*(visit(arg) for arg in node.args[0].args))
+            elif node.op in ir_compilers:
+                compiled[id(node)] = ir_compilers[node.op](*(visit(arg) for arg in node.args))
+            else:
+                function = ir_functions[node.op]
+                left, right = (visit(arg) for arg in node.args)
+                compiled[id(node)] = lambda: function(left(), right())
+        return compiled[id(node)]
+    return visit(root)
+
+
+# Returns the Attributes read by an IR DAG
+def read_attributes(root):
+    attributes = set()
+    seen = set()
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        if id(node) not in seen:
+            seen.add(id(node))
+            attributes.update(node.attributes)
+            nodes += node.args
+    return attributes
+
+
+# Prints a built condition tree
+def describe(condition):
+    """
+    Prints a condition subtree whose primitive conditions were built by Automation.build_condition(), without
+    optimizing it. e.g: to report shared ConditionGroups
+    :param condition: Primitive condition or ConditionGroup
+    :return: The expression string. See format_ir()
+    """
+    builder = IRBuilder(optimize=False)
+
+    # ConditionGroups have r1/r2 sides. See lib.automation.is_condition_group()
+    def lower(node):
+        if hasattr(node, 'r1'):
+            return builder.group(node.operator, lower(node.r1), lower(node.r2))
+        return builder.test(node)
+    return format_ir(lower(condition))
@@ -0,0 +1,541 @@
+import os
+import json
+import logging
+import threading
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+from .connection import live_connections
+from .events import events, LEVELS
+
+# Upper bounds in seconds of the latency histogram buckets. Ingestion and evaluation take microseconds, publishing
+# through a slow broker may take seconds
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Supported ways of exporting metrics
+EXPORTERS = ('HTTP', 'File')
+
+
+# Returns a label value escaped for the Prometheus text format
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Returns the label set of a sample in the Prometheus text format. e.g: '{entity="kitchen_gas"}'
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+
+# A counter per label value
+class Counter:
+    """
+    The Counter class counts events per label value. e.g: the messages ingested per Entity
+    ...
+
+    Attributes
+    ----------
+        name: str
+            Metric name. e.g: 'ha_auto_entity_messages_total'
+        help: str
+            Description of the metric
+        label: str
+            Name of the label distinguishing the counted objects. e.g: 'entity'
+        values: dict
+            Current count per label value
+
+    Methods
+    -------
+        inc(self, label, amount=1): Increases the count of a label value.
+        samples(self): Returns the metric's samples.
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    # Increase the count of a label value
+    def inc(self, label, amount=1):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    # (name, labels, value) samples of the metric
+    def samples(self):
+        with self.lock:
+            return [(self.name, ((self.label, label),), value) for label, value in self.values.items()]
+
+
+# A histogram of observed values per label value
+class Histogram:
+    """
+    The Histogram class counts observed values (e.g: durations in seconds) per label value into buckets with fixed
+    upper bounds. Observing a value is a binary search and two additions, independent of the number of observations.
+    ...
+
+    Attributes
+    ----------
+        name: str
+            Metric name. e.g: 'ha_auto_update_state_seconds'
+        help: str
+            Description of the metric
+        label: str
+            Name of the label distinguishing the observed objects. e.g: 'entity'
+        buckets: tuple
+            Sorted upper bounds of the buckets. Values above the last bound are counted in the +Inf bucket
+        values: dict
+            Per label value, the list of bucket counts (not cumulative, +Inf last), the sum and the maximum of the
+            observed values
+        total: float
+            Sum of the values observed for all label values
+
+    Methods
+    -------
+        observe(self, label, value): Counts a value observed for a label value.
+        summary(self): Returns the number, sum and maximum of the values observed per label value.
+        samples(self): Returns the metric's samples.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    # Count an observed value
+    def observe(self, label, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            if label not in self.values:
+                self.values[label] = [[0] * (len(self.buckets) + 1), 0.0, value]
+            counts = self.values[label]
+            counts[0][index] += 1
+            counts[1] += value
+            if value > counts[2]:
+                counts[2] = value
+            self.total += value
+
+    # Number, sum and maximum of the observed values per label value
+    def summary(self):
+        with self.lock:
+            return {label: (sum(counts), total, maximum) for label, (counts, total, maximum) in self.values.items()}
+
+    # (name, labels, value) samples of the metric. Bucket counts are cumulative, as in the Prometheus format
+    def samples(self):
+        samples = []
+        with self.lock:
+            values = [(label, list(counts), total) for label, (counts, total, _) in self.values.items()]
+        for label, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", ((self.label, label), ('le', bound)), cumulative))
+            samples.append((f"{self.name}_sum", ((self.label, label),), total))
+            samples.append((f"{self.name}_count", ((self.label, label),), cumulative))
+        return samples
+
+
+# A gauge read when metrics are exported
+class Gauge:
+    """
+    The Gauge class reports a current value, e.g: a queue depth, computed by a function when metrics are exported so
+    that the measured code is not instrumented at all.
+    ...
+
+    Attributes
+    ----------
+        name: str
+            Metric name. e.g: 'ha_auto_dispatch_queue_depth'
+        help: str
+            Description of the metric
+        label: str
+            Name of the label distinguishing the measured objects, or None for a single value
+        function: callable
+            Function returning the current values as a dictionary {label value: value}, or a number if label is None
+
+    Methods
+    -------
+        samples(self): Returns the metric's samples.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, label, function):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.function = function
+
+    # (name, labels, value) samples of the metric
+    def samples(self):
+        values = self.function()
+        if self.label is None:
+            return [] if values is None else [(self.name, (), values)]
+        return [(self.name, ((self.label, label),), value) for label, value in values.items()]
+
+
+# A class holding the metrics of the runtime
+class MetricsRegistry:
+    """
+    The MetricsRegistry class holds the counters, histograms and gauges measuring the runtime and renders them in the
+    Prometheus text format. Instrumented code checks enabled before measuring anything, so disabled metrics cost a
+    single attribute lookup per instrumented call.
+    ...
+
+    Attributes
+    ----------
+        enabled: bool
+            Whether instrumented code records measurements
+        metrics: dict
+            Registered metrics by name
+        messages: Counter
+            Messages ingested per Entity
+        evaluations: Counter
+            Evaluations per Automation
+        triggers: Counter
+            Triggers per Automation
+        deferred_triggers: Counter
+            Triggers deferred by the debounce or min_interval of their Automation, per Automation
+        suppressed_actions: Counter
+            Actions skipped because their target Attribute already had the value, per Automation
+        truncated_samples: Counter
+            Samples removed from an aggregate window they were still inside because the history was full, per Attribute
+        unknown_keys: Counter
+            Undeclared message keys ignored per Entity
+        mismatched_values: Counter
+            Message values that could not be coerced to their declared type per Entity
+        ingest_coalesced: Counter
+            Messages replacing or merged into a pending message of the ingestion queue per Entity
+        ingest_dropped: Counter
+            Messages dropped by the ingestion queue's overflow policy per Entity
+        update_state_duration: Histogram
+            Duration of Entity.update_state() per Entity
+        evaluate_duration: Histogram
+            Duration of Automation evaluations per Automation
+        trigger_duration: Histogram
+            Duration of running the actions of triggered Automations per Automation
+        publish_duration: Histogram
+            Duration of publishing dispatched messages per Broker
+        publish_latency: Histogram
+            Time from an Automation triggering to its message being published, per Broker
+
+    Methods
+    -------
+        register(self, metric): Adds a metric, replacing any metric with the same name.
+        gauge(self, name, help, label, function): Registers a Gauge.
+        render(self): Returns all metrics in the Prometheus text format.
+    """
+
+    def __init__(self):
+        """
+        Creates and returns a MetricsRegistry object holding the runtime's metrics. Metrics start disabled
+        """
+        self.enabled = False
+        self.metrics = {}
+        self.messages = self.register(Counter('ha_auto_entity_messages_total', 'Messages ingested per Entity',
+                                              'entity'))
+        self.evaluations = self.register(Counter('ha_auto_automation_evaluations_total', 'Evaluations per Automation',
+                                                 'automation'))
+        self.triggers = self.register(Counter('ha_auto_automation_triggers_total', 'Triggers per Automation',
+                                              'automation'))
+        self.deferred_triggers = self.register(Counter('ha_auto_automation_deferred_triggers_total',
+                                                       'Triggers deferred by debounce or min_interval per Automation',
+                                                       'automation'))
+        self.suppressed_actions = self.register(Counter('ha_auto_automation_suppressed_actions_total',
+                                                        'Actions skipped because their Attribute already had the '
+                                                        'value per Automation', 'automation'))
+        self.truncated_samples = self.register(Counter('ha_auto_attribute_truncated_samples_total',
+                                                       'Samples removed from aggregate windows by a full history per '
+                                                       'Attribute', 'attribute'))
+        self.unknown_keys = self.register(Counter('ha_auto_entity_unknown_keys_total',
+                                                  'Undeclared message keys ignored per Entity', 'entity'))
+        self.mismatched_values = self.register(Counter('ha_auto_entity_mismatched_values_total',
+                                                       'Message values that could not be coerced to their declared '
+                                                       'type per Entity', 'entity'))
+        self.ingest_coalesced = self.register(Counter('ha_auto_ingest_coalesced_total',
+                                                      'Messages coalesced into a pending message per Entity', 'entity'))
+        self.ingest_dropped = self.register(Counter('ha_auto_ingest_dropped_total',
+                                                    'Messages dropped by the ingestion queue per Entity', 'entity'))
+        self.update_state_duration = self.register(Histogram('ha_auto_update_state_seconds',
+                                                             'Duration of Entity state updates', 'entity'))
+        self.evaluate_duration = self.register(Histogram('ha_auto_evaluate_seconds',
+                                                         'Duration of Automation evaluations', 'automation'))
+        self.trigger_duration = self.register(Histogram('ha_auto_trigger_seconds',
+                                                        'Duration of running the actions of triggered Automations',
+                                                        'automation'))
+        self.publish_duration = self.register(Histogram('ha_auto_publish_seconds',
+                                                        'Duration of publishing dispatched messages', 'broker'))
+        self.publish_latency = self.register(Histogram('ha_auto_trigger_publish_seconds',
+                                                       'Time from an Automation triggering to its action being '
+                                                       'published', 'broker'))
+
+    # Add a metric
+    def register(self, metric):
+        """
+        Adds a metric to the registry, replacing any metric with the same name.
+        :param metric: Counter, Histogram or Gauge object
+        :return: The metric
+        """
+        self.metrics[metric.name] = metric
+        return metric
+
+    # Register a gauge
+    def gauge(self, name, help, label, function):
+        """
+        Registers a Gauge computed by a function when metrics are exported.
+        :param name: Metric name
+        :param help: Description of the metric
+        :param label: Name of the label distinguishing the measured objects, or None for a single value
+        :param function: Function returning {label value: value}, or a number if label is None
+        :return: The Gauge
+        """
+        return self.register(Gauge(name, help, label, function))
+
+    # Render all metrics
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format. Gauges raising an exception are logged and
+        skipped.
+        :return: String
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                samples = metric.samples()
+            except Exception:
+                logging.error(f"Reading metric {metric.name} failed", exc_info=True)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+# The registry of the running process
+metrics = MetricsRegistry()
+
+
+# Register the gauges measuring a running model
+def watch_model(model):
+    """
+    Registers the gauges measuring a running model: the depths of its dispatch queues, of its event scheduler, of its
+    ingestion queue and of its shard forwarding queues, and the live connections of every Broker. The gauges read the
+    model's current dispatcher, scheduler, ingestion queue and router when metrics are exported.
+    :param model: The running model
+    :return:
+    """
+    def dispatch_depths():
+        dispatcher = getattr(model, 'dispatcher', None)
+        return dispatcher.queue_depths() if dispatcher is not None else {}
+
+    def scheduled():
+        scheduler = getattr(model, 'scheduler', None)
+        return len(scheduler.pending) if scheduler is not None else None
+
+    def ingestion_depth():
+        ingestion = getattr(model, 'ingestion', None)
+        return len(ingestion) if ingestion is not None else None
+
+    def forward_depths():
+        router = getattr(model, 'router', None)
+        return {str(index): len(batch) for index, batch in enumerate(router.pending)} if router is not None else {}
+
+    metrics.gauge('ha_auto_dispatch_queue_depth', 'Messages waiting to be published per Broker', 'broker',
+                  dispatch_depths)
+    metrics.gauge('ha_auto_scheduled_automations', 'Automations waiting to be evaluated', None, scheduled)
+    metrics.gauge('ha_auto_ingest_pending', 'Entities with a message waiting in the ingestion queue', None,
+                  ingestion_depth)
+    metrics.gauge('ha_auto_shard_queue_depth', 'Entity messages waiting to be forwarded per shard', 'shard',
+                  forward_depths)
+    metrics.gauge('ha_auto_broker_connections', 'Live endpoints per Broker connection', 'broker', live_connections)
+
+
+# Request handler serving the metrics, and the recent events of the event log on /events. e.g:
+# /events?kind=trigger&automation=gasAlert&count=20
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/events':
+            query = dict(parse_qsl(url.query))
+            try:
+                count = int(query.pop('count', 100))
+                if query.get('level', 'debug') not in LEVELS:
+                    raise ValueError(f"Unknown level. Use one of {tuple(LEVELS)}")
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            body = json.dumps(events.recent(count, **query), default=str).encode()
+            content_type = 'application/json'
+        elif url.path in ('/', '/metrics'):
+            body = metrics.render().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Requests are not logged, scrapes would flood the output
+    def log_message(self, format, *args):
+        pass
+
+
+# A class serving the metrics over HTTP
+class MetricsServer:
+    """
+    The MetricsServer class serves the metrics in the Prometheus text format on /metrics, and the recent events of the
+    event log as JSON on /events, from a background thread.
+    ...
+
+    Attributes
+    ----------
+        host: str
+            Address the server listens on. Defaults to the local host only
+        port: int
+            Port the server listens on. 0 picks a free port, set once started
+        server: ThreadingHTTPServer
+            The running server. Created by start()
+
+    Methods
+    -------
+        start(self): Starts serving in a background thread.
+        stop(self): Stops the server.
+    """
+
+    def __init__(self, port, host='127.0.0.1'):
+        """
+        Creates and returns a MetricsServer object
+        :param port: Port to listen on
+        :param host: Address to listen on
+        """
+        self.host = host
+        self.port = port
+        self.server = None
+
+    # Start serving
+    def start(self):
+        """
+        Starts serving the metrics in a background thread.
+        :return:
+        """
+        self.server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True).start()
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    # Stop serving
+    def stop(self):
+        """
+        Stops the server.
+        :return:
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+# A class periodically writing the metrics to a file
+class MetricsWriter:
+    """
+    The MetricsWriter class writes the metrics in the Prometheus text format to a file every interval seconds, e.g:
+    for the node exporter's textfile collector. The file is replaced atomically, so readers never see a partial dump.
+    ...
+
+    Attributes
+    ----------
+        path: str
+            Path of the metrics file
+        interval: float
+            Seconds between writes
+
+    Methods
+    -------
+        write(self): Writes the metrics once.
+        start(self): Starts writing in a background thread.
+        stop(self): Stops writing after a final write.
+    """
+
+    def __init__(self, path, interval=10):
+        """
+        Creates and returns a MetricsWriter object
+        :param path: Path of the metrics file
+        :param interval: Seconds between writes
+        """
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Write the metrics once
+    def write(self):
+        """
+        Writes the metrics to a temporary file next to the metrics file, then replaces the metrics file with it.
+        :return:
+        """
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            f.write(metrics.render())
+        os.replace(temporary, self.path)
+
+    # Thread loop writing the metrics every interval
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                logging.error(f"Writing metrics to {self.path} failed", exc_info=True)
+
+    # Start writing
+    def start(self):
+        """
+        Starts writing the metrics every interval seconds in a background thread.
+        :return:
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="metrics-writer", daemon=True)
+        self.thread.start()
+
+    # Stop writing
+    def stop(self):
+        """
+        Stops the writing thread and writes the metrics a last time.
+        :return:
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.write()
+
+
+# Enable metrics and start exporting them
+def start_metrics(export="HTTP", port=9464, path="metrics.prom", interval=10):
+    """
+    Enables the instrumentation and starts exporting the metrics.
+    :param export: "HTTP" to serve them on a local port, or "File" to write them to a file periodically
+    :param port: Port of the HTTP endpoint
+    :param path: Path of the metrics file
+    :param interval: Seconds between writes of the metrics file
+    :return: The started MetricsServer or MetricsWriter
+    """
+    if export not in EXPORTERS:
+        raise ValueError(f"Unknown metrics export '{export}'. Use one of {EXPORTERS}")
+    exporter = MetricsServer(port) if export == "HTTP" else MetricsWriter(path, interval)
+    metrics.enabled = True
+    exporter.start()
+    return exporter
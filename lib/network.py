@@ -0,0 +1,287 @@
+import logging
+
+from .automation import List, Dict, operator_functions, is_attribute, is_condition_group
+from .ir import describe
+
+
+# Value of a network node whose computation raised an exception
+class Failed:
+    def __init__(self, error):
+        self.error = error
+
+
+# Returns a function computing a ConditionGroup node from the values of its sides. Mirrors compiled conditions:
+# short-circuiting operators ignore a failed right side when the left side decides the result, other operators fail if
+# either side failed.
+def group_function(operator):
+    if operator == 'AND':
+        return lambda left, right: left if type(left) is Failed or not left else right
+    elif operator == 'OR':
+        return lambda left, right: left if type(left) is Failed or left else right
+    elif operator == 'NOR':
+        return lambda left, right: left if type(left) is Failed else \
+            False if left else right if type(right) is Failed else not right
+    elif operator == 'NAND':
+        return lambda left, right: left if type(left) is Failed else \
+            True if not left else right if type(right) is Failed else not right
+
+    function = operator_functions[operator]
+
+    def apply(left, right):
+        if type(left) is Failed:
+            return left
+        if type(right) is Failed:
+            return right
+        try:
+            return function(left, right)
+        except Exception as error:
+            return Failed(error)
+    return apply
+
+
+# Returns a function computing a primitive condition node with its compiled callable
+def primitive_function(cond_func):
+    def compute():
+        try:
+            return cond_func()
+        except Exception as error:
+            return Failed(error)
+    return compute
+
+
+# Returns a hashable key of a literal operand. Types are part of the key, since e.g: 1 == True == 1.0
+def literal_key(node):
+    if type(node) == List:
+        return 'list', tuple(literal_key(item) for item in node.items)
+    elif type(node) == Dict:
+        return 'dict', tuple((item.name, literal_key(item.value)) for item in node.items)
+    return type(node).__name__, node
+
+
+# Returns a hashable key of a condition operand. Attributes are identified by object
+def operand_key(node):
+    if is_attribute(node):
+        return 'attribute', id(node)
+    return 'literal', literal_key(node)
+
+
+# A node of the condition network
+class NetworkNode:
+    """
+    The NetworkNode class represents a distinct primitive condition or ConditionGroup of the condition network, shared
+    by all Automations containing it.
+    ...
+
+    Attributes
+    ----------
+        compute: callable
+            Function computing the node's value. Primitive nodes take no arguments, ConditionGroup nodes take the
+            values of their sides
+        sides: tuple
+            The left and right NetworkNodes of a ConditionGroup node. Empty for primitive nodes
+        height: int
+            0 for primitive nodes, 1 + the height of the highest side for ConditionGroup nodes
+        outputs: list
+            ConditionGroup nodes using this node as a side
+        value:
+            Current value of the condition. A Failed object if its computation raised an exception
+        occurrences: int
+            Number of times the condition appears in the model's Automations
+        condition: object
+            The condition's first occurrence. Used for reporting
+    """
+
+    def __init__(self, compute, sides, height, condition):
+        self.compute = compute
+        self.sides = sides
+        self.height = height
+        self.outputs = []
+        self.value = None
+        self.occurrences = 0
+        self.condition = condition
+
+
+# A class evaluating the conditions of all Automations through a shared condition network
+class ConditionNetwork:
+    """
+    The ConditionNetwork class merges the condition trees of all Automations of a model into a shared network, in the
+    spirit of a Rete network. Primitive conditions and ConditionGroups are hashed by their structure, so a condition
+    repeated across Automations (e.g: clock.hour > 7) becomes a single node. When Attributes change, only the
+    primitive nodes reading them are recomputed, and changed values propagate upwards level by level, so every
+    distinct condition is computed at most once per update.
+    ...
+
+    Attributes
+    ----------
+        model: textX model
+            The model whose Automations are evaluated
+        automations: list
+            The Automations the network was built for. The network is rebuilt when the model's list changes, e.g:
+            after a model reload
+        computations: int
+            Number of node computations since the network was built
+
+    Methods
+    -------
+        build(self): Builds the network from the conditions of the model's Automations.
+        update(self): Recomputes the nodes affected by Attribute changes since the last update.
+        result(self, automation): Returns the current condition result of an Automation.
+        evaluate(self): Updates the network and returns the results of all Automations.
+        stats(self): Returns statistics on the sharing found in the model.
+        most_shared(self, count): Returns the most shared conditions.
+    """
+
+    def __init__(self, model):
+        """
+        Creates and returns a ConditionNetwork object
+        :param model: The model whose Automations are evaluated. Conditions must be built using build_condition()
+        """
+        self.model = model
+        self.automations = None
+        self.computations = 0
+
+    # Build the network
+    def build(self):
+        """
+        Builds the network from the conditions of the model's Automations and computes every node once.
+        :return:
+        """
+        self.automations = self.model.automations
+        self.nodes = {}
+        self.roots = {}
+        # Primitive nodes reading each Attribute {attribute: [nodes]} and the Attribute versions last seen
+        self.readers = {}
+        self.versions = {}
+        self.primitive_count = 0
+        self.group_count = 0
+
+        for automation in self.automations:
+            # Automations whose condition was not built are evaluated by Automation.evaluate()
+            if hasattr(automation.condition, 'cond_func'):
+                self.roots[automation] = self.add(automation.condition)
+
+        # Compute all nodes, lowest first
+        for node in sorted(self.nodes.values(), key=lambda node: node.height):
+            node.value = node.compute(*(side.value for side in node.sides))
+            self.computations += 1
+        self.versions = {attribute: attribute.version for attribute in self.readers}
+
+        stats = self.stats()
+        logging.info(f"Condition network: {stats['primitive_conditions']} primitive conditions "
+                     f"({stats['distinct_primitive_conditions']} distinct), {stats['group_conditions']} condition "
+                     f"groups ({stats['distinct_group_conditions']} distinct)")
+
+    # Add a condition tree to the network and return its root node
+    def add(self, condition):
+        if is_condition_group(condition):
+            self.group_count += 1
+            sides = (self.add(condition.r1), self.add(condition.r2))
+            key = (condition.operator, id(sides[0]), id(sides[1]))
+            if key not in self.nodes:
+                node = NetworkNode(group_function(condition.operator), sides,
+                                   max(side.height for side in sides) + 1, condition)
+                for side in sides:
+                    side.outputs.append(node)
+                self.nodes[key] = node
+        else:
+            self.primitive_count += 1
+            key = (condition.operator, operand_key(condition.operand1), operand_key(condition.operand2))
+            if key not in self.nodes:
+                node = NetworkNode(primitive_function(condition.cond_func), (), 0, condition)
+                for operand in (condition.operand1, condition.operand2):
+                    if is_attribute(operand):
+                        self.readers.setdefault(operand, []).append(node)
+                self.nodes[key] = node
+        node = self.nodes[key]
+        node.occurrences += 1
+        return node
+
+    # Recompute the nodes affected by Attribute changes
+    def update(self):
+        """
+        Recomputes the primitive nodes reading Attributes whose version changed since the last update, then the
+        ConditionGroup nodes whose sides changed value, level by level. Rebuilds the network first if the model's
+        Automations changed.
+        :return:
+        """
+        if self.model.automations is not self.automations:
+            self.build()
+            return
+
+        # Primitive nodes reading changed Attributes
+        levels = [set()]
+        for attribute, nodes in self.readers.items():
+            version = attribute.version
+            if version != self.versions[attribute]:
+                self.versions[attribute] = version
+                levels[0].update(nodes)
+
+        # Recompute level by level, scheduling the outputs of nodes whose value changed
+        height = 0
+        while height < len(levels):
+            for node in levels[height]:
+                value = node.compute(*(side.value for side in node.sides))
+                self.computations += 1
+                old = node.value
+                if value is old or (type(value) is type(old) and type(value) is not Failed and value == old):
+                    continue
+                node.value = value
+                for output in node.outputs:
+                    while len(levels) <= output.height:
+                        levels.append(set())
+                    levels[output.height].add(output)
+            height += 1
+
+    # Current condition result of an Automation
+    def result(self, automation):
+        """
+        Returns the current condition result of an Automation, as of the last update.
+        :param automation: Automation object
+        :return: The result as a bool, or None if the Automation's condition has to be evaluated with its compiled
+            callable, e.g: because its computation raised an exception. See Automation.evaluate()
+        """
+        root = self.roots.get(automation)
+        if root is None or type(root.value) is Failed:
+            return None
+        return bool(root.value)
+
+    # Update the network and return all results
+    def evaluate(self):
+        """
+        Updates the network and returns the condition results of all Automations.
+        :return: Iterator of (Automation, result) pairs. See result()
+        """
+        self.update()
+        return ((automation, self.result(automation)) for automation in self.automations)
+
+    # Sharing statistics
+    def stats(self):
+        """
+        Returns statistics on the sharing found in the model's conditions.
+        :return: Dictionary with the number of primitive conditions and ConditionGroups in all Automations, the number
+            of distinct ones, the number of nodes shared by more than one occurrence, the ratio of occurrences to
+            nodes and the number of node computations since the network was built
+        """
+        primitives = sum(1 for node in self.nodes.values() if not node.sides)
+        groups = len(self.nodes) - primitives
+        occurrences = self.primitive_count + self.group_count
+        return {
+            'automations': len(self.roots),
+            'primitive_conditions': self.primitive_count,
+            'distinct_primitive_conditions': primitives,
+            'group_conditions': self.group_count,
+            'distinct_group_conditions': groups,
+            'shared_nodes': sum(1 for node in self.nodes.values() if node.occurrences > 1),
+            'sharing_ratio': occurrences / len(self.nodes) if self.nodes else 1.0,
+            'computations': self.computations
+        }
+
+    # Most shared conditions
+    def most_shared(self, count=10):
+        """
+        Returns the conditions appearing most often in the model's Automations.
+        :param count: Number of conditions to return
+        :return: List of (expression, occurrences) tuples, most shared first. See lib.ir.describe()
+        """
+        nodes = sorted(self.nodes.values(), key=lambda node: node.occurrences, reverse=True)[:count]
+        return [(describe(node.condition), node.occurrences) for node in nodes]
@@ -0,0 +1,254 @@
+import os
+import mmap
+import zlib
+import atexit
+import struct
+import logging
+import marshal
+import threading
+
+from .cache import serialize_model
+from .state import state_store
+
+# Magic bytes starting every state file, followed by the format version, the length and the CRC32 of the payload
+STATE_MAGIC = b'HA_STATE'
+STATE_VERSION = 1
+state_header = struct.Struct('<8sIII')
+
+
+# Returns a checksum of each Automation's definition, leaving out its enabled flag
+def definition_checksums(model):
+    checksums = {}
+    for definition in serialize_model(model)['automations']:
+        definition = {key: value for key, value in definition.items() if key != 'enabled'}
+        checksums[definition['name']] = zlib.crc32(marshal.dumps(definition))
+    return checksums
+
+
+# Returns the Attribute values and Automation enabled flags of a model as plain data
+def capture_state(model, flags=True):
+    """
+    Returns the current values of the Attributes of a model's Entities and the enabled flags of its Automations. Unset
+    Attributes are left out. Each flag is stored with a checksum of its Automation's definition, so that a flag is only
+    restored to the same Automation.
+    :param model: The running model
+    :param flags: Whether the enabled flags are captured
+    :return: Dictionary {'entities': {entity: {attribute: value}}, 'automations': {automation: (enabled, checksum)}}
+    """
+    checksums = definition_checksums(model) if flags else {}
+    return {
+        'entities': {entity.name: {name: value for name, value in entity.state.items() if value is not None}
+                     for entity in list(model.entities)},
+        'automations': {automation.name: (automation.enabled, checksums[automation.name])
+                        for automation in list(model.automations) if flags}
+    }
+
+
+# Applies state captured by capture_state() to a model
+def apply_state(model, data, flags=True):
+    """
+    Restores the Attribute values and Automation enabled flags of a model from captured state. Values are applied as
+    messages received by their Entities, so they are coerced to the declared types. Entities, Attributes and
+    Automations the model no longer declares, and Automations whose definition changed, are skipped.
+    :param model: Model whose Broker connections have not started yet
+    :param data: State returned by capture_state()
+    :param flags: Whether the enabled flags are restored
+    :return: (Number of restored Attribute values, Number of restored enabled flags)
+    """
+    values = 0
+    for entity in model.entities:
+        state = {name: value for name, value in data['entities'].get(entity.name, {}).items()
+                 if name in entity.attributes_dict}
+        if state:
+            entity.update_state(state)
+            values += len(state)
+
+    restored = 0
+    if flags:
+        checksums = definition_checksums(model)
+        for automation in model.automations:
+            saved = data['automations'].get(automation.name)
+            if saved is not None and saved[1] == checksums[automation.name]:
+                automation.enabled = saved[0]
+                restored += 1
+    return values, restored
+
+
+# Writes state to a file, replacing it atomically
+def write_state(path, data):
+    """
+    Writes state to a temporary file next to the state file through a memory map, then replaces the state file with it,
+    so that a crash while writing leaves the previous state file intact.
+    :param path: Path of the state file
+    :param data: State returned by capture_state()
+    :return: Size of the written file in bytes
+    """
+    payload = marshal.dumps(data)
+    size = state_header.size + len(payload)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'w+b') as f:
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as buffer:
+            state_header.pack_into(buffer, 0, STATE_MAGIC, STATE_VERSION, len(payload), zlib.crc32(payload))
+            buffer[state_header.size:] = payload
+            buffer.flush()
+    os.replace(temporary, path)
+    return size
+
+
+# Reads state from a file
+def read_state(path):
+    """
+    Reads the state written by write_state() through a memory map.
+    :param path: Path of the state file
+    :return: State as returned by capture_state(), or None if the file is missing
+    :raises ValueError: If the file is not a state file of the current version, or is corrupted
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < state_header.size:
+            raise ValueError(f"State file {path} is truncated")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            magic, version, length, checksum = state_header.unpack_from(buffer, 0)
+            if magic != STATE_MAGIC or version != STATE_VERSION:
+                raise ValueError(f"{path} is not a version {STATE_VERSION} state file")
+            payload = buffer[state_header.size:state_header.size + length]
+    if len(payload) != length or zlib.crc32(payload) != checksum:
+        raise ValueError(f"State file {path} is corrupted")
+    return marshal.loads(payload)
+
+
+# A class saving and restoring the state of a running model
+class StatePersistence:
+    """
+    The StatePersistence class periodically saves the Attribute values and Automation enabled flags of a running model
+    to a state file, and restores them on startup before the Broker connections start, so that conditions see the last
+    known values instead of unset Attributes until every device publishes again. Saving is skipped while no Attribute
+    version and no enabled flag changed, and the file is replaced atomically, see write_state(). When Automations are
+    evaluated by shard workers, the model's enabled flags are not the ones the workers update, so flags must not be
+    persisted.
+    ...
+
+    Attributes
+    ----------
+        model: model object
+            The running model
+        path: str
+            Path of the state file
+        interval: float
+            Seconds between saves
+        flags: bool
+            Whether the enabled flags are saved and restored
+        fingerprint: tuple
+            Attribute versions total and enabled flags at the last save. Used to skip saves when nothing changed
+        saves: int
+            Number of written state files
+        skipped: int
+            Number of saves skipped because nothing changed
+
+    Methods
+    -------
+        restore(self): Restores the model's state from the state file.
+        save(self): Saves the model's state if it changed since the last save.
+        start(self): Starts saving in a background thread.
+        stop(self): Stops saving after a final save.
+        stats(self): Returns the persistence statistics.
+    """
+
+    def __init__(self, model, path, interval=5, flags=True):
+        """
+        Creates and returns a StatePersistence object
+        :param model: The running model
+        :param path: Path of the state file
+        :param interval: Seconds between saves
+        :param flags: Whether the enabled flags are saved and restored. e.g: False when shard workers evaluate the
+            Automations
+        """
+        self.model = model
+        self.path = path
+        self.interval = interval
+        self.flags = flags
+        self.fingerprint = None
+        self.saves = 0
+        self.skipped = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Restore the model's state
+    def restore(self):
+        """
+        Restores the Attribute values and Automation enabled flags saved in the state file. Meant to be called before
+        the model's Broker connections start. A missing or unreadable state file leaves the model as parsed.
+        :return: (Number of restored Attribute values, Number of restored enabled flags)
+        """
+        try:
+            data = read_state(self.path)
+        except (OSError, ValueError, EOFError, TypeError):
+            logging.warning(f"Cannot restore the state from {self.path}. Starting without it", exc_info=True)
+            return 0, 0
+        if data is None:
+            return 0, 0
+        values, flags = apply_state(self.model, data, self.flags)
+        logging.info(f"Restored {values} Attribute values and {flags} Automation flags from {self.path}")
+        return values, flags
+
+    # Returns a value changing whenever an Attribute or an enabled flag changes
+    def current_fingerprint(self):
+        return (sum(sum(column.versions) for column in state_store.columns.values()),
+                tuple(automation.enabled for automation in list(self.model.automations) if self.flags))
+
+    # Save the model's state
+    def save(self):
+        """
+        Writes the model's state to the state file, unless nothing changed since the last save.
+        :return: True if the state file was written
+        """
+        fingerprint = self.current_fingerprint()
+        if fingerprint == self.fingerprint:
+            self.skipped += 1
+            return False
+        write_state(self.path, capture_state(self.model, self.flags))
+        self.fingerprint = fingerprint
+        self.saves += 1
+        return True
+
+    # Thread loop saving the state every interval
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.save()
+            except (OSError, ValueError):
+                logging.error(f"Saving the state to {self.path} failed", exc_info=True)
+
+    # Start saving
+    def start(self):
+        """
+        Starts saving the state every interval seconds in a background thread. The state is saved a last time on exit.
+        :return:
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="state-persistence", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    # Stop saving
+    def stop(self):
+        """
+        Stops the saving thread and saves the state a last time.
+        :return:
+        """
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.save()
+
+    # Persistence statistics
+    def stats(self):
+        """
+        Returns the persistence statistics.
+        :return: Dictionary {'saves': int, 'skipped': int}
+        """
+        return {'saves': self.saves, 'skipped': self.skipped}
@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import atexit
+import signal
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from .metrics import metrics
+
+# Phases of the per-cycle time breakdown and the histograms measuring them. Ingestion and publishing run on other
+# threads, so a cycle is charged with the time they took since the previous cycle ended
+phase_histograms = {
+    'ingest': lambda: metrics.update_state_duration,
+    'evaluate': lambda: metrics.evaluate_duration,
+    'trigger': lambda: metrics.trigger_duration,
+    'publish': lambda: metrics.publish_duration
+}
+
+# Maximum number of characters of a condition expression included in the report
+CONDITION_PREVIEW = 200
+
+
+# Returns the folded stack of a frame, outermost call first. e.g: 'run (main.py:10);evaluate (automation.py:215)'
+def fold_stack(frame):
+    calls = []
+    while frame is not None:
+        calls.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(calls))
+
+
+# A class sampling the stacks of all threads
+class StackSampler:
+    """
+    The StackSampler class is a sampling profiler. A background thread records the stacks of all other threads every
+    interval seconds, and the samples are written in the collapsed stack format read by flamegraph.pl, speedscope and
+    other flame graph tools: one line per distinct stack, with frames separated by ';' and followed by its count.
+    ...
+
+    Attributes
+    ----------
+        interval: float
+            Seconds between samples
+        stacks: dict
+            Number of samples per folded stack. Stacks start with the name of their thread
+
+    Methods
+    -------
+        start(self): Starts sampling.
+        stop(self): Stops sampling.
+        write(self, path): Writes the samples in the collapsed stack format.
+    """
+
+    def __init__(self, interval=0.005):
+        """
+        Creates and returns a StackSampler object
+        :param interval: Seconds between samples
+        """
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Thread loop sampling the other threads
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    stack = f"{names.get(ident, ident)};{fold_stack(frame)}"
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    # Start sampling
+    def start(self):
+        """
+        Starts sampling in a background thread.
+        :return:
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="stack-sampler", daemon=True)
+        self.thread.start()
+
+    # Stop sampling
+    def stop(self):
+        """
+        Stops sampling. Recorded samples are kept.
+        :return:
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # Write the samples
+    def write(self, path):
+        """
+        Writes the recorded samples in the collapsed stack format, most sampled stacks first.
+        :param path: Path of the trace file
+        :return:
+        """
+        stacks = sorted(list(self.stacks.items()), key=lambda item: item[1], reverse=True)
+        with open(path, 'w') as f:
+            for stack, count in stacks:
+                f.write(f"{stack} {count}\n")
+
+
+# A class profiling the runtime
+class Profiler:
+    """
+    The Profiler class implements the runtime's profiling mode. It uses the measurements recorded by the metrics
+    instrumentation (see lib.metrics) to break every evaluation cycle down into the time spent in ingestion,
+    evaluation, triggering and publishing, flags Automation evaluations exceeding a time budget, and writes a report
+    ranking the most expensive Automations and Entities. An optional StackSampler records a sampling trace.
+    ...
+
+    Attributes
+    ----------
+        active: bool
+            Whether profiling is running. Set by start()
+        budget: float
+            Seconds a single Automation evaluation may take before it is flagged as slow. None disables flagging
+        top: int
+            Number of Automations, Entities and cycles listed in the report
+        report_path: str
+            Path of the JSON report
+        trace_path: str
+            Path of the sampling trace, or None to not sample
+        cycles: deque
+            Breakdowns of the most recent evaluation cycles
+        slow: dict
+            Number of evaluations over budget per Automation name
+        sampler: StackSampler object
+            Records the sampling trace. None if trace_path is not set
+
+    Methods
+    -------
+        start(self): Enables the instrumentation and starts profiling.
+        cycle(self): Context manager measuring an evaluation cycle.
+        check(self, automation, duration): Flags an Automation evaluation exceeding the budget.
+        report(self): Returns the profiling report.
+        write_report(self): Writes the report, and the sampling trace if enabled.
+        stop(self): Stops profiling, writing the report.
+    """
+
+    def __init__(self, budget=None, top=10, report_path="profile.json", trace_path=None, sample_interval=0.005,
+                 history=1000):
+        """
+        Creates and returns a Profiler object. Profiling starts when start() is called
+        :param budget: Seconds a single Automation evaluation may take before it is flagged as slow
+        :param top: Number of Automations, Entities and cycles listed in the report
+        :param report_path: Path of the JSON report
+        :param trace_path: Path of the sampling trace, or None to not sample
+        :param sample_interval: Seconds between stack samples of the trace
+        :param history: Number of recent cycles kept for the report
+        """
+        self.active = False
+        self.budget = budget
+        self.top = top
+        self.report_path = report_path
+        self.trace_path = trace_path
+        self.sample_interval = sample_interval
+        self.cycles = deque(maxlen=history)
+        self.cycle_count = 0
+        self.slow = {}
+        self.sampler = None
+        # Slowest evaluation over budget per Automation name
+        self.slowest = {}
+        # Conditions of the flagged Automations, by Automation name
+        self.conditions = {}
+        # Phase totals when the previous cycle ended
+        self.totals = {}
+        # Set to request a report from the reporting thread, e.g: by the SIGUSR1 handler
+        self.requested = threading.Event()
+        self.lock = threading.Lock()
+
+    # Current total time of each phase
+    def phase_totals(self):
+        return {phase: histogram().total for phase, histogram in phase_histograms.items()}
+
+    # Start profiling
+    def start(self):
+        """
+        Enables the metrics instrumentation and starts profiling. The report is written on exit, and when the process
+        receives SIGUSR1 where supported. Must be called from the main thread.
+        :return:
+        """
+        metrics.enabled = True
+        self.active = True
+        self.totals = self.phase_totals()
+        if self.trace_path is not None:
+            self.sampler = StackSampler(self.sample_interval)
+            self.sampler.start()
+        # Reports requested by signal are written by a thread, since the interrupted code may hold the metric locks
+        threading.Thread(target=self.serve_requests, name="profile-reporter", daemon=True).start()
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.requested.set())
+        atexit.register(self.stop)
+        logging.info(f"Profiling. The report is written to {self.report_path} on exit"
+                     f"{' and on SIGUSR1' if hasattr(signal, 'SIGUSR1') else ''}")
+
+    # Thread loop writing requested reports
+    def serve_requests(self):
+        while True:
+            self.requested.wait()
+            self.requested.clear()
+            try:
+                self.write_report()
+            except OSError:
+                logging.error(f"Writing the profiling report to {self.report_path} failed", exc_info=True)
+
+    # Measure an evaluation cycle
+    @contextmanager
+    def cycle(self):
+        """
+        Context manager wrapping an evaluation cycle. Records the cycle's duration and the time spent in each phase
+        since the previous cycle ended. Does nothing unless profiling is active.
+        :return:
+        """
+        if not self.active:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            totals = self.phase_totals()
+            with self.lock:
+                breakdown = {'cycle': self.cycle_count, 'duration_s': duration}
+                breakdown.update({f"{phase}_s": totals[phase] - self.totals[phase] for phase in totals})
+                self.totals = totals
+                self.cycles.append(breakdown)
+                self.cycle_count += 1
+
+    # Flag an evaluation over budget
+    def check(self, automation, duration):
+        """
+        Flags an Automation evaluation that took longer than the budget. The first slow evaluation of an Automation
+        and every 100th one after it are logged.
+        :param automation: The evaluated Automation
+        :param duration: Duration of the evaluation in seconds
+        :return:
+        """
+        if self.budget is None or duration <= self.budget:
+            return
+        with self.lock:
+            count = self.slow.get(automation.name, 0) + 1
+            self.slow[automation.name] = count
+            self.slowest[automation.name] = max(self.slowest.get(automation.name, 0), duration)
+            if automation.name not in self.conditions:
+                self.conditions[automation.name] = getattr(automation.condition, 'cond_lambda', '')[:CONDITION_PREVIEW]
+        if count % 100 == 1:
+            logging.warning(f"Automation {automation.name} took {duration * 1000:.3f} ms to evaluate, over the "
+                            f"{self.budget * 1000:.3f} ms budget ({count} slow evaluations)")
+
+    # Build the report
+    def report(self):
+        """
+        Returns the profiling report: the Automations and Entities ranked by the total time spent evaluating and
+        updating them, the Automations flagged as slow, and per-phase statistics of the recent cycles along with the
+        slowest ones.
+        :return: Dictionary
+        """
+        def ranked(histogram, count_name):
+            entries = sorted(histogram.summary().items(), key=lambda item: item[1][1], reverse=True)[:self.top]
+            return [{'name': name, count_name: count, 'total_s': total, 'mean_s': total / count, 'max_s': maximum}
+                    for name, (count, total, maximum) in entries]
+
+        with self.lock:
+            cycles = list(self.cycles)
+            slow = [{'name': name, 'slow_evaluations': count, 'max_s': self.slowest[name],
+                     'condition': self.conditions[name]}
+                    for name, count in sorted(self.slow.items(), key=lambda item: item[1], reverse=True)]
+        phases = {}
+        for phase in ('duration',) + tuple(phase_histograms):
+            values = [cycle[f"{phase}_s"] for cycle in cycles]
+            phases[phase] = {'total_s': sum(values), 'mean_s': sum(values) / len(values) if values else 0.0,
+                             'max_s': max(values, default=0.0)}
+        return {
+            'budget_s': self.budget,
+            'cycles': {
+                'count': self.cycle_count,
+                'recent': len(cycles),
+                'phases': phases,
+                'slowest': sorted(cycles, key=lambda cycle: cycle['duration_s'], reverse=True)[:self.top]
+            },
+            'automations': ranked(metrics.evaluate_duration, 'evaluations'),
+            'triggers': ranked(metrics.trigger_duration, 'triggers'),
+            'entities': ranked(metrics.update_state_duration, 'messages'),
+            'slow_automations': slow
+        }
+
+    # Write the report
+    def write_report(self):
+        """
+        Writes the report as JSON to report_path, and the sampling trace recorded so far to trace_path if enabled.
+        :return:
+        """
+        with open(self.report_path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        if self.sampler is not None:
+            self.sampler.write(self.trace_path)
+        logging.info(f"Profiling report written to {self.report_path}")
+
+    # Stop profiling
+    def stop(self):
+        """
+        Stops profiling and the sampler, then writes the report.
+        :return:
+        """
+        if not self.active:
+            return
+        self.active = False
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.write_report()
+
+
+# The profiler of the running process. Inactive unless started with start_profiling()
+profiler = Profiler()
+
+
+# Configure and start the profiler of the running process
+def start_profiling(budget=None, top=10, report_path="profile.json", trace_path=None, sample_interval=0.005):
+    """
+    Configures and starts the profiler of the running process. See Profiler.
+    :param budget: Seconds a single Automation evaluation may take before it is flagged as slow
+    :param top: Number of Automations, Entities and cycles listed in the report
+    :param report_path: Path of the JSON report
+    :param trace_path: Path of the sampling trace, or None to not sample
+    :param sample_interval: Seconds between stack samples of the trace
+    :return: The started Profiler
+    """
+    profiler.budget = budget
+    profiler.top = top
+    profiler.report_path = report_path
+    profiler.trace_path = trace_path
+    profiler.sample_interval = sample_interval
+    profiler.start()
+    return profiler
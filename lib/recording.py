@@ -0,0 +1,205 @@
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+
+# Magic bytes starting every traffic log, followed by the format version
+LOG_MAGIC = b'HATRAFIC'
+LOG_VERSION = 1
+log_header = struct.Struct('<8sI')
+
+# Record header: kind, timestamp in seconds since the epoch, Entity id and length of the data following the header
+record_header = struct.Struct('<BdII')
+
+# Record kinds. An ENTITY record assigns an id to the Entity name in its data, a MESSAGE record holds the JSON payload
+# received by an Entity
+ENTITY_RECORD = 0
+MESSAGE_RECORD = 1
+
+
+# Iterates over the records of a traffic log buffer as (kind, timestamp, entity id, data, end offset) tuples. A record
+# cut short, e.g: by a crash while it was written, ends the log.
+def read_records(buffer):
+    if len(buffer) < log_header.size:
+        return
+    magic, version = log_header.unpack_from(buffer, 0)
+    if magic != LOG_MAGIC or version != LOG_VERSION:
+        raise ValueError(f"Not a version {LOG_VERSION} traffic log")
+    offset = log_header.size
+    while offset + record_header.size <= len(buffer):
+        kind, timestamp, entity_id, length = record_header.unpack_from(buffer, offset)
+        end = offset + record_header.size + length
+        if end > len(buffer):
+            return
+        yield kind, timestamp, entity_id, buffer[offset + record_header.size:end], end
+        offset = end
+
+
+# A class reading a traffic log
+class TrafficLog:
+    """
+    The TrafficLog class reads a traffic log written by a TrafficRecorder. The file is memory-mapped, so records are
+    decoded as they are iterated without loading the log into memory.
+    ...
+
+    Attributes
+    ----------
+        path: str
+            Path of the traffic log
+
+    Methods
+    -------
+        messages(self, raw=False): Iterates over the recorded messages.
+        entity_ids(self): Returns the Entity ids assigned in the log and the end of its last complete record.
+        close(self): Unmaps the log.
+    """
+
+    def __init__(self, path):
+        """
+        Opens a traffic log
+        :param path: Path of the traffic log
+        """
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # Empty files cannot be mapped
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Iterate over the recorded messages
+    def messages(self, raw=False):
+        """
+        Iterates over the recorded messages in the order they were received.
+        :param raw: Whether to yield the JSON payloads as bytes instead of parsing them, e.g: to let
+                    Entity.update_state() decode them
+        :return: Iterator of (timestamp, entity name, payload) tuples
+        """
+        names = {}
+        for kind, timestamp, entity_id, data, _ in read_records(self.buffer):
+            if kind == ENTITY_RECORD:
+                names[entity_id] = data.decode()
+            elif kind == MESSAGE_RECORD:
+                yield timestamp, names[entity_id], data if raw else json.loads(data)
+
+    # Entity ids assigned in the log
+    def entity_ids(self):
+        """
+        Returns the Entity ids assigned in the log and the offset following its last complete record, so that a
+        TrafficRecorder can append to it.
+        :return: ({entity name: id}, offset)
+        """
+        ids = {}
+        offset = 0
+        for kind, _, entity_id, data, end in read_records(self.buffer):
+            if kind == ENTITY_RECORD:
+                ids[data.decode()] = entity_id
+            offset = end
+        return ids, offset
+
+    # Unmap the log
+    def close(self):
+        """
+        Unmaps and closes the log.
+        :return:
+        """
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+
+# A class recording the messages received by Entities
+class TrafficRecorder:
+    """
+    The TrafficRecorder class appends the messages received by Entities to a compact, append-only binary traffic log,
+    replayed by lib.replay. Each message is a fixed size header holding its timestamp and a small Entity id, followed by
+    its JSON payload. Entity names are written once, the first time an Entity is recorded. Appending to an existing log
+    continues its Entity ids.
+    ...
+
+    Attributes
+    ----------
+        path: str
+            Path of the traffic log
+        ids: dict
+            Ids assigned to Entity names
+        recorded: int
+            Number of messages recorded
+
+    Methods
+    -------
+        record(self, entity, message): Appends a message received by an Entity.
+        flush(self): Writes the buffered records to the file.
+        close(self): Flushes and closes the log.
+    """
+
+    def __init__(self, path):
+        """
+        Opens a traffic log for appending, creating it if needed
+        :param path: Path of the traffic log
+        """
+        self.path = path
+        self.ids = {}
+        self.recorded = 0
+        # Lock serializing records, since Entities receive messages on their subscriber threads
+        self.lock = threading.Lock()
+
+        offset = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with TrafficLog(path) as log:
+                self.ids, offset = log.entity_ids()
+        self.file = open(path, 'r+b' if offset else 'wb')
+        if offset:
+            # Drop a record cut short by a crash
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        else:
+            self.file.write(log_header.pack(LOG_MAGIC, LOG_VERSION))
+
+    # Append a message
+    def record(self, entity, message):
+        """
+        Appends a message received by an Entity to the log. Meant to be called by Entity.receive().
+        :param entity: The Entity receiving the message
+        :param message: Dictionary containing the message
+        :return:
+        """
+        data = json.dumps(message, separators=(',', ':')).encode()
+        timestamp = time.time()
+        with self.lock:
+            # Messages may still arrive after the log was closed on exit
+            if self.file.closed:
+                return
+            entity_id = self.ids.get(entity.name)
+            if entity_id is None:
+                entity_id = self.ids[entity.name] = len(self.ids)
+                name = entity.name.encode()
+                self.file.write(record_header.pack(ENTITY_RECORD, timestamp, entity_id, len(name)) + name)
+            self.file.write(record_header.pack(MESSAGE_RECORD, timestamp, entity_id, len(data)) + data)
+            self.recorded += 1
+
+    # Write buffered records
+    def flush(self):
+        """
+        Writes the buffered records to the file.
+        :return:
+        """
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+
+    # Close the log
+    def close(self):
+        """
+        Flushes and closes the log.
+        :return:
+        """
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
@@ -0,0 +1,341 @@
+import logging
+import threading
+
+from .automation import is_attribute, is_aggregate, is_condition_group, is_time_condition, source_attribute
+from .cache import serialize_model
+from .connection import start_connections, prune_connections
+from .entity import detached_construction
+
+
+# Compares the definitions of two models by name
+def diff_definitions(old_data, new_data):
+    """
+    Compares the plain data definitions of two models, as produced by lib.cache.serialize_model(), by Broker, Entity
+    and Automation name.
+    :param old_data: Definition of the live model
+    :param new_data: Definition of the new model
+    :return: Dictionary {'brokers'|'entities'|'automations': {'added'|'removed'|'changed'|'unchanged': [names]}}
+    """
+    diff = {}
+    for category in ('brokers', 'entities', 'automations'):
+        old = {item['name']: item for item in old_data[category]}
+        new = {item['name']: item for item in new_data[category]}
+        diff[category] = {
+            'added': [name for name in new if name not in old],
+            'removed': [name for name in old if name not in new],
+            'changed': [name for name in new if name in old and new[name] != old[name]],
+            'unchanged': [name for name in new if name in old and new[name] == old[name]]
+        }
+    return diff
+
+
+# Returns the names of the Entities an Automation reads or writes
+def automation_entities(automation):
+    names = {action.attribute.parent.name for action in automation.actions}
+
+    # Walk the condition tree collecting the Entities of Attribute operands
+    nodes = [automation.condition]
+    while nodes:
+        node = nodes.pop()
+        if is_condition_group(node):
+            nodes += [node.r1, node.r2]
+        # Time conditions read no Entity
+        elif not is_time_condition(node):
+            names.update(source_attribute(operand).parent.name for operand in (node.operand1, node.operand2)
+                         if is_attribute(operand))
+    return names
+
+
+# Points an Automation's condition and actions to the Attributes of the given Entities
+def rebind_automation(automation, entities):
+    """
+    Replaces the Attribute references in an Automation's condition and actions with the same named Attributes of the
+    given Entities. Used to bind Automations of a newly parsed model to the live Entities that were carried forward.
+    :param automation: Automation object
+    :param entities: Dictionary {entity_name: Entity}
+    :return:
+    """
+    def live_attribute(attribute):
+        return entities[attribute.parent.name].attributes_dict[attribute.name]
+
+    nodes = [automation.condition]
+    while nodes:
+        node = nodes.pop()
+        if is_condition_group(node):
+            nodes += [node.r1, node.r2]
+        elif not is_time_condition(node):
+            for operand in (node.operand1, node.operand2):
+                if is_aggregate(operand):
+                    operand.attribute = live_attribute(operand.attribute)
+            if is_attribute(node.operand1) and not is_aggregate(node.operand1):
+                node.operand1 = live_attribute(node.operand1)
+            if is_attribute(node.operand2) and not is_aggregate(node.operand2):
+                node.operand2 = live_attribute(node.operand2)
+    for action in automation.actions:
+        action.attribute = live_attribute(action.attribute)
+
+
+# Detaches an Automation from the runtime
+def retire_automation(automation):
+    # Disable it, in case it is still waiting in a scheduler queue
+    automation.enabled = False
+    # Stop Attribute updates from scheduling it
+    for attribute in automation.dependencies:
+        if automation in attribute.automations:
+            attribute.automations.remove(automation)
+    # Cancel its deferred trigger and the timers of its time conditions
+    if automation.wake is not None:
+        automation.wake.cancel()
+    nodes = [automation.condition]
+    while nodes:
+        node = nodes.pop()
+        if is_condition_group(node):
+            nodes += [node.r1, node.r2]
+        elif is_time_condition(node):
+            node.stop()
+        else:
+            for operand in (node.operand1, node.operand2):
+                if is_aggregate(operand):
+                    operand.stop()
+
+
+# Applies a newly loaded model to the live model
+def apply_reload(live, live_data, new_model, new_data, bridge=None):
+    """
+    Updates the live model in place to match a newly loaded model, only touching what changed:
+        - Brokers, Entities and Automations are matched by name and compared by definition.
+        - Unchanged Entities of unchanged Brokers are carried forward, keeping their Attribute values and connection
+          registration. The Entities of the new model replacing them are discarded.
+        - The new model's other Entities are attached: their Attributes get state store slots and they register with
+          their connections. They must have been created detached, see ModelReloader.load().
+        - Unchanged Automations whose Entities were all carried forward keep their compiled conditions and enabled
+          state. Other Automations of the new model are bound to the live Entities and their conditions are built.
+        - Removed and replaced Entities are unregistered from their connections and their state slots are released.
+          Connections left without Entities are stopped and new or changed ones are started, while connections of
+          unchanged Brokers are reused.
+    :param live: The live model. Keeps its identity, so runtime state attached to it (scheduler, dispatcher) remains
+    :param live_data: Definition of the live model, as produced by lib.cache.serialize_model()
+    :param new_model: Newly parsed or restored model
+    :param new_data: Definition of the new model
+    :param bridge: Optional bridge set on the connections before starting them. See BrokerConnection.
+    :return: The diff of the two definitions. See diff_definitions()
+    """
+    diff = diff_definitions(live_data, new_data)
+    unchanged_brokers = set(diff['brokers']['unchanged'])
+    # Entities are only carried forward if their Broker is unchanged too
+    entity_brokers = {entity['name']: entity['broker'] for entity in new_data['entities']}
+    unchanged_entities = {name for name in diff['entities']['unchanged'] if entity_brokers[name] in unchanged_brokers}
+    unchanged_automations = set(diff['automations']['unchanged'])
+
+    # Brokers: keep the live objects of unchanged Brokers
+    live_brokers = {broker.name: broker for broker in live.brokers}
+    brokers = [live_brokers[broker.name] if broker.name in unchanged_brokers else broker
+               for broker in new_model.brokers]
+
+    # Entities: carry forward unchanged Entities and discard the new objects replacing them
+    entities = []
+    for entity in new_model.entities:
+        if entity.name in unchanged_entities:
+            entities.append(live.entities_dict[entity.name])
+        else:
+            entity.parent = live
+            entities.append(entity)
+    entities_dict = {entity.name: entity for entity in entities}
+
+    # Detach the live Entities that were removed or replaced, then attach the new ones, so that a topic never has
+    # both the replaced and the replacing Entity
+    for entity in live.entities:
+        if entities_dict.get(entity.name) is not entity:
+            entity.detach()
+    for entity in entities:
+        if entity.connection is None:
+            entity.attach()
+
+    # Automations: keep unchanged Automations whose Entities were all carried forward
+    live_automations = {automation.name: automation for automation in live.automations}
+    automations = []
+    rebuilt = []
+    for automation in new_model.automations:
+        if automation.name in unchanged_automations and \
+                automation_entities(live_automations[automation.name]) <= unchanged_entities:
+            automations.append(live_automations.pop(automation.name))
+        else:
+            automation.parent = live
+            rebind_automation(automation, entities_dict)
+            automation.build_condition()
+            logging.debug(f"{automation.name} condition: {automation.condition.cond_lambda}")
+            automations.append(automation)
+            rebuilt.append(automation)
+
+    # Retire the live Automations that were removed or replaced
+    for automation in live_automations.values():
+        retire_automation(automation)
+
+    # Swap the live model's contents
+    live.brokers = brokers
+    live.entities = entities
+    live.entities_dict = entities_dict
+    live.automations = automations
+
+    # Drop unused connections and start new ones, restarting the ones whose topics changed
+    prune_connections()
+    start_connections(bridge=bridge)
+
+    # Evaluate the new Automations in event-driven mode
+    scheduler = getattr(live, 'scheduler', None)
+    if scheduler is not None:
+        scheduler.schedule(rebuilt)
+
+    return diff
+
+
+# A class receiving models from the Node-RED integration and applying them to the running model
+class ModelReloader:
+    """
+    The ModelReloader class receives configuration models, e.g: from the Node-RED integration subscriber which keeps
+    running for the lifetime of HA-Auto. The first model is handed to the runtime to start, while later models are
+    loaded from memory and applied incrementally to the live model using apply_reload(). Loading a model has no effect
+    on the live model: its Entities are created detached and only attached when the model is applied.
+    ...
+
+    Attributes
+    ----------
+        loader: ModelLoader or textX metamodel
+            Object used to load models with model_from_str()
+        lock: threading.Lock
+            Lock held while a model is received or applied. The threaded runtime holds it while evaluating a cycle
+        model: textX model
+            The live model. Set by attach()
+        data: dict
+            Definition of the live model, as produced by lib.cache.serialize_model()
+        save_path: str
+            Optional path where received models are saved. e.g: 'config/config_remote.model'
+        bridge: callable
+            Optional bridge set on the connections started by a reload. See BrokerConnection.
+        on_apply: callable
+            Optional function called with the live model after a model is applied, while the lock is held. e.g: to
+            restart shard workers
+
+    Methods
+    -------
+        receive(self, data): Subscriber callback receiving a model.
+        wait(self): Blocks until the first model is received and returns it.
+        attach(self, model, model_str, data=None): Sets the live model later models are applied to.
+        load(self, model_str): Loads a model, logging errors.
+        apply(self, new_model): Applies a loaded model to the live model.
+        reload(self, model_str): Loads a model and applies it to the live model.
+    """
+
+    def __init__(self, loader, save_path=None, bridge=None):
+        """
+        Creates and returns a ModelReloader object
+        :param loader: Object used to load models with model_from_str(). e.g: ModelLoader
+        :param save_path: Optional path where received models are saved
+        :param bridge: Optional bridge set on the connections started by a reload
+        """
+        self.loader = loader
+        self.save_path = save_path
+        self.bridge = bridge
+        self.lock = threading.Lock()
+        self.model = None
+        self.data = None
+        # Latest model received before a live model was attached
+        self.received_model = None
+        self.received = threading.Event()
+        self.on_apply = None
+
+    # Subscriber callback receiving a model
+    def receive(self, data):
+        """
+        Callback used by the Node-RED integration subscriber. Models received before the live model is attached are
+        handed to wait(), later models are applied to the live model.
+        :param data: Dictionary containing the model source under 'config'
+        :return:
+        """
+        logging.info("Configuration Received")
+        model_str = data["config"]
+        if self.save_path is not None:
+            with open(self.save_path, 'w') as f:
+                f.write(model_str)
+        with self.lock:
+            if self.model is None:
+                self.received_model = model_str
+                self.received.set()
+                return
+        self.reload(model_str)
+
+    # Wait for the first model
+    def wait(self):
+        """
+        Blocks until a model is received.
+        :return: The model source
+        """
+        self.received.wait()
+        return self.received_model
+
+    # Set the live model
+    def attach(self, model, model_str, data=None):
+        """
+        Sets the live model later models are applied to. Later models are compared with the model's definition as
+        loaded, so the definition must be taken before its runtime state (e.g: Automation enabled flags) changes. If a
+        different model was received in the meantime, it is applied right away.
+        :param model: The live model
+        :param model_str: Source of the live model
+        :param data: Definition of the model as loaded, from lib.cache.serialize_model(). Needed if the model's runtime
+            state changed since, e.g: flags restored from a state file. Defaults to the model's current definition
+        :return:
+        """
+        with self.lock:
+            self.data = serialize_model(model) if data is None else data
+            self.model = model
+            received_model = self.received_model
+        if received_model is not None and received_model != model_str:
+            self.reload(received_model)
+
+    # Load a model
+    def load(self, model_str):
+        """
+        Loads a model from memory. Errors in the model are logged. The model's Entities are created detached, so
+        loading neither registers them with the live connections nor allocates state store slots, and can run on any
+        thread. A model that fails to load leaves nothing behind.
+        :param model_str: Model source
+        :return: The loaded model, or None if it could not be loaded
+        """
+        try:
+            with detached_construction():
+                return self.loader.model_from_str(model_str)
+        except Exception:
+            logging.error("Received configuration could not be loaded. Keeping the running configuration",
+                          exc_info=True)
+            return None
+
+    # Apply a loaded model to the live model
+    def apply(self, new_model):
+        """
+        Applies a loaded model to the live model and logs a summary of the changes.
+        :param new_model: Model returned by load()
+        :return: The diff of the live and the new model. See diff_definitions()
+        """
+        new_data = serialize_model(new_model)
+        with self.lock:
+            diff = apply_reload(self.model, self.data, new_model, new_data, bridge=self.bridge)
+            self.data = new_data
+            if self.on_apply is not None:
+                self.on_apply(self.model)
+        logging.info("Configuration reloaded: " + ", ".join(
+            f"{category} +{len(changes['added'])} ~{len(changes['changed'])} -{len(changes['removed'])}"
+            for category, changes in diff.items()))
+        return diff
+
+    # Load a model and apply it to the live model
+    def reload(self, model_str):
+        """
+        Loads a model from memory and applies it to the live model. A model that cannot be loaded leaves the live
+        model untouched.
+        :param model_str: The new model source
+        :return: The diff of the live and the new model, or None if the new model could not be loaded
+        """
+        new_model = self.load(model_str)
+        if new_model is None:
+            return None
+        return self.apply(new_model)
@@ -0,0 +1,408 @@
+# Replays traffic logs recorded by lib.recording against a model, without a broker. Run it as a module, e.g:
+# python -m lib.replay run lang/full_metamodel.tx config/config_local.model traffic.log --speed 10 --out run.json
+# python -m lib.replay compare run.json baseline.json
+
+import json
+import math
+import time
+import itertools
+from collections import Counter
+
+import click
+from commlib.endpoints import EndpointType
+
+from .automation import Automation, List, Dict, Action, IntAction, FloatAction, StringAction, BoolAction
+from .broker import Broker, MQTTBroker, AMQPBroker, RedisBroker, BrokerAuthPlain
+from .entity import Entity, Attribute, IntAttribute, FloatAttribute, StringAttribute, BoolAttribute, ListAttribute, \
+    DictAttribute
+from .cache import ModelLoader, DEFAULT_CACHE_DIR
+from .connection import set_endpoint_factory, start_connections, clear_connections
+from .scheduler import Scheduler
+from .state import state_store
+from .timers import timers, TimeWindow, TimeAt, TimeDelay, TimeInterval
+from .aggregates import Aggregate
+from .vectorized import VectorEvaluator
+from .network import ConditionNetwork
+from .recording import TrafficLog
+
+
+# Stub of commlib-py's publishers passing published messages to the running replay instead of a broker
+class ReplayPublisher:
+    # Function receiving the published messages as sink(topic, message). Set by ReplayDriver
+    sink = None
+
+    def __init__(self, topic=None, conn_params=None, **kwargs):
+        self.topic = topic
+
+    # MPublisher style publishing takes the topic as an argument
+    def publish(self, msg, topic=None):
+        ReplayPublisher.sink(self.topic if topic is None else topic, msg)
+
+
+# Stub of commlib-py's subscribers. Replayed messages are passed to the Entities directly
+class ReplaySubscriber:
+    def __init__(self, **kwargs):
+        pass
+
+    def run(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+# Endpoint factory returning the replay stubs. See lib.connection.set_endpoint_factory()
+def replay_endpoint_factory(etype, etransport):
+    if etype in (EndpointType.Publisher, EndpointType.MPublisher):
+        return ReplayPublisher
+    return ReplaySubscriber
+
+
+# A class replaying recorded Entity traffic against a model
+class ReplayDriver:
+    """
+    The ReplayDriver class feeds the messages of a traffic log to the Entities of a model and evaluates its
+    Automations like the runtime would, while the model's publishers are stubbed. Messages are replayed at the speed
+    they were recorded, a multiple of it, or as fast as possible. Actions are published synchronously, so every action
+    is attributed to the message that caused it.
+    ...
+
+    Attributes
+    ----------
+        model: textX model
+            The model replayed against. Its connections must use the replay stubs. Its conditions are rebuilt by run()
+        speed: float
+            Replay speed relative to the recorded traffic. e.g: 1 replays in real time, 10 ten times faster. 0 replays
+            as fast as possible
+        eval_mode: str
+            "Event" to evaluate the Automations reading the Attributes changed by each message, or "Polling" to
+            evaluate all Automations every poll_interval seconds of recorded time
+        eval_backend: str
+            "Scalar", "Vectorized" or "Network". See main.py
+        poll_interval: float
+            Seconds of recorded time between evaluation cycles in "Polling" mode
+        actions: list
+            Published actions as (message index, topic, message) tuples. The index is the number of messages replayed
+            before the action
+        now: float
+            Replayed time, returned by the timer wheel's clocks during run()
+        next_poll: float
+            Replayed time of the next cycle in "Polling" mode
+
+    Methods
+    -------
+        advance(self, timestamp, evaluator): Fires the timers due up to a replayed time.
+        run(self, messages): Replays messages and returns the report.
+    """
+
+    def __init__(self, model, speed=0, eval_mode="Event", eval_backend="Scalar", poll_interval=1):
+        """
+        Creates and returns a ReplayDriver object
+        :param model: The model to replay against
+        :param speed: Replay speed relative to the recorded traffic, or 0 to replay as fast as possible
+        :param eval_mode: "Event" or "Polling"
+        :param eval_backend: "Scalar", "Vectorized" or "Network"
+        :param poll_interval: Seconds of recorded time between evaluation cycles in "Polling" mode
+        """
+        self.model = model
+        self.speed = speed
+        self.eval_mode = eval_mode
+        self.eval_backend = eval_backend
+        self.poll_interval = poll_interval
+        self.actions = []
+        self.index = 0
+        self.evaluations = 0
+        self.evaluation_errors = 0
+        self.triggers = Counter()
+        self.now = self.next_poll = None
+
+    # Receive a published action
+    def publish(self, topic, message):
+        self.actions.append((self.index, topic, message))
+
+    # Evaluate Automations and run the actions of the triggered ones. Conditions raising an exception, e.g: because
+    # the Attributes they read have not been received yet, are counted instead of stopping the replay
+    def evaluate(self, results):
+        for automation, result in results:
+            self.evaluations += 1
+            try:
+                triggered, _ = automation.evaluate(result)
+            except Exception:
+                self.evaluation_errors += 1
+                continue
+            if triggered:
+                self.triggers[automation.name] += 1
+                automation.trigger()
+
+    # Run an evaluation cycle on a snapshot of the replayed state
+    def cycle(self, evaluator):
+        state_store.snapshot()
+        if self.eval_mode == "Event":
+            automations = []
+            automation = self.model.scheduler.next(timeout=0)
+            while automation is not None:
+                automations.append(automation)
+                automation = self.model.scheduler.next(timeout=0)
+            if evaluator is not None:
+                evaluator.update()
+                self.evaluate((automation, evaluator.result(automation)) for automation in automations)
+            else:
+                self.evaluate((automation, None) for automation in automations)
+        elif evaluator is not None:
+            self.evaluate(evaluator.evaluate())
+        else:
+            self.evaluate((automation, None) for automation in self.model.automations)
+
+    # Fire the timers due before a replayed time, like the evaluation loop waiting for them: in "Event" mode a cycle
+    # runs at every deadline firing timers, in "Polling" mode at the first poll after it. The wheel is then advanced to
+    # the time, so the next cycle sees the timers due up to it
+    def advance(self, timestamp, evaluator):
+        while True:
+            wait = timers.timeout(self.now)
+            if wait is None:
+                break
+            due = self.now + max(wait, timers.resolution)
+            if self.eval_mode != "Event":
+                polls = max(math.ceil((due - self.next_poll) / self.poll_interval), 0)
+                due = self.next_poll + polls * self.poll_interval
+            if due >= timestamp:
+                break
+            self.now = due
+            if timers.advance(due):
+                if self.eval_mode != "Event":
+                    self.next_poll = due + self.poll_interval
+                self.cycle(evaluator)
+        self.now = max(self.now, timestamp)
+        timers.advance(self.now)
+
+    # Replay messages
+    def run(self, messages):
+        """
+        Replays messages against the model, evaluating its Automations after every message in "Event" mode, or every
+        poll_interval seconds of recorded time in "Polling" mode. Messages to Entities missing from the model are
+        skipped, and messages the Entity cannot apply (e.g: payloads that are not JSON objects) are counted as errors.
+        Undeclared keys the Entities ignored and values they could not coerce are counted too. Conditions raising an
+        exception are counted as evaluation errors.
+        The timer wheel runs on the recorded time while replaying: both its clocks return the time of the message
+        being replayed, the conditions are rebuilt so that time conditions and Aggregates start at the first message,
+        and the wheel is advanced before every cycle. The wheel's timers are dropped once the replay ends.
+        :param messages: Iterable of (timestamp, entity name, payload) tuples. e.g: TrafficLog.messages()
+        :return: Report dictionary with the throughput, the evaluations, the triggers per Automation and the actions
+        """
+        messages = iter(messages)
+        head = next(messages, None)
+        if head is not None:
+            messages = itertools.chain((head,), messages)
+        # Replayed time, starting at the first message
+        self.now = self.next_poll = head[0] if head is not None else time.time()
+        clocks = timers.clock, timers.wall_clock
+        timers.clock = timers.wall_clock = lambda: self.now
+        try:
+            timers.restart(self.now)
+            for automation in self.model.automations:
+                automation.build_condition()
+            return self.replay(messages)
+        finally:
+            timers.clock, timers.wall_clock = clocks
+            timers.restart()
+
+    # Replay messages on the recorded time
+    def replay(self, messages):
+        ReplayPublisher.sink = self.publish
+        model = self.model
+        if self.eval_mode == "Event":
+            model.scheduler = Scheduler()
+            # The runtime evaluates all Automations once on start
+            model.scheduler.schedule(model.automations)
+        evaluator = None
+        if self.eval_mode != "Event" and self.eval_backend == "Vectorized":
+            evaluator = VectorEvaluator(model)
+        elif self.eval_backend == "Network":
+            evaluator = ConditionNetwork(model)
+
+        skipped = Counter()
+        errors = 0
+        first = last = None
+        start = time.perf_counter()
+        if self.eval_mode == "Event":
+            self.cycle(evaluator)
+        for timestamp, name, payload in messages:
+            if first is None:
+                first = timestamp
+            last = timestamp
+            # Wait until the message is due
+            if self.speed > 0:
+                delay = start + (timestamp - first) / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            # Timers due before the message, then the polling cycle due before it
+            self.advance(timestamp, evaluator)
+            if self.eval_mode != "Event" and timestamp >= self.next_poll:
+                self.cycle(evaluator)
+                self.next_poll += self.poll_interval * ((timestamp - self.next_poll) // self.poll_interval + 1)
+
+            entity = model.entities_dict.get(name)
+            if entity is None:
+                skipped[name] += 1
+                continue
+            try:
+                entity.update_state(payload)
+            except Exception:
+                errors += 1
+            self.index += 1
+            if self.eval_mode == "Event":
+                self.cycle(evaluator)
+        # Final polling cycle, evaluating the last messages
+        if self.eval_mode != "Event":
+            self.cycle(evaluator)
+        duration = time.perf_counter() - start
+
+        return {
+            'speed': self.speed,
+            'eval_mode': self.eval_mode,
+            'eval_backend': self.eval_backend,
+            'messages': self.index,
+            'skipped': dict(skipped),
+            'errors': errors,
+            'unknown_keys': sum(entity.decoder.unknown for entity in model.entities),
+            'mismatched_values': sum(entity.decoder.mismatched for entity in model.entities),
+            'recorded_duration_s': last - first if first is not None else 0.0,
+            'duration_s': duration,
+            'messages_per_s': self.index / duration if duration > 0 else None,
+            'evaluations': self.evaluations,
+            'evaluation_errors': self.evaluation_errors,
+            'triggers': dict(self.triggers),
+            'action_count': len(self.actions),
+            'actions_per_topic': dict(Counter(topic for _, topic, _ in self.actions)),
+            'actions': [list(action) for action in self.actions]
+        }
+
+
+# Compare the actions of two replays
+def compare_reports(report, baseline):
+    """
+    Compares the outcome of two replays of the same traffic log, e.g: of a new rule set or engine change against a
+    baseline.
+    :param report: Replay report. See ReplayDriver.run()
+    :param baseline: Replay report of the baseline
+    :return: Dictionary with whether the actions are identical, the number of leading actions both replays agree on,
+        the first diverging action of each replay along with the index of the message preceding it, and the
+        Automations and topics whose trigger or action counts differ as {name: [count, baseline count]}
+    """
+    actions, baseline_actions = report['actions'], baseline['actions']
+    matching = 0
+    while matching < min(len(actions), len(baseline_actions)) and actions[matching] == baseline_actions[matching]:
+        matching += 1
+
+    # Differences between two {name: count} dictionaries
+    def differences(counts, baseline_counts):
+        return {name: [counts.get(name, 0), baseline_counts.get(name, 0)]
+                for name in sorted(set(counts) | set(baseline_counts))
+                if counts.get(name, 0) != baseline_counts.get(name, 0)}
+
+    identical = matching == len(actions) == len(baseline_actions)
+    return {
+        'identical': identical,
+        'matching_actions': matching,
+        'first_divergence': None if identical else {
+            'action': actions[matching] if matching < len(actions) else None,
+            'baseline_action': baseline_actions[matching] if matching < len(baseline_actions) else None
+        },
+        'triggers': differences(report['triggers'], baseline['triggers']),
+        'actions_per_topic': differences(report['actions_per_topic'], baseline['actions_per_topic'])
+    }
+
+
+# Load a model and replay a traffic log against it
+def replay(metamodel_path, model_path, log_path, speed=0, eval_mode="Event", eval_backend="Scalar", poll_interval=1,
+           cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Loads a model with stubbed publishers and replays a traffic log against it.
+    :param metamodel_path: Grammar used to parse the model. e.g: 'lang/full_metamodel.tx'
+    :param model_path: Path of the model
+    :param log_path: Path of the traffic log
+    :param speed: Replay speed relative to the recorded traffic, or 0 to replay as fast as possible
+    :param eval_mode: "Event" or "Polling"
+    :param eval_backend: "Scalar", "Vectorized" or "Network"
+    :param poll_interval: Seconds of recorded time between evaluation cycles in "Polling" mode
+    :param cache_dir: Directory of the model cache, or None to always parse the model
+    :return: Replay report. See ReplayDriver.run()
+    """
+    set_endpoint_factory(replay_endpoint_factory)
+    clear_connections()
+    metamodel = ModelLoader(metamodel_path, classes=[Entity, Attribute, IntAttribute, FloatAttribute, StringAttribute,
+                                                     BoolAttribute, ListAttribute, DictAttribute, Broker, MQTTBroker,
+                                                     AMQPBroker, RedisBroker, BrokerAuthPlain, Automation, Action,
+                                                     IntAction, FloatAction, StringAction, BoolAction, List, Dict,
+                                                     TimeWindow, TimeAt, TimeDelay, TimeInterval, Aggregate],
+                            cache_dir=cache_dir)
+    model = metamodel.model_from_file(model_path)
+    model.entities_dict = {entity.name: entity for entity in model.entities}
+    # The conditions are built by the driver, on the recorded time
+    # Only the publishers are needed, messages come from the log
+    start_connections(subscribe=False)
+
+    driver = ReplayDriver(model, speed=speed, eval_mode=eval_mode, eval_backend=eval_backend,
+                          poll_interval=poll_interval)
+    with TrafficLog(log_path) as log:
+        report = driver.run(log.messages(raw=True))
+    report.update({'model': model_path, 'log': log_path})
+    return report
+
+
+# Main CLI Command Group
+@click.group()
+def cli():
+    pass
+
+
+# Replay
+@click.command()
+@click.argument('metamodel_in')
+@click.argument('model_in')
+@click.argument('log_in')
+@click.option('--speed', default=0.0, help="replay speed relative to the recording, e.g: 1 or 10. 0 for maximum speed")
+@click.option('--mode', default="Event", type=click.Choice(["Event", "Polling"]), help="evaluation mode")
+@click.option('--backend', default="Scalar", type=click.Choice(["Scalar", "Vectorized", "Network"]),
+              help="evaluation backend")
+@click.option('--poll-interval', default=1.0, help="seconds of recorded time between Polling evaluation cycles")
+@click.option('--compare', default="", help="report of a baseline replay to compare the actions with")
+@click.option('--out', default="", help="output JSON report. Prints a summary if not set")
+@click.option('--cache-dir', default=DEFAULT_CACHE_DIR, help="model cache directory, empty to disable caching")
+def run(metamodel_in, model_in, log_in, speed, mode, backend, poll_interval, compare, out, cache_dir):
+    """
+    Replays a traffic log against a model and reports the throughput, the triggers and the actions.
+    """
+    report = replay(metamodel_in, model_in, log_in, speed=speed, eval_mode=mode, eval_backend=backend,
+                    poll_interval=poll_interval, cache_dir=cache_dir or None)
+    if compare:
+        with open(compare) as f:
+            report['divergence'] = compare_reports(report, json.load(f))
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    summary = {key: value for key, value in report.items() if key != 'actions'}
+    click.echo(json.dumps(summary, indent=2))
+
+
+# Comparison of two saved replay reports
+@click.command(name='compare')
+@click.argument('report_in')
+@click.argument('baseline_in')
+def compare_command(report_in, baseline_in):
+    """
+    Compares the actions of two saved replay reports.
+    """
+    with open(report_in) as f:
+        report = json.load(f)
+    with open(baseline_in) as f:
+        baseline = json.load(f)
+    click.echo(json.dumps(compare_reports(report, baseline), indent=2))
+
+
+cli.add_command(run)
+cli.add_command(compare_command)
+
+# CLI Utility Entry Point
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,77 @@
+import queue
+import threading
+
+
+# A class scheduling Automations for evaluation when the Attributes they depend on change
+class Scheduler:
+    """
+    The Scheduler class implements event-driven Automation evaluation. Entities schedule the Automations that read
+    their updated Attributes and the evaluation loop blocks until an Automation is scheduled, so no work is done while
+    the system is idle.
+    ...
+
+    Attributes
+    ----------
+        queue: queue.Queue
+            FIFO queue of Automations waiting to be evaluated
+        pending: set
+            Set of the Automations currently in the queue. Used so that an Automation is queued at most once
+        lock: threading.Lock
+            Lock guarding pending, since Entities schedule Automations from their subscriber threads
+
+    Methods
+    -------
+        schedule(self, automations): Queues the given Automations for evaluation unless they are already queued.
+        next(self, timeout=None): Blocks until an Automation is scheduled and returns it.
+        wake(self): Makes a blocked next() return None.
+    """
+
+    def __init__(self):
+        """
+        Creates and returns a Scheduler object
+        """
+        # Queue of Automations waiting to be evaluated
+        self.queue = queue.Queue()
+        # Automations currently in the queue
+        self.pending = set()
+        # Lock guarding pending
+        self.lock = threading.Lock()
+
+    # Queue Automations for evaluation
+    def schedule(self, automations):
+        """
+        Queues the given Automations for evaluation. Automations that are already waiting in the queue are skipped,
+        since a single evaluation will see all updates that happened up to that point.
+        :param automations: Iterable of Automation objects
+        :return:
+        """
+        with self.lock:
+            for automation in automations:
+                if automation not in self.pending:
+                    self.pending.add(automation)
+                    self.queue.put(automation)
+
+    # Get the next Automation to be evaluated
+    def next(self, timeout=None):
+        """
+        Blocks until an Automation is scheduled and returns it.
+        :param timeout: Maximum number of seconds to wait. None waits forever.
+        :return: The next Automation to evaluate, or None if the timeout expired
+        """
+        try:
+            automation = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        # Remove from pending before evaluation so that updates arriving during evaluation schedule it again
+        with self.lock:
+            self.pending.discard(automation)
+        return automation
+
+    # Wake up the evaluation loop
+    def wake(self):
+        """
+        Makes the evaluation loop blocked in next() return None without an Automation, e.g: to apply the messages of
+        an ingestion queue, which schedule the Automations reading the updated Attributes.
+        :return:
+        """
+        self.queue.put(None)
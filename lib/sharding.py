@@ -0,0 +1,433 @@
+import logging
+import math
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+
+from .automation import is_attribute, is_aggregate, is_condition_group, is_time_condition, source_attribute
+from .cache import serialize_model, restore_model
+from .connection import start_connections
+from .dispatcher import Dispatcher
+from .events import start_event_log
+from .network import ConditionNetwork
+from .scheduler import Scheduler
+from .state import state_store
+from .timers import timers
+from .vectorized import VectorEvaluator
+
+
+# Returns the Attribute and Aggregate operands of an Automation's condition
+def condition_operands(automation):
+    operands = []
+    nodes = [automation.condition]
+    while nodes:
+        node = nodes.pop()
+        if is_condition_group(node):
+            nodes += [node.r1, node.r2]
+        # Time conditions read no Entity
+        elif not is_time_condition(node):
+            operands += [operand for operand in (node.operand1, node.operand2) if is_attribute(operand)]
+    return operands
+
+
+# Returns the names of the Entities read by an Automation's condition
+def condition_entities(automation):
+    return {source_attribute(operand).parent.name for operand in condition_operands(automation)}
+
+
+# Returns the names of the Entities whose Attributes an Automation's condition aggregates
+def aggregated_entities(automation):
+    return {operand.attribute.parent.name for operand in condition_operands(automation) if is_aggregate(operand)}
+
+
+# Partitions Automations into shards using the Entities they read
+def partition_automations(automations, shards):
+    """
+    Partitions Automations into shards of similar size, placing Automations that read the same Entities together so
+    that each Entity update is forwarded to as few shards as possible. Automations connected through the Entities
+    they read form components, which are placed whole on the least loaded shard, largest first. A component too large
+    for the room left is split, placing each of its Automations on the shard already reading most of its Entities.
+    :param automations: List of Automation objects
+    :param shards: Number of shards
+    :return: List of shards, each a list of Automation objects
+    """
+    # Union-find over Entity names. Automations reading no Entity get a component of their own
+    parents = {}
+
+    def find(name):
+        while parents[name] != name:
+            parents[name] = parents[parents[name]]
+            name = parents[name]
+        return name
+
+    reads = []
+    for automation in automations:
+        names = condition_entities(automation) or {('automation', automation.name)}
+        reads.append(names)
+        roots = {find(parents.setdefault(name, name)) for name in names}
+        root = roots.pop()
+        for other in roots:
+            parents[other] = root
+
+    components = {}
+    for automation, names in zip(automations, reads):
+        components.setdefault(find(next(iter(names))), []).append((automation, names))
+
+    capacity = math.ceil(len(automations) / shards) if automations else 0
+    partition = [[] for _ in range(shards)]
+    shard_entities = [set() for _ in range(shards)]
+
+    def place(index, automation, names):
+        partition[index].append(automation)
+        shard_entities[index].update(names)
+
+    for component in sorted(components.values(), key=len, reverse=True):
+        index = min(range(shards), key=lambda i: len(partition[i]))
+        if len(partition[index]) + len(component) <= capacity:
+            for automation, names in component:
+                place(index, automation, names)
+            continue
+        # Split the component
+        for automation, names in component:
+            candidates = [i for i in range(shards) if len(partition[i]) < capacity] or range(shards)
+            index = max(candidates, key=lambda i: (len(names & shard_entities[i]), -len(partition[i])))
+            place(index, automation, names)
+    return partition
+
+
+# Entry point of a shard worker process
+def run_shard(data, names, channel, run_automation, eval_mode="Polling", eval_backend="Scalar", poll_interval=1,
+              dispatch_async=True, dispatch_queue_size=1000, dispatch_overflow='drop_oldest', event_log=None):
+    """
+    Evaluates the Automations of a shard. The model is restored from its plain data, keeping only the shard's
+    Automations, and its Broker connections only publish. Entity updates are received from the main process as batches
+    of (entity index, message) pairs and applied with Entity.update_state(). None stops the worker.
+    :param data: Plain data of the model, as produced by lib.cache.serialize_model()
+    :param names: Names of the shard's Automations
+    :param channel: Receiving end of the pipe from the main process
+    :param run_automation: Function evaluating an Automation and running its actions, called as
+        run_automation(automation, result). e.g: main.run_automation
+    :param eval_mode: "Event" or "Polling"
+    :param eval_backend: "Scalar", "Vectorized" or "Network"
+    :param poll_interval: Seconds between evaluation cycles in "Polling" mode
+    :param dispatch_async: Whether actions are published through a Dispatcher
+    :param dispatch_queue_size: Maximum number of queued messages per Broker
+    :param dispatch_overflow: Policy used when a Broker's queue is full
+    :param event_log: Arguments of start_event_log() for the worker's event log, or None to only keep its ring buffer
+    :return:
+    """
+    if event_log is not None:
+        start_event_log(**event_log)
+    model = restore_model(data)
+    model.entities_dict = {entity.name: entity for entity in model.entities}
+    names = set(names)
+    model.automations = [automation for automation in model.automations if automation.name in names]
+    start_connections(subscribe=False)
+    for automation in model.automations:
+        automation.build_condition()
+    if dispatch_async:
+        model.dispatcher = Dispatcher(maxsize=dispatch_queue_size, overflow=dispatch_overflow)
+
+    evaluator = None
+    if eval_backend == "Vectorized" and eval_mode != "Event":
+        evaluator = VectorEvaluator(model)
+    elif eval_backend == "Network":
+        evaluator = ConditionNetwork(model)
+    if eval_mode == "Event":
+        model.scheduler = Scheduler()
+        model.scheduler.schedule(model.automations)
+
+    # Apply a batch of Entity updates. Returns False when the worker has to stop
+    def apply(batch):
+        if batch is None:
+            return False
+        for index, message in batch:
+            model.entities[index].update_state(message)
+        return True
+
+    # Evaluation cycle, reading a snapshot of the applied batches. Due timers set the time conditions they change first
+    def cycle():
+        timers.advance()
+        state_store.snapshot()
+        if eval_mode == "Event":
+            if evaluator is not None:
+                evaluator.update()
+            automation = model.scheduler.next(timeout=0)
+            while automation is not None:
+                run_automation(automation, evaluator.result(automation) if evaluator is not None else None)
+                automation = model.scheduler.next(timeout=0)
+        elif evaluator is not None:
+            for automation, result in evaluator.evaluate():
+                run_automation(automation, result)
+        else:
+            for automation in model.automations:
+                run_automation(automation)
+        if dispatch_async:
+            model.dispatcher.flush()
+
+    try:
+        if eval_mode == "Event":
+            # Evaluate the scheduled Automations after every group of batches, and when a timer is due. The first
+            # batch holds the initial state
+            if not apply(channel.recv()):
+                return
+            while True:
+                while channel.poll():
+                    if not apply(channel.recv()):
+                        return
+                cycle()
+                channel.poll(timers.timeout())
+        else:
+            # Apply batches as they arrive, evaluating all Automations every poll_interval seconds. The first batch
+            # holds the initial state
+            if not apply(channel.recv()):
+                return
+            next_cycle = time.monotonic()
+            while True:
+                timeout = next_cycle - time.monotonic()
+                if timeout > 0 and channel.poll(timeout):
+                    if not apply(channel.recv()):
+                        return
+                    continue
+                cycle()
+                next_cycle = max(next_cycle + poll_interval, time.monotonic())
+    except (EOFError, KeyboardInterrupt):
+        return
+    finally:
+        if dispatch_async:
+            model.dispatcher.stop()
+
+
+# A class running Automations in worker processes
+class ShardRouter:
+    """
+    The ShardRouter class spreads the evaluation of a model's Automations over worker processes, so that evaluation is
+    not limited to a single core by the GIL. Automations are partitioned by the Entities they read (see
+    partition_automations()). The main process keeps receiving Entity messages and forwards the ones that changed an
+    Entity to the workers whose Automations read it, in batches over one pipe per worker. Workers whose Automations
+    aggregate an Entity receive all of its messages, since a repeated value is still a sample of the aggregates. Each
+    worker evaluates its Automations and publishes their actions over its own Broker connections.
+    ...
+
+    Attributes
+    ----------
+        model: textX model
+            The model whose Automations are evaluated. Its Entities call route() when their state changes
+        shards: int
+            Number of worker processes
+        run_automation: callable
+            Function evaluating an Automation and running its actions in the workers. Must be importable by the worker
+            processes, e.g: main.run_automation
+        settings: dict
+            Evaluation and dispatch settings passed to the workers. See run_shard()
+        processes: list
+            The worker processes
+        routes: dict
+            Indices of the shards reading each Entity {entity: [shard_index]}
+        aggregated: dict
+            Indices of the shards aggregating each Entity's Attributes {entity: [shard_index]}
+        forwarded: int
+            Number of messages forwarded to workers
+        batches: int
+            Number of batches sent to workers
+
+    Methods
+    -------
+        start(self): Partitions the Automations and starts the workers.
+        stop(self): Stops the workers.
+        restart(self, model=None): Restarts the workers, e.g: after a model reload.
+        route(self, entity, message, changed=True): Forwards an Entity message to the workers that need it.
+        wait(self): Blocks until a worker exits.
+        stats(self): Returns the shard sizes and forwarding statistics.
+    """
+
+    def __init__(self, model, shards, run_automation, start_method='spawn', **settings):
+        """
+        Creates and returns a ShardRouter object
+        :param model: The model whose Automations are evaluated
+        :param shards: Number of worker processes
+        :param run_automation: Function evaluating an Automation and running its actions in the workers
+        :param start_method: multiprocessing start method. 'spawn' starts workers without the main process's broker
+            threads
+        :param settings: Evaluation and dispatch settings passed to the workers. See run_shard()
+        """
+        self.model = model
+        self.shards = shards
+        self.run_automation = run_automation
+        self.context = multiprocessing.get_context(start_method)
+        self.settings = settings
+        self.processes = []
+        self.channels = []
+        self.partition = []
+        self.routes = {}
+        self.aggregated = {}
+        self.entity_index = {}
+        self.forwarded = 0
+        self.batches = 0
+        # Messages waiting to be sent to each worker, guarded by condition
+        self.pending = []
+        self.condition = threading.Condition()
+        self.sender = None
+        self.running = False
+
+    # Partition the Automations and start the workers
+    def start(self):
+        """
+        Partitions the model's Automations, starts a worker process per shard and sends each worker the current state
+        of the Entities its Automations read.
+        :return:
+        """
+        data = serialize_model(self.model)
+        partition = partition_automations(self.model.automations, self.shards)
+        entity_index = {entity: index for index, entity in enumerate(self.model.entities)}
+        processes = []
+        channels = []
+        for index, automations in enumerate(partition):
+            receiver, sender = self.context.Pipe(duplex=False)
+            process = self.context.Process(target=run_shard, name=f"shard-{index}", daemon=True,
+                                           args=(data, [automation.name for automation in automations], receiver,
+                                                 self.run_automation), kwargs=self.settings)
+            process.start()
+            receiver.close()
+            processes.append(process)
+            channels.append(sender)
+
+        # Install the routes and queue the current state of the Entities each shard reads. Both happen under the lock,
+        # so messages routed afterwards are applied after the state they changed
+        with self.condition:
+            self.routes = {}
+            self.aggregated = {}
+            self.pending = []
+            for index, automations in enumerate(partition):
+                entities = [self.model.entities_dict[name]
+                            for name in set().union(*(condition_entities(automation) for automation in automations))]
+                for entity in entities:
+                    self.routes.setdefault(entity, []).append(index)
+                for name in set().union(*(aggregated_entities(automation) for automation in automations)):
+                    self.aggregated.setdefault(self.model.entities_dict[name], []).append(index)
+                self.pending.append([(entity_index[entity], entity.state) for entity in entities])
+            self.partition = partition
+            self.entity_index = entity_index
+            self.processes = processes
+            self.channels = channels
+            self.running = True
+        self.sender = threading.Thread(target=self.send, daemon=True)
+        self.sender.start()
+
+        sizes = [len(automations) for automations in partition]
+        replicated = sum(len(shards) > 1 for shards in self.routes.values())
+        logging.info(f"Sharding: {len(self.model.automations)} Automations in {self.shards} workers {sizes}, "
+                     f"{replicated} of {len(self.routes)} read Entities forwarded to more than one worker")
+
+    # Stop the workers
+    def stop(self):
+        """
+        Stops the sender thread and the worker processes.
+        :return:
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.sender is not None:
+            self.sender.join()
+            self.sender = None
+        for channel in self.channels:
+            try:
+                channel.send(None)
+            except OSError:
+                pass
+            channel.close()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        with self.condition:
+            self.processes = []
+            self.channels = []
+            self.routes = {}
+            self.aggregated = {}
+
+    # Restart the workers
+    def restart(self, model=None):
+        """
+        Stops the workers and starts new ones, e.g: after a model reload changed the model's Automations or Entities.
+        The new workers start from the current Entity states kept by the main process, while the last results of
+        their Automations (see Automation.evaluate()) start over.
+        :param model: Optional model replacing the current one
+        :return:
+        """
+        self.stop()
+        if model is not None:
+            self.model = model
+        self.start()
+
+    # Forward an Entity message to the workers that need it
+    def route(self, entity, message, changed=True):
+        """
+        Queues an Entity message for the workers whose Automations read the Entity if it changed the Entity's state,
+        and otherwise for the workers whose Automations aggregate the Entity's Attributes. Called by
+        Entity.update_state() for every message.
+        :param entity: Entity object
+        :param message: Dictionary containing the message
+        :param changed: Whether the message changed the Entity's state
+        :return:
+        """
+        with self.condition:
+            shards = self.routes.get(entity) if changed else self.aggregated.get(entity)
+            if not shards:
+                return
+            item = (self.entity_index[entity], message)
+            for index in shards:
+                self.pending[index].append(item)
+            self.forwarded += 1
+            self.condition.notify()
+
+    # Sender thread sending the queued messages to the workers
+    def send(self):
+        while True:
+            with self.condition:
+                while self.running and not any(self.pending):
+                    self.condition.wait()
+                if not self.running:
+                    return
+                # Messages queued while the previous batches were sent go out together
+                batches, self.pending = self.pending, [[] for _ in self.pending]
+                channels = self.channels
+            for index, (channel, batch) in enumerate(zip(channels, batches)):
+                if not batch:
+                    continue
+                try:
+                    channel.send(batch)
+                    self.batches += 1
+                except OSError:
+                    logging.error(f"Shard worker {index} is not reachable", exc_info=True)
+
+    # Block until a worker exits
+    def wait(self, timeout=None):
+        """
+        Blocks until a worker process exits.
+        :param timeout: Maximum number of seconds to wait. None waits forever
+        :return: Indices of the workers that exited. Empty if the timeout expired or the workers were restarted
+        """
+        processes = list(self.processes)
+        if processes:
+            multiprocessing.connection.wait([process.sentinel for process in processes], timeout)
+        elif timeout is not None:
+            time.sleep(timeout)
+        return [index for index, process in enumerate(processes)
+                if not process.is_alive() and process in self.processes]
+
+    # Shard sizes and forwarding statistics
+    def stats(self):
+        """
+        Returns statistics on the shards and the forwarded messages.
+        :return: Dictionary with the number of Automations per shard, the number of read Entities forwarded to more
+            than one shard, the number of forwarded messages and of batches sent
+        """
+        return {
+            'shards': [len(automations) for automations in self.partition],
+            'replicated_entities': sum(len(shards) > 1 for shards in self.routes.values()),
+            'forwarded': self.forwarded,
+            'batches': self.batches
+        }
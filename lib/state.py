@@ -0,0 +1,423 @@
+import time
+import threading
+from array import array
+
+# Slot states. A typed column slot is unset until written, holds its value in the column's array when the value has the
+# column's type, and holds it in the column's boxed dictionary otherwise
+UNSET = 0
+TYPED = 1
+BOXED = 2
+
+
+# Base class of the state store columns, tracking the slots written since the last snapshot
+class Column:
+    """
+    The Column class keeps the list of the slots of a column written since its last snapshot, so that snapshots copy
+    the changed slots instead of the whole column. A slot is listed once until the next snapshot: writers mark it after
+    writing its value, and snapshots clear the mark before copying it, so a value written while a snapshot is copied is
+    listed again for the next one.
+    ...
+
+    Attributes
+    ----------
+        dirty: list
+            Slots written since the last snapshot
+        marked: bytearray
+            1 for the slots in dirty
+
+    Methods
+    -------
+        touch(self, slot): Lists a written slot for the next snapshot.
+        settle(self, count): Removes the first count slots of dirty, copied by a completed snapshot.
+    """
+
+    def __init__(self):
+        self.dirty = []
+        self.marked = bytearray()
+
+    # List a written slot for the next snapshot. Called after the slot's value is written
+    def touch(self, slot):
+        if not self.marked[slot]:
+            self.marked[slot] = 1
+            self.dirty.append(slot)
+
+    # Forget the slots copied by a completed snapshot. Slots listed since are kept
+    def settle(self, count):
+        del self.dirty[:count]
+
+    # Clear the marks of the slots about to be copied and return them, or None if copying the whole column is cheaper
+    def take(self, count):
+        if count * 8 > len(self.marked):
+            self.marked[:] = bytes(len(self.marked))
+            return None
+        slots = self.dirty[:count]
+        marked = self.marked
+        for slot in slots:
+            marked[slot] = 0
+        return slots
+
+
+# A column of slots storing values of one type in a compact array
+class TypedColumn(Column):
+    """
+    The TypedColumn class stores the values of all Attributes of one type in a single array. Values of another type,
+    e.g: a string received for an int Attribute, are kept in a side dictionary so they read back exactly as received.
+    Ingestion writes the live buffers (data, states, boxed, versions). Conditions read the snapshot buffers, which
+    StateStore.snapshot() refreshes at the start of every evaluation cycle from the slots written since the last one.
+    ...
+
+    Attributes
+    ----------
+        python_type: type
+            Type of the values stored in data
+        data: array.array
+            Values of the slots
+        states: bytearray
+            State of each slot. One of UNSET, TYPED, BOXED
+        boxed: dict
+            Values of BOXED slots {slot: value}
+        versions: array.array
+            Version of each slot, increased by ingestion every time its value changes
+        snapshot_data, snapshot_states, snapshot_boxed, snapshot_versions:
+            Copies of data, states, boxed and versions taken by the last snapshot
+        free: list
+            Released slots, reused by allocate()
+
+    Methods
+    -------
+        allocate(self): Returns a new slot.
+        release(self, slot): Releases a slot for reuse.
+        read(self, slot): Returns the latest value of a slot. None if unset.
+        write(self, slot, value): Sets the value of a slot.
+        update(self, slot, value): Sets the value of a slot and returns whether it changed.
+        snapshot(self): Copies the slots written since the last snapshot to the snapshot buffers.
+        reader(self, slot): Returns a function returning the value of a slot in the snapshot.
+        read_source(self, slot, prefix): Returns a Python expression reading a slot of the snapshot, used to compile
+            conditions.
+    """
+
+    def __init__(self, typecode, python_type):
+        """
+        Creates and returns a TypedColumn object
+        :param typecode: array typecode of the column. e.g: 'q'
+        :param python_type: Type of the values stored in the array. e.g: int
+        """
+        super().__init__()
+        self.python_type = python_type
+        self.data = array(typecode)
+        self.states = bytearray()
+        self.boxed = {}
+        self.versions = array('Q')
+        # The snapshot buffers are modified in place, so that compiled conditions can keep references to them
+        self.snapshot_data = array(typecode)
+        self.snapshot_states = bytearray()
+        self.snapshot_boxed = {}
+        self.snapshot_versions = array('Q')
+        self.free = []
+
+    # Return a new slot
+    def allocate(self):
+        if self.free:
+            return self.free.pop()
+        for buffer in (self.data, self.versions, self.snapshot_data, self.snapshot_versions):
+            buffer.append(0)
+        self.states.append(UNSET)
+        self.snapshot_states.append(UNSET)
+        self.marked.append(0)
+        return len(self.states) - 1
+
+    # Release a slot for reuse
+    def release(self, slot):
+        self.write(slot, None)
+        self.free.append(slot)
+
+    # Return the value of a slot
+    def read(self, slot):
+        state = self.states[slot]
+        if state == TYPED:
+            return self.data[slot]
+        return self.boxed.get(slot)
+
+    # Set the value of a slot
+    def write(self, slot, value):
+        if type(value) is self.python_type:
+            try:
+                self.data[slot] = value
+                self.states[slot] = TYPED
+                self.boxed.pop(slot, None)
+                self.touch(slot)
+                return
+            # e.g: ints outside the int64 range
+            except OverflowError:
+                pass
+        if value is None:
+            self.states[slot] = UNSET
+            self.boxed.pop(slot, None)
+        else:
+            self.boxed[slot] = value
+            self.states[slot] = BOXED
+        self.touch(slot)
+
+    # Set the value of a slot and return whether it changed. A value of another type counts as a change
+    def update(self, slot, value):
+        # Fast path: a value of the column's type replacing another
+        if type(value) is self.python_type and self.states[slot] == TYPED:
+            if self.data[slot] == value:
+                return False
+            try:
+                self.data[slot] = value
+                self.touch(slot)
+                return True
+            except OverflowError:
+                pass
+        old = self.read(slot)
+        if type(old) is type(value) and old == value:
+            return False
+        self.write(slot, value)
+        return True
+
+    # Copy the slots written since the last snapshot to the snapshot buffers. Returns the number of listed slots copied
+    def snapshot(self):
+        count = len(self.dirty)
+        if not count:
+            return 0
+        slots = self.take(count)
+        if slots is None:
+            self.snapshot_data[:] = self.data
+            self.snapshot_states[:] = self.states
+            self.snapshot_versions[:] = self.versions
+            self.snapshot_boxed.clear()
+            self.snapshot_boxed.update(self.boxed)
+            return count
+        data, states, boxed, versions = self.data, self.states, self.boxed, self.versions
+        for slot in slots:
+            self.snapshot_data[slot] = data[slot]
+            self.snapshot_states[slot] = states[slot]
+            self.snapshot_versions[slot] = versions[slot]
+            if states[slot] == BOXED:
+                self.snapshot_boxed[slot] = boxed.get(slot)
+            else:
+                self.snapshot_boxed.pop(slot, None)
+        return count
+
+    # Return a function reading a slot of the snapshot
+    def reader(self, slot):
+        data, states, boxed = self.snapshot_data, self.snapshot_states, self.snapshot_boxed
+        return lambda: data[slot] if states[slot] == TYPED else boxed.get(slot)
+
+    # Return a Python expression reading a slot of the snapshot and the values of the names it uses. Names start with
+    # prefix. The expression only depends on the column type and the prefix, so functions compiled from it can be reused
+    def read_source(self, slot, prefix):
+        source = f"({prefix}data[{prefix}slot] if {prefix}states[{prefix}slot] == {TYPED} " \
+                 f"else {prefix}boxed.get({prefix}slot))"
+        return source, {f"{prefix}data": self.snapshot_data, f"{prefix}states": self.snapshot_states,
+                        f"{prefix}boxed": self.snapshot_boxed, f"{prefix}slot": slot}
+
+
+class BoolColumn(TypedColumn):
+    def __init__(self):
+        super().__init__('b', bool)
+
+    # The array stores 0/1, convert back to bool
+    def read(self, slot):
+        state = self.states[slot]
+        if state == TYPED:
+            return self.data[slot] == 1
+        return self.boxed.get(slot)
+
+    def reader(self, slot):
+        data, states, boxed = self.snapshot_data, self.snapshot_states, self.snapshot_boxed
+        return lambda: data[slot] == 1 if states[slot] == TYPED else boxed.get(slot)
+
+    def read_source(self, slot, prefix):
+        source, names = super().read_source(slot, prefix)
+        return source.replace(f"{prefix}data[{prefix}slot]", f"{prefix}data[{prefix}slot] == 1", 1), names
+
+
+# A column of slots storing arbitrary values
+class ObjectColumn(Column):
+    """
+    The ObjectColumn class stores the values of Attributes without a compact representation (strings, lists) in a
+    single list. Provides the same methods as TypedColumn.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.data = []
+        self.versions = array('Q')
+        self.snapshot_data = []
+        self.snapshot_versions = array('Q')
+        self.free = []
+
+    def allocate(self):
+        if self.free:
+            return self.free.pop()
+        self.data.append(None)
+        self.snapshot_data.append(None)
+        self.versions.append(0)
+        self.snapshot_versions.append(0)
+        self.marked.append(0)
+        return len(self.data) - 1
+
+    def release(self, slot):
+        self.write(slot, None)
+        self.free.append(slot)
+
+    def read(self, slot):
+        return self.data[slot]
+
+    def write(self, slot, value):
+        self.data[slot] = value
+        self.touch(slot)
+
+    def update(self, slot, value):
+        old = self.data[slot]
+        self.data[slot] = value
+        self.touch(slot)
+        return type(old) is not type(value) or old != value
+
+    def snapshot(self):
+        count = len(self.dirty)
+        if not count:
+            return 0
+        slots = self.take(count)
+        if slots is None:
+            self.snapshot_data[:] = self.data
+            self.snapshot_versions[:] = self.versions
+            return count
+        for slot in slots:
+            self.snapshot_data[slot] = self.data[slot]
+            self.snapshot_versions[slot] = self.versions[slot]
+        return count
+
+    def reader(self, slot):
+        data = self.snapshot_data
+        return lambda: data[slot]
+
+    def read_source(self, slot, prefix):
+        return f"{prefix}data[{prefix}slot]", {f"{prefix}data": self.snapshot_data, f"{prefix}slot": slot}
+
+
+# A class storing the values of all Attributes
+class StateStore:
+    """
+    The StateStore class holds the values of all Entity Attributes in columns, one per value kind: compact arrays for
+    int, float and bool Attributes and a list for everything else. Every Attribute is given a fixed slot in the column
+    of its kind when it is created, so ingestion and compiled conditions address values by slot instead of through
+    per-object state.
+
+    Ingestion threads write the live buffers of the columns while conditions read their snapshot buffers, refreshed
+    once per evaluation cycle by snapshot(). Each snapshot only copies the slots written since the previous one, so its
+    cost follows the number of changed values, not the number of Attributes. Snapshots are consistent without a lock
+    on the ingestion path: every ingesting thread brackets the messages it applies with begin() and end(), which make
+    its write sequence odd while a message is being applied, and snapshot() only keeps a copy if no message was in
+    progress or applied while it was taken. Every cycle therefore sees each message either completely or not at all.
+    ...
+
+    Attributes
+    ----------
+        columns: dict
+            Columns by kind. {'int': TypedColumn, 'float': TypedColumn, 'bool': BoolColumn, 'object': ObjectColumn}
+        sequences: dict
+            Write sequence of each ingesting thread, by thread id. Odd while the thread is applying a message
+        snapshots: int
+            Number of snapshots taken
+        retries: int
+            Number of times snapshot() waited or copied again because a message was being applied
+
+    Methods
+    -------
+        allocate(self, kind): Returns the column of a kind and a new slot in it.
+        begin(self): Marks the start of a message applied by the calling thread.
+        end(self, writer): Marks the end of a message.
+        snapshot(self): Refreshes the snapshot read by conditions with a consistent copy of the live state.
+        stats(self): Returns the number of used slots and the approximate memory of each column.
+    """
+
+    def __init__(self):
+        self.columns = {
+            'int': TypedColumn('q', int),
+            'float': TypedColumn('d', float),
+            'bool': BoolColumn(),
+            'object': ObjectColumn()
+        }
+        self.sequences = {}
+        self.snapshots = 0
+        self.retries = 0
+
+    # Allocate a slot
+    def allocate(self, kind):
+        """
+        Allocates a slot for a value of the given kind.
+        :param kind: One of 'int', 'float', 'bool', 'object'
+        :return: (column, slot)
+        """
+        column = self.columns[kind]
+        return column, column.allocate()
+
+    # Start applying a message
+    def begin(self):
+        """
+        Marks the start of a message applied by the calling thread. Must be followed by end(), also when applying the
+        message fails, or snapshots wait forever.
+        :return: Writer token passed to end()
+        """
+        writer = threading.get_ident()
+        self.sequences[writer] = self.sequences.get(writer, 0) + 1
+        return writer
+
+    # Finish applying a message
+    def end(self, writer):
+        """
+        Marks the end of the message started by begin().
+        :param writer: Token returned by begin()
+        :return:
+        """
+        self.sequences[writer] += 1
+
+    # Take a consistent snapshot
+    def snapshot(self):
+        """
+        Copies the slots written since the last snapshot to the snapshot read by conditions, waiting for messages being
+        applied by other threads to complete. Meant to be called at the start of every evaluation cycle. The copy is
+        discarded and taken again if a message was applied while it was taken.
+        :return:
+        """
+        sequences = self.sequences
+        while True:
+            before = tuple(sequences.values())
+            if not any(sequence & 1 for sequence in before):
+                copied = [(column, column.snapshot()) for column in self.columns.values()]
+                if tuple(sequences.values()) == before:
+                    # The listed slots are only forgotten once a copy is kept, a discarded copy is taken again
+                    for column, count in copied:
+                        column.settle(count)
+                    self.snapshots += 1
+                    return
+            self.retries += 1
+            # Let the thread applying a message run
+            time.sleep(0)
+
+    # Column statistics
+    def stats(self):
+        """
+        Returns statistics of each column.
+        :return: Dictionary {kind: {'slots': int, 'free': int, 'boxed': int, 'bytes': int}}. bytes counts the live and
+            snapshot arrays of typed columns and lists of pointers of the object column, not the objects themselves
+        """
+        stats = {}
+        for kind, column in self.columns.items():
+            versions = len(column.versions) * column.versions.itemsize
+            if isinstance(column, TypedColumn):
+                size = 2 * (len(column.data) * column.data.itemsize + len(column.states) + versions)
+                boxed = len(column.boxed)
+            else:
+                size = 2 * (len(column.data) * 8 + versions)
+                boxed = 0
+            stats[kind] = {'slots': len(column.data) - len(column.free), 'free': len(column.free), 'boxed': boxed,
+                           'bytes': size}
+        return stats
+
+
+# The store holding the values of all Attributes. Attributes allocate their slots in it when created
+state_store = StateStore()
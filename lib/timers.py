@@ -0,0 +1,574 @@
+import abc
+import math
+import time
+import datetime
+import threading
+
+from .entity import BoolAttribute
+from .state import state_store
+
+
+# A timer of a TimerWheel
+class Timer:
+    """
+    The Timer class represents a callback scheduled on a TimerWheel. Cancelled timers stay in their wheel slot until it
+    is processed, so cancelling takes constant time.
+    ...
+
+    Attributes
+    ----------
+        deadline: float
+            Time the timer is due at, on its wheel's clock
+        callback: callable
+            Function called without arguments when the timer fires
+        cancelled: bool
+            Whether the timer was cancelled
+
+    Methods
+    -------
+        cancel(self): Cancels the timer.
+    """
+
+    def __init__(self, wheel, deadline, callback):
+        """
+        Creates and returns a Timer object. Meant to be called by TimerWheel.schedule()
+        :param wheel: The TimerWheel the timer is scheduled on
+        :param deadline: Time the timer is due at, on the wheel's clock
+        :param callback: Function called without arguments when the timer fires
+        """
+        self.wheel = wheel
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    # Cancel the timer
+    def cancel(self):
+        """
+        Cancels the timer. Cancelling a fired or cancelled timer does nothing.
+        :return:
+        """
+        with self.wheel.lock:
+            if not self.cancelled:
+                self.cancelled = True
+                self.wheel.count -= 1
+
+
+# A class scheduling callbacks at deadlines
+class TimerWheel:
+    """
+    The TimerWheel class is a hierarchical timing wheel. Time is divided into ticks of resolution seconds. The first
+    level has a slot per tick for the next slots ticks, and every following level has a slot per full rotation of the
+    level below it, so four levels of 256 slots cover about 500 days at 10ms. A timer is put into the slot of its
+    deadline tick on the lowest level that reaches it, and moved down a level when the level below reaches its slot.
+    Scheduling and cancelling take constant time, and advancing costs at most one slot per elapsed tick plus the timers
+    due or moved down, however many timers are waiting. Timers never fire before their deadline and fire within about
+    a tick of it once the wheel is advanced.
+    The wheel runs on a monotonic clock, so that durations (delays, periods, debounces, aggregate windows) are not
+    shortened or stretched when the system time is set. Deadlines given as a time of day are converted from wall time
+    using wall_clock when they are scheduled.
+    The evaluation loop advances the wheel at the start of every cycle and waits at most timeout() seconds for the next
+    cycle. Timers may also be scheduled and cancelled from ingestion threads, so the wheel's state is guarded by a
+    lock, which is released while callbacks run.
+    ...
+
+    Attributes
+    ----------
+        resolution: float
+            Seconds per tick
+        slots: int
+            Number of slots per level
+        levels: list
+            Slots of each level, lowest first. Each slot is a list of Timer objects
+        sizes: list
+            Number of timers in the slots of each level, including cancelled ones
+        clock: callable
+            Function returning the current time of the wheel. Defaults to time.monotonic
+        wall_clock: callable
+            Function returning the current wall time, in seconds since the epoch. Defaults to time.time
+        tick: int
+            Last processed tick, counted from the clock's epoch
+        time: float
+            Time the wheel was last advanced to
+        count: int
+            Number of timers waiting to fire
+        fired: int
+            Number of fired timers
+        lock: threading.Lock
+            Lock guarding the wheel's state
+
+    Methods
+    -------
+        schedule(self, deadline, callback): Schedules a callback at a deadline.
+        from_wall(self, moment): Converts a wall time to the wheel's clock.
+        advance(self, now=None): Fires the timers due up to a time.
+        timeout(self, now=None): Returns the seconds until the next timer may be due.
+        restart(self, now=None): Drops the waiting timers and moves the wheel to a time.
+        stats(self): Returns the wheel statistics.
+    """
+
+    def __init__(self, resolution=0.01, slots=256, levels=4, clock=time.monotonic, wall_clock=time.time):
+        """
+        Creates and returns a TimerWheel object
+        :param resolution: Seconds per tick
+        :param slots: Number of slots per level
+        :param levels: Number of levels. Timers due after the last level's range are moved down until they are reached
+        :param clock: Function returning the current time of the wheel
+        :param wall_clock: Function returning the current wall time
+        """
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.sizes = [0] * levels
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.time = clock()
+        self.tick = int(self.time / resolution)
+        self.count = 0
+        self.fired = 0
+        self.lock = threading.Lock()
+
+    # Schedule a callback
+    def schedule(self, deadline, callback):
+        """
+        Schedules a callback to be called by advance() once the time reaches a deadline. Deadlines in the past fire on
+        the next tick.
+        :param deadline: Time the callback is due at, on the wheel's clock
+        :param callback: Function called without arguments
+        :return: Timer object, which can be cancelled
+        """
+        timer = Timer(self, deadline, callback)
+        with self.lock:
+            # An idle wheel is not advanced, catch up with the clock first
+            if self.count == 0:
+                self.tick = max(self.tick, int(self.clock() / self.resolution))
+            self.insert(timer, self.tick + 1)
+            self.count += 1
+        return timer
+
+    # Convert a wall time to the wheel's clock
+    def from_wall(self, moment):
+        """
+        Converts a wall time, e.g: the next occurrence of a time of day, to the wheel's clock, at the current offset
+        between the two clocks.
+        :param moment: Time in seconds since the epoch
+        :return: Time on the wheel's clock
+        """
+        return moment - self.wall_clock() + self.clock()
+
+    # Put a timer into the slot of its deadline tick, on the lowest level reaching it. Timers due before the earliest
+    # tick are put into its slot
+    def insert(self, timer, earliest):
+        tick = max(math.ceil(timer.deadline / self.resolution), earliest)
+        delta = tick - self.tick
+        span = 1
+        for index, level in enumerate(self.levels):
+            if delta < span * self.slots or index == len(self.levels) - 1:
+                level[(tick // span) % self.slots].append(timer)
+                self.sizes[index] += 1
+                return
+            span *= self.slots
+
+    # Fire the due timers
+    def advance(self, now=None):
+        """
+        Fires the timers due up to a time, tick by tick. Callbacks may schedule new timers, which
+        fire in the same call if they are due.
+        :param now: Time to advance to. Defaults to the clock's current time
+        :return: Number of fired timers
+        """
+        self.time = self.clock() if now is None else now
+        target = int(self.time / self.resolution)
+        fired = 0
+        while True:
+            # Callbacks run without the lock, since they may schedule timers
+            with self.lock:
+                due = self.collect(target)
+            if not due:
+                return fired
+            for timer in due:
+                timer.callback()
+            fired += len(due)
+
+    # Advance tick by tick up to a target tick, stopping at the first slot holding timers to fire. Returns them, marked
+    # as fired. Called with the lock held
+    def collect(self, target):
+        while self.tick < target:
+            # Nothing to fire: jump straight to the target
+            if self.count == 0:
+                self.tick = target
+                break
+            # Empty lowest levels: skip to the end of their rotation, where the first level holding timers moves its
+            # timers down
+            span = 1
+            for size in self.sizes:
+                if size:
+                    break
+                span *= self.slots
+            if span > 1:
+                self.tick = min(target, self.tick - self.tick % span + span - 1)
+                if self.tick == target:
+                    break
+            self.tick += 1
+            # Move the timers of the next slot of each level down when the level below completes a rotation
+            span = 1
+            for index in range(1, len(self.levels)):
+                span *= self.slots
+                if self.tick % span:
+                    break
+                slot = self.levels[index][(self.tick // span) % self.slots]
+                self.levels[index][(self.tick // span) % self.slots] = []
+                self.sizes[index] -= len(slot)
+                for timer in slot:
+                    if not timer.cancelled:
+                        self.insert(timer, self.tick)
+            slot = self.levels[0][self.tick % self.slots]
+            if not slot:
+                continue
+            self.levels[0][self.tick % self.slots] = []
+            self.sizes[0] -= len(slot)
+            due = [timer for timer in slot if not timer.cancelled]
+            # Fired timers count as cancelled, so cancelling them later does nothing
+            for timer in due:
+                timer.cancelled = True
+            self.count -= len(due)
+            self.fired += len(due)
+            if due:
+                return due
+        return []
+
+    # Seconds until the next timer may be due
+    def timeout(self, now=None):
+        """
+        Returns the seconds the evaluation loop may wait before advancing the wheel: until the first timer of the lowest
+        level is due, or until timers of a higher level have to move down, whichever comes first.
+        :param now: Current time. Defaults to the clock's current time
+        :return: Seconds, 0 if a timer is due, or None if no timer is waiting
+        """
+        now = self.clock() if now is None else now
+        with self.lock:
+            return self.next_due(now)
+
+    # Seconds until the next timer may be due. Called with the lock held
+    def next_due(self, now):
+        if self.count == 0:
+            return None
+        # The earliest of the first non empty slot of each level. Slots of higher levels are due when their timers
+        # move down
+        deadline = None
+        span = 1
+        for level, size in zip(self.levels, self.sizes):
+            if size:
+                current = self.tick // span
+                for offset in range(1, self.slots + 1):
+                    if level[(current + offset) % self.slots]:
+                        tick = (current + offset) * span
+                        deadline = tick if deadline is None else min(deadline, tick)
+                        break
+            span *= self.slots
+        return max(deadline * self.resolution - now, 0)
+
+    # Drop the waiting timers and move the wheel to a time
+    def restart(self, now=None):
+        """
+        Cancels the waiting timers and moves the wheel to a time, which may be earlier than its current one. Used by
+        replays, which run the wheel on the recorded time.
+        :param now: Time to move to. Defaults to the clock's current time
+        :return:
+        """
+        with self.lock:
+            for level in self.levels:
+                for slot in level:
+                    for timer in slot:
+                        timer.cancelled = True
+                    slot.clear()
+            self.sizes = [0] * len(self.levels)
+            self.count = 0
+            self.time = self.clock() if now is None else now
+            self.tick = int(self.time / self.resolution)
+
+    # Wheel statistics
+    def stats(self):
+        """
+        Returns the wheel statistics.
+        :return: Dictionary {'pending': int, 'fired': int}
+        """
+        return {'pending': self.count, 'fired': self.fired}
+
+
+# The timer wheel of the running process, advanced by the evaluation loop
+timers = TimerWheel()
+
+
+# Returns the seconds since midnight of a 'HH:MM' or 'HH:MM:SS' time of day
+def parse_clock_time(text):
+    parts = [int(part) for part in text.split(':')]
+    hours, minutes, seconds = parts + [0] * (3 - len(parts))
+    if hours > 23 or minutes > 59 or seconds > 59:
+        raise ValueError(f"Invalid time of day '{text}'")
+    return hours * 3600 + minutes * 60 + seconds
+
+
+# Returns the seconds of a duration. e.g: '500ms', '30s', '5m', '1.5h'
+def parse_duration(text):
+    for unit, seconds in (('ms', 0.001), ('s', 1), ('m', 60), ('h', 3600)):
+        if text.endswith(unit):
+            return float(text[:-len(unit)]) * seconds
+    raise ValueError(f"Invalid duration '{text}'. Use a number followed by ms, s, m or h")
+
+
+# Returns the time a time of day next occurs at, after a given time, in local time
+def next_clock_time(seconds, after):
+    day = datetime.datetime.fromtimestamp(after).replace(hour=0, minute=0, second=0, microsecond=0)
+    candidate = day + datetime.timedelta(seconds=seconds)
+    if candidate.timestamp() <= after:
+        candidate = day + datetime.timedelta(days=1, seconds=seconds)
+    return candidate.timestamp()
+
+
+# Returns the seconds since midnight of a time, in local time
+def seconds_of_day(now):
+    moment = datetime.datetime.fromtimestamp(now)
+    return moment.hour * 3600 + moment.minute * 60 + moment.second + moment.microsecond / 1000000
+
+
+# The value of a time condition
+class TimerState(BoolAttribute):
+    def __init__(self, parent):
+        super().__init__(parent, 'active')
+
+
+# Base class of the time conditions of automation.tx
+class TimeCondition(abc.ABC):
+    """
+    The TimeCondition class is the base of the conditions on time: time windows (TimeWindow), times of day (TimeAt),
+    delays (TimeDelay) and periods (TimeInterval). They do not read Entity Attributes. Instead, the timer wheel sets
+    the value of a condition at the deadlines where it changes, in a bool slot of the state store, and schedules the
+    Automations reading it. To the rest of the runtime a time condition is the primitive condition
+    operand1 == operand2 with operand1 that slot's TimerState and operand2 True, so it is compiled, version checked,
+    shared and snapshotted like any other primitive condition. Conditions true at an instant (TimeAt, TimeInterval)
+    are true for a single evaluation cycle, after which the wheel resets them. Times of day (TimeWindow, TimeAt) are
+    read from the wheel's wall clock, delays and periods (TimeDelay, TimeInterval) from its monotonic clock.
+    ...
+
+    Attributes
+    ----------
+        operand1: TimerState object
+            Value of the condition. Set by start()
+        operator: str
+            Always '=='
+        operand2: bool
+            Always True
+        automation: Automation object
+            The Automation whose condition contains the time condition. Set by start()
+        timer: Timer object
+            The timer of the next change. None if there is none
+        reset: Timer object
+            The timer resetting a condition that is true for one evaluation cycle. None if there is none
+
+    Methods
+    -------
+        start(self, automation, wheel=timers): Sets the initial value and schedules the first change.
+        stop(self): Cancels the condition's timer and releases its state store slot.
+        definition(self): Returns the arguments the condition is created with.
+        describe(self): Returns the condition as written in the model.
+    """
+
+    operator = '=='
+    operand2 = True
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.operand1 = None
+        self.automation = None
+        self.wheel = None
+        self.timer = None
+        self.reset = None
+
+    # Set the initial value and schedule the first change
+    def start(self, automation, wheel=timers):
+        """
+        Allocates the condition's state store slot, sets its initial value and schedules its first change. Called by
+        Automation.build_condition(). Starting a started condition restarts it.
+        :param automation: The Automation whose condition contains the time condition
+        :param wheel: TimerWheel scheduling the changes
+        :return:
+        """
+        self.stop()
+        self.automation = automation
+        self.wheel = wheel
+        self.operand1 = TimerState(self)
+        self.begin(wheel.clock())
+
+    # Cancel the timer and release the state store slot
+    def stop(self):
+        """
+        Cancels the condition's timer and releases its state store slot, e.g: when a model reload retires its
+        Automation.
+        :return:
+        """
+        for timer in (self.timer, self.reset):
+            if timer is not None:
+                timer.cancel()
+        self.timer = self.reset = None
+        if self.operand1 is not None:
+            self.operand1.release()
+            self.operand1 = None
+
+    # Set the initial value and schedule the first change. Implemented by each time condition
+    @abc.abstractmethod
+    def begin(self, now):
+        pass
+
+    # Schedule a callback at a deadline
+    def arm(self, deadline, callback):
+        self.timer = self.wheel.schedule(deadline, callback)
+
+    # Schedule a callback at a wall time
+    def arm_at(self, moment, callback):
+        self.arm(self.wheel.from_wall(moment), callback)
+
+    # Set the condition's value, scheduling the Automations reading it if it changed
+    def set(self, value):
+        state = self.operand1
+        writer = state_store.begin()
+        try:
+            changed = state.column.update(state.slot, value)
+            if changed:
+                state.column.versions[state.slot] += 1
+        finally:
+            state_store.end(writer)
+        scheduler = getattr(self.automation.parent, 'scheduler', None)
+        if changed and scheduler is not None:
+            scheduler.schedule(state.automations)
+
+    # Make the condition true for one evaluation cycle. It is reset by the first advance of the wheel after the one
+    # firing it, so the cycle evaluating it sees it true
+    def pulse(self):
+        self.set(True)
+        self.reset = self.wheel.schedule(self.wheel.time + self.wheel.resolution, lambda: self.set(False))
+
+    # Arguments the condition is created with, after parent. Used by the model cache
+    @abc.abstractmethod
+    def definition(self):
+        pass
+
+    # The condition as written in the model
+    @abc.abstractmethod
+    def describe(self):
+        pass
+
+
+# True while the local time of day is in [start, end). The window wraps past midnight if end is before start.
+# e.g: time between 22:00 and 06:30
+class TimeWindow(TimeCondition):
+    def __init__(self, parent, start_time, end_time):
+        super().__init__(parent)
+        self.start_time = start_time
+        self.end_time = end_time
+        self.start_seconds = parse_clock_time(start_time)
+        self.end_seconds = parse_clock_time(end_time)
+
+    # Whether a time of day is inside the window
+    def contains(self, seconds):
+        if self.start_seconds <= self.end_seconds:
+            return self.start_seconds <= seconds < self.end_seconds
+        return seconds >= self.start_seconds or seconds < self.end_seconds
+
+    def begin(self, now):
+        self.update()
+
+    # Set the value at the current wall time and schedule the next bound. The value is computed from the clock instead
+    # of toggled, so clock changes (e.g: daylight saving time) cannot invert it
+    def update(self):
+        now = self.wheel.wall_clock()
+        inside = self.contains(seconds_of_day(now))
+        self.set(inside)
+        if self.start_seconds != self.end_seconds:
+            bound = self.end_seconds if inside else self.start_seconds
+            self.arm_at(next_clock_time(bound, now), self.update)
+
+    def definition(self):
+        return self.start_time, self.end_time
+
+    def describe(self):
+        return f"time between {self.start_time} and {self.end_time}"
+
+
+# True for one evaluation cycle when the local time of day reaches a time. e.g: time at 07:30
+class TimeAt(TimeCondition):
+    def __init__(self, parent, time):
+        super().__init__(parent)
+        self.time = time
+        self.seconds = parse_clock_time(time)
+        self.due = None
+
+    def begin(self, now):
+        self.set(False)
+        self.due = next_clock_time(self.seconds, self.wheel.wall_clock())
+        self.arm_at(self.due, self.fire)
+
+    # The next occurrence is taken after the one firing, in case the wall clock is slightly behind the wheel's
+    def fire(self):
+        self.pulse()
+        self.due = next_clock_time(self.seconds, max(self.wheel.wall_clock(), self.due))
+        self.arm_at(self.due, self.fire)
+
+    def definition(self):
+        return self.time,
+
+    def describe(self):
+        return f"time at {self.time}"
+
+
+# True once a delay has passed since the Automation's condition was built, e.g: since startup or the reload adding
+# the Automation. e.g: after 30s
+class TimeDelay(TimeCondition):
+    def __init__(self, parent, delay):
+        super().__init__(parent)
+        self.delay = delay
+        self.seconds = parse_duration(delay)
+
+    def begin(self, now):
+        self.set(False)
+        self.arm(now + self.seconds, lambda: self.set(True))
+
+    def definition(self):
+        return self.delay,
+
+    def describe(self):
+        return f"after {self.delay}"
+
+
+# True for one evaluation cycle every period, starting one period after the Automation's condition was built.
+# e.g: every 10s
+class TimeInterval(TimeCondition):
+    def __init__(self, parent, period):
+        super().__init__(parent)
+        self.period = period
+        self.seconds = parse_duration(period)
+        if self.seconds <= 0:
+            raise ValueError(f"Invalid period '{period}'. Periods must be positive")
+        self.deadline = None
+
+    def begin(self, now):
+        self.set(False)
+        self.deadline = now + self.seconds
+        self.arm(self.deadline, self.fire)
+
+    # Deadlines are multiples of the period from the start, so they do not drift. Periods missed while the evaluation
+    # loop was busy fire once
+    def fire(self):
+        self.pulse()
+        missed = max(math.floor((self.wheel.time - self.deadline) / self.seconds), 0)
+        self.deadline += (missed + 1) * self.seconds
+        self.arm(self.deadline, self.fire)
+
+    def definition(self):
+        return self.period,
+
+    def describe(self):
+        return f"every {self.period}"
+
+
+# Time condition classes, by class name
+time_condition_classes = {cls.__name__: cls for cls in (TimeWindow, TimeAt, TimeDelay, TimeInterval)}
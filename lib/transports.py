@@ -0,0 +1,280 @@
+import logging
+import threading
+
+import paho.mqtt.client as mqtt
+import redis
+from commlib.endpoints import EndpointType, TransportType
+from commlib.transports.amqp import AMQPTransport
+
+
+# Subscribers receiving the messages of many topics over a single client connection to a Broker. commlib-py's
+# subscribers open a client per topic or pattern, so a Broker connection shared by many Entities uses these instead.
+# Every subscriber has the same interface:
+#   subscriber = Class(conn_params=..., on_message=callback)
+#   subscriber.subscribe(topic) / subscriber.unsubscribe(topic), before or after run()
+#   subscriber.run() connects and starts receiving on a background thread, subscriber.stop() disconnects
+# Topics are '.' separated, like Entity topics. Messages are passed to on_message(payload, topic) with the payload as
+# received, raw JSON bytes or str, which the Entities parse. See PayloadDecoder.parse()
+
+
+# A subscriber receiving the topics of an MQTT Broker over one paho-mqtt client
+class MQTTSubscriber:
+    """
+    The MQTTSubscriber class subscribes a single MQTT client to any number of topics. Subscriptions are sent again
+    whenever the client (re)connects, so they survive reconnections.
+    ...
+
+    Attributes
+    ----------
+        conn_params: commlib-py MQTT ConnectionParameters
+            Broker connection parameters
+        on_message: callable
+            Function called as on_message(payload, topic) for every received message
+        topics: set
+            Subscribed topics
+        client: paho.mqtt.client.Client
+            The client shared by all topics
+    """
+
+    def __init__(self, conn_params=None, on_message=None):
+        self.conn_params = conn_params
+        self.on_message = on_message
+        self.topics = set()
+        self.lock = threading.Lock()
+        self.running = False
+        self.client = mqtt.Client(clean_session=True, protocol=mqtt.MQTTv311, transport='tcp')
+        self.client.username_pw_set(conn_params.creds.username, conn_params.creds.password)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.receive
+
+    def subscribe(self, topic):
+        with self.lock:
+            self.topics.add(topic)
+            if self.running:
+                self.client.subscribe(topic.replace('.', '/'))
+
+    def unsubscribe(self, topic):
+        with self.lock:
+            self.topics.discard(topic)
+            if self.running:
+                self.client.unsubscribe(topic.replace('.', '/'))
+
+    def run(self):
+        with self.lock:
+            self.running = True
+        self.client.connect(self.conn_params.host, int(self.conn_params.port), 60)
+        self.client.loop_start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    # Subscribe to all topics on every connection
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != mqtt.CONNACK_ACCEPTED:
+            logging.error(f"MQTT Broker {self.conn_params.host}:{self.conn_params.port} refused the connection ({rc})")
+            return
+        with self.lock:
+            topics = [(topic.replace('.', '/'), 0) for topic in self.topics]
+        if topics:
+            client.subscribe(topics)
+
+    def receive(self, client, userdata, message):
+        try:
+            self.on_message(message.payload, message.topic)
+        except Exception:
+            logging.error(f"Error handling a message received on {message.topic}", exc_info=True)
+
+
+# A subscriber receiving the channels of a Redis Broker over one pub/sub connection
+class RedisSubscriber:
+    """
+    The RedisSubscriber class subscribes a single Redis pub/sub connection to any number of channels, read by one
+    background thread.
+    ...
+
+    Attributes
+    ----------
+        conn_params: commlib-py Redis ConnectionParameters
+            Broker connection parameters
+        on_message: callable
+            Function called as on_message(payload, topic) for every received message
+        topics: set
+            Subscribed channels
+        pubsub: redis.client.PubSub
+            The pub/sub connection shared by all channels
+    """
+
+    def __init__(self, conn_params=None, on_message=None):
+        self.conn_params = conn_params
+        self.on_message = on_message
+        self.topics = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pubsub = redis.Redis(host=conn_params.host, port=conn_params.port, db=conn_params.db,
+                                  username=conn_params.creds.username or None,
+                                  password=conn_params.creds.password or None).pubsub(ignore_subscribe_messages=True)
+
+    def subscribe(self, topic):
+        with self.lock:
+            self.topics.add(topic)
+            if self.thread is not None:
+                self.pubsub.subscribe(**{topic: self.receive})
+
+    def unsubscribe(self, topic):
+        with self.lock:
+            self.topics.discard(topic)
+            if self.thread is not None:
+                self.pubsub.unsubscribe(topic)
+
+    def run(self):
+        with self.lock:
+            # The reading thread needs a subscription to start
+            if self.thread is None and self.topics:
+                self.pubsub.subscribe(**{topic: self.receive for topic in self.topics})
+                self.thread = self.pubsub.run_in_thread(sleep_time=0.001, daemon=True)
+
+    def stop(self):
+        with self.lock:
+            if self.thread is not None:
+                self.thread.stop()
+                self.thread = None
+            self.pubsub.close()
+
+    def receive(self, message):
+        topic = message['channel'].decode() if isinstance(message['channel'], bytes) else message['channel']
+        try:
+            self.on_message(message['data'], topic)
+        except Exception:
+            logging.error(f"Error handling a message received on {topic}", exc_info=True)
+
+
+# A subscriber receiving the topics of an AMQP Broker through one queue bound to each of them
+class AMQPSubscriber:
+    """
+    The AMQPSubscriber class consumes a single queue bound to the topic exchange once per topic, over one connection.
+    Bindings added while consuming are sent by the consuming thread, since pika connections are not thread safe.
+    ...
+
+    Attributes
+    ----------
+        conn_params: commlib-py AMQP ConnectionParameters
+            Broker connection parameters
+        on_message: callable
+            Function called as on_message(payload, topic) for every received message
+        exchange: str
+            Topic exchange the queue is bound to
+        topics: set
+            Bound topics
+    """
+
+    def __init__(self, conn_params=None, on_message=None, exchange='amq.topic'):
+        self.conn_params = conn_params
+        self.on_message = on_message
+        self.exchange = exchange
+        self.topics = set()
+        self.lock = threading.Lock()
+        self.transport = None
+        self.queue = None
+        self.thread = None
+
+    def subscribe(self, topic):
+        with self.lock:
+            self.topics.add(topic)
+            if self.transport is not None:
+                self.transport.add_threadsafe_callback(self.transport.bind_queue, self.exchange, self.queue, topic)
+
+    def unsubscribe(self, topic):
+        with self.lock:
+            self.topics.discard(topic)
+            if self.transport is not None:
+                self.transport.add_threadsafe_callback(self.transport.channel.queue_unbind, queue=self.queue,
+                                                       exchange=self.exchange, routing_key=topic)
+
+    def run(self):
+        with self.lock:
+            if self.transport is not None:
+                return
+            self.transport = AMQPTransport(self.conn_params)
+            self.transport.connect()
+            self.queue = self.transport.create_queue()
+            for topic in self.topics:
+                self.transport.bind_queue(self.exchange, self.queue, topic)
+            self.transport.channel.basic_consume(self.queue, self.receive, auto_ack=True)
+        self.thread = threading.Thread(target=self.transport.start_consuming, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            transport, self.transport = self.transport, None
+        if transport is not None:
+            transport.add_threadsafe_callback(transport.stop_consuming)
+            self.thread.join()
+            transport.close()
+
+    def receive(self, channel, method, properties, body):
+        try:
+            self.on_message(body, method.routing_key)
+        except Exception:
+            logging.error(f"Error handling a message received on {method.routing_key}", exc_info=True)
+
+
+# Multi-topic subscriber classes by transport
+subscriber_classes = {
+    TransportType.MQTT: MQTTSubscriber,
+    TransportType.REDIS: RedisSubscriber,
+    TransportType.AMQP: AMQPSubscriber
+}
+
+
+# Returns the multi-topic subscriber class of a transport
+def subscriber_factory(transport):
+    return subscriber_classes[transport]
+
+
+# A multi-topic subscriber made of one pattern subscriber of an endpoint factory per topic
+class EndpointSubscriber:
+    """
+    The EndpointSubscriber class provides the multi-topic subscriber interface on top of an endpoint factory with the
+    signature of commlib-py's endpoint_factory, opening one pattern subscriber per topic. Used with in-process
+    transports, e.g: the in-memory transport of the benchmarks, whose endpoints hold no connection.
+    """
+
+    def __init__(self, factory, transport, conn_params=None, on_message=None):
+        self.factory = factory
+        self.transport = transport
+        self.conn_params = conn_params
+        self.on_message = on_message
+        self.endpoints = {}
+        self.running = False
+
+    def subscribe(self, topic):
+        if topic not in self.endpoints:
+            self.endpoints[topic] = self.factory(EndpointType.PSubscriber, self.transport)(
+                topic=topic, conn_params=self.conn_params, on_message=self.on_message)
+            if self.running:
+                self.endpoints[topic].run()
+
+    def unsubscribe(self, topic):
+        endpoint = self.endpoints.pop(topic, None)
+        if endpoint is not None and self.running:
+            endpoint.stop()
+
+    def run(self):
+        if not self.running:
+            self.running = True
+            for endpoint in self.endpoints.values():
+                endpoint.run()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            for endpoint in self.endpoints.values():
+                endpoint.stop()
+
+
+# Returns a function creating EndpointSubscribers of an endpoint factory, with the signature of subscriber_factory()
+def endpoint_subscriber_factory(factory):
+    return lambda transport: lambda **kwargs: EndpointSubscriber(factory, transport, **kwargs)
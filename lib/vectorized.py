@@ -0,0 +1,204 @@
+# NumPy is optional. It is only needed by the "Vectorized" evaluation backend
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .automation import is_attribute, is_condition_group
+from .state import state_store, TYPED
+
+# Numeric operators evaluated in the vectorized pass and the operator used when the operands are swapped, so that
+# literal-first conditions (e.g: 28 < kitchen.temperature) become attribute-first (kitchen.temperature > 28)
+numeric_operators = {'>': '<', '<': '>', '==': '==', '!=': '!='}
+
+# NumPy functions applying the numeric operators to arrays
+numeric_functions = {
+    '>': lambda left, right: left > right,
+    '<': lambda left, right: left < right,
+    '==': lambda left, right: left == right,
+    '!=': lambda left, right: left != right
+}
+
+# NumPy functions applying the boolean operators of ConditionGroups to arrays of bools. Mirror operator_functions in
+# lib.automation for bool operands, including the XNOR expression
+group_functions = {
+    'AND': lambda left, right: left & right,
+    'OR': lambda left, right: left | right,
+    'NOT': lambda left, right: left != right,
+    'XOR': lambda left, right: left ^ right,
+    'NOR': lambda left, right: ~(left | right),
+    'XNOR': lambda left, right: (left | right) & (~left | ~right),
+    'NAND': lambda left, right: ~(left & right)
+}
+
+
+# Returns the (attribute, operator, constant) of a numeric threshold condition, or None for other conditions
+def numeric_threshold(node):
+    if node.operator not in numeric_operators:
+        return None
+    operand1, operand2 = node.operand1, node.operand2
+    # Attribute compared to a number
+    if is_attribute(operand1) and type(operand2) in (int, float):
+        attribute, operator, constant = operand1, node.operator, operand2
+    # Number compared to an attribute
+    elif is_attribute(operand2) and type(operand1) in (int, float):
+        attribute, operator, constant = operand2, numeric_operators[node.operator], operand1
+    else:
+        return None
+    # Only Attributes stored in typed numeric columns
+    if attribute.kind not in ('int', 'float'):
+        return None
+    return attribute, operator, constant
+
+
+# A class evaluating the conditions of all Automations in one vectorized pass
+class VectorEvaluator:
+    """
+    The VectorEvaluator class evaluates the conditions of all Automations of a model together, using NumPy. Numeric
+    threshold conditions (e.g: kitchen_thermometer.temperature > 28) are extracted into arrays of state store slots,
+    operators and constants, grouped by column and operator, and computed with one array operation per group. The
+    remaining primitive conditions are computed with their compiled callables. The ConditionGroup trees of all
+    Automations are then resolved level by level, with one array operation per level and boolean operator.
+
+    A condition whose numeric slots are unset or hold values of another type, or whose other primitive conditions
+    fail or return non-bool values, has no vectorized result and is evaluated with its compiled callable instead,
+    preserving its exact semantics.
+    ...
+
+    Attributes
+    ----------
+        model: textX model
+            The model whose Automations are evaluated
+        automations: list
+            The Automations the evaluator was built for. The evaluator is rebuilt when the model's list changes, e.g:
+            after a model reload
+
+    Methods
+    -------
+        build(self): Extracts the condition trees of the model's Automations.
+        evaluate(self): Evaluates the conditions of all Automations.
+    """
+
+    def __init__(self, model):
+        """
+        Creates and returns a VectorEvaluator object
+        :param model: The model whose Automations are evaluated. Conditions must be built using build_condition()
+        """
+        if np is None:
+            raise ImportError("The Vectorized evaluation backend requires NumPy. Install it using: "
+                              "pip install -r requirements-optional.txt")
+        self.model = model
+        self.automations = None
+
+    # Extract the condition trees of the model's Automations
+    def build(self):
+        """
+        Numbers the condition nodes of all Automations and groups them for vectorized evaluation: numeric threshold
+        conditions by column, operator and constant type, other primitive conditions in a list, and ConditionGroups
+        by their height in the tree and operator.
+        :return:
+        """
+        self.automations = self.model.automations
+        numeric = {}
+        scalar = []
+        groups = {}
+        roots = []
+        owners = []
+
+        # Post-order numbering of a condition tree. Returns the node's number and height
+        def visit(node, owner):
+            if is_condition_group(node):
+                left, left_height = visit(node.r1, owner)
+                right, right_height = visit(node.r2, owner)
+                height = max(left_height, right_height) + 1
+                number = len(owners)
+                owners.append(owner)
+                groups.setdefault((height, node.operator), []).append((number, left, right))
+                return number, height
+            number = len(owners)
+            owners.append(owner)
+            threshold = numeric_threshold(node)
+            if threshold is not None:
+                attribute, operator, constant = threshold
+                # int columns are compared exactly with int64 constants and as floats with other constants
+                exact = attribute.kind == 'int' and type(constant) is int and -2 ** 63 <= constant < 2 ** 63
+                key = (attribute.kind, operator, exact)
+                numeric.setdefault(key, []).append((number, attribute.slot, constant))
+            else:
+                scalar.append((number, node.cond_func))
+            return number, 0
+
+        for index, automation in enumerate(self.automations):
+            # Automations whose condition was not built are evaluated by Automation.evaluate()
+            if not hasattr(automation.condition, 'cond_func'):
+                roots.append(-1)
+                continue
+            roots.append(visit(automation.condition, index)[0])
+
+        self.size = len(owners)
+        self.owners = np.array(owners, dtype=np.int64)
+        self.roots = np.array(roots, dtype=np.int64)
+        self.numeric = []
+        for (kind, operator, exact), items in numeric.items():
+            numbers, slots, constants = zip(*items)
+            self.numeric.append((kind, numeric_functions[operator], np.array(numbers, dtype=np.int64),
+                                 np.array(slots, dtype=np.int64),
+                                 np.array(constants, dtype=np.int64 if exact else np.float64)))
+        self.scalar_numbers = np.array([number for number, _ in scalar], dtype=np.int64)
+        self.scalar_functions = [function for _, function in scalar]
+        self.groups = [(group_functions[operator], *(np.array(column, dtype=np.int64) for column in zip(*items)))
+                       for (height, operator), items in sorted(groups.items())]
+
+    # Evaluate the conditions of all Automations
+    def evaluate(self):
+        """
+        Evaluates the conditions of all Automations of the model, rebuilding the evaluator first if the model's
+        Automations changed.
+        :return: Iterator of (Automation, result) pairs. result is None for Automations whose condition has to be
+            evaluated with its compiled callable. See Automation.evaluate()
+        """
+        if self.model.automations is not self.automations:
+            self.build()
+
+        # One extra node, read by Automations without a built condition
+        values = np.zeros(self.size + 1, dtype=bool)
+        failed = np.zeros(len(self.automations), dtype=bool)
+
+        # Numeric threshold conditions, one array operation per group. The columns are copied, so the state store can
+        # keep allocating slots while the copies are in use
+        columns = {}
+        for kind, function, numbers, slots, constants in self.numeric:
+            if kind not in columns:
+                column = state_store.columns[kind]
+                columns[kind] = (np.frombuffer(column.snapshot_data.tobytes(), dtype=column.data.typecode),
+                                 np.frombuffer(bytes(column.snapshot_states), dtype=np.uint8))
+            data, states = columns[kind]
+            values[numbers] = function(data[slots], constants)
+            # Unset slots and slots holding values of another type
+            typed = states[slots] == TYPED
+            if not typed.all():
+                failed[self.owners[numbers[~typed]]] = True
+
+        # Other primitive conditions
+        if self.scalar_functions:
+            results = []
+            for number, function in zip(self.scalar_numbers.tolist(), self.scalar_functions):
+                try:
+                    result = function()
+                except Exception:
+                    result = None
+                if type(result) is not bool:
+                    failed[self.owners[number]] = True
+                    result = False
+                results.append(result)
+            values[self.scalar_numbers] = results
+
+        # ConditionGroups, from the lowest to the highest level
+        for function, numbers, left, right in self.groups:
+            values[numbers] = function(values[left], values[right])
+
+        results = values[self.roots].tolist()
+        failed |= self.roots < 0
+        for index in np.flatnonzero(failed).tolist():
+            results[index] = None
+        return zip(self.automations, results)
@@ -2,14 +2,18 @@
 # "python -m lib.visualize". The -m tells Python to load it as a module, not as the top-level script.
 # Example call: python -m lib.visualize visualize lang\full_metamodel.tx config\example.full_metamodel gpsAutomation --out gpsAutomation.pu
 
-import click
+import logging
 
-from textx import textx_isinstance, metamodel_from_file
+import click
 
-from .automation import Automation, List, Dict, Action, IntAction, FloatAction, StringAction, BoolAction
+from .automation import Automation, List, Dict, Action, IntAction, FloatAction, StringAction, BoolAction, \
+    is_condition_group, is_time_condition, is_aggregate
 from .broker import Broker, MQTTBroker, AMQPBroker, RedisBroker, BrokerAuthPlain
 from .entity import Attribute, IntAttribute, FloatAttribute, StringAttribute, BoolAttribute, ListAttribute, \
     DictAttribute
+from .cache import ModelLoader
+from .timers import TimeWindow, TimeAt, TimeDelay, TimeInterval
+from .aggregates import Aggregate
 
 # List of primitive types that can be directly printed
 primitives = (int, float, str, bool)
@@ -27,35 +31,40 @@ def print_operand(node):
     """
     if type(node) in primitives or type(node) in custom_classes:
         return node
+    elif is_aggregate(node):
+        return node.describe()
     else:
         return node.parent.name + '.' + node.name
 
 
 # Pre-Order traversal of Condition tree
-def visit_node(node, depth, metamodel, file_writer):
+def visit_node(node, depth, file_writer):
     """
     Function called recursively to visit the Automation's Condition abstract syntax tree using pre-order traversal
     to create a PlantUML MindMap of the Automation's Condition.
     :param node: Node in the Abstract Syntax Tree
     :param depth: Current tree level depth
-    :param metamodel: The metamodel used to parse the model and it's Automations
     :param file_writer: File writer used to write to the PlantUML MindMap
     :return:
     """
     # Increase depth
     depth += 1
 
+    # Time conditions have no operands to print. Print them as written in the model
+    if is_time_condition(node):
+        file_writer.write(f"{'-' * depth} {node.describe()}\n")
+        return
+
     # Print node operator
     file_writer.write(f"{'-' * depth} {node.operator}\n")
 
     # If we are in a ConditionGroup node, recursively visit the left and right sides
-    # TODO: Probably passing around metamodel as an argument just for accessing the ConditionGroup class is not best
-    if textx_isinstance(node, metamodel.namespaces['automation']['ConditionGroup']):
+    if is_condition_group(node):
 
         # Visit left node
-        visit_node(node.r1, depth, metamodel, file_writer)
+        visit_node(node.r1, depth, file_writer)
         # Visit right node
-        visit_node(node.r2, depth, metamodel, file_writer)
+        visit_node(node.r2, depth, file_writer)
 
     # If we are in a primitive condition node, print it out
     else:
@@ -66,10 +75,9 @@ def visit_node(node, depth, metamodel, file_writer):
 
 
 # Visualizes Automation Conditions and Actions using PlantUML
-def visualize_automation(metamodel, automation, out_dir=""):
+def visualize_automation(automation, out_dir=""):
     """
     Creates a PlantUML MindMap visualization of the desired Automation.
-    :param metamodel: Metamodel used to parse the Automation
     :param automation: The Automation to be visualized
     :param out_dir: File directory for saving the Automation visualization. e.g: 'visualization/automation.pu'
         (optional)
@@ -92,7 +100,7 @@ def visualize_automation(metamodel, automation, out_dir=""):
         for action in automation.actions:
             f.write(f"++ {print_operand(action.attribute)} = {action.value}\n")
         # Write Conditions
-        visit_node(automation.condition, depth, metamodel, f)
+        visit_node(automation.condition, depth, f)
         # Write MindMap model end
         f.write("@endmindmap")
         # Close file writer
@@ -111,27 +119,32 @@ def cli():
 @click.argument('model_in')
 @click.argument('automation_name')
 @click.option('--out', default="", help="output file")
-def visualize(metamodel_in, model_in, automation_name, out):
+@click.option('--cache-dir', default=None, help="model cache directory. Models are not cached if omitted")
+def visualize(metamodel_in, model_in, automation_name, out, cache_dir):
     """
     Function used to implement the visualization's tool standalone Command Line Utility. Calls visualize_automation().
     :param metamodel_in: Metamodel used to parse the model.
     :param model_in: Model containing the Automation to be visualized.
     :param automation_name: Automation's name.
     :param out: File directory for saving the Automation visualization. e.g: 'visualization/automation.pu'
+    :param cache_dir: Directory of the model cache. Unchanged models are restored from it instead of being parsed.
+        None disables caching
     :return:
     """
     # Print message
     click.echo(
         f"Using {metamodel_in} metamodel to visualize {automation_name} automation in {model_in} model. Saving to: {out}")
 
-    # Initialize full metamodel. Custom Entity class is not needed and wouldn't allow for offline execution
-    # because the constructor starts a broker publisher and subscriber
-    metamodel = metamodel_from_file(metamodel_in, classes=[Attribute, IntAttribute, FloatAttribute,
-                                                           StringAttribute, BoolAttribute, ListAttribute,
-                                                           DictAttribute, Broker, MQTTBroker, AMQPBroker,
-                                                           RedisBroker, BrokerAuthPlain, Automation, Action,
-                                                           IntAction, FloatAction, StringAction, BoolAction,
-                                                           List, Dict])
+    # Initialize full metamodel loader. Custom Entity class is not needed. The metamodel is only created if the model
+    # is not in the cache
+    metamodel = ModelLoader(metamodel_in, classes=[Attribute, IntAttribute, FloatAttribute,
+                                                   StringAttribute, BoolAttribute, ListAttribute,
+                                                   DictAttribute, Broker, MQTTBroker, AMQPBroker,
+                                                   RedisBroker, BrokerAuthPlain, Automation, Action,
+                                                   IntAction, FloatAction, StringAction, BoolAction,
+                                                   List, Dict, TimeWindow, TimeAt, TimeDelay, TimeInterval,
+                                                   Aggregate],
+                            cache_dir=cache_dir or None)
 
     # Initialize full model
     model = metamodel.model_from_file(model_in)
@@ -145,10 +158,10 @@ def visualize(metamodel_in, model_in, automation_name, out):
     # Build Conditions for all Automations
     for automation in model.automations:
         automation.build_condition()
-        print(f"{automation.name} condition:\n{automation.condition.cond_lambda}\n")
+        logging.debug(f"{automation.name} condition: {automation.condition.cond_lambda}")
 
     # Call visualize_automation() to visualize selected automation
-    visualize_automation(metamodel=metamodel, automation=model.automations_dict[automation_name], out_dir=out)
+    visualize_automation(automation=model.automations_dict[automation_name], out_dir=out)
 
 
 # Add visualize command to
@@ -1,9 +1,9 @@
 import os
 import time
+import atexit
+import contextlib
+import asyncio
 import logging
-from colorama import init, Fore, Style
-
-from textx import metamodel_from_file
 
 from commlib.endpoints import endpoint_factory, EndpointType, TransportType
 from commlib.transports.mqtt import ConnectionParameters as MQTT_ConnectionParameters, Credentials as MQTT_Credentials
@@ -12,85 +12,298 @@ from lib.automation import Automation, List, Dict, Action, IntAction, FloatActio
 from lib.broker import Broker, MQTTBroker, AMQPBroker, RedisBroker, BrokerAuthPlain
 from lib.entity import Entity, Attribute, \
     IntAttribute, FloatAttribute, StringAttribute, BoolAttribute, ListAttribute, DictAttribute
+from lib.scheduler import Scheduler
+from lib.connection import start_connections
+from lib.dispatcher import Dispatcher
+from lib.async_runtime import AsyncRuntime
+from lib.cache import ModelLoader, serialize_model
+from lib.vectorized import VectorEvaluator
+from lib.network import ConditionNetwork
+from lib.reload import ModelReloader
+from lib.sharding import ShardRouter
+from lib.metrics import metrics, watch_model, start_metrics, MetricsServer
+from lib.profiling import profiler, start_profiling
+from lib.recording import TrafficRecorder
+from lib.persistence import StatePersistence
+from lib.state import state_store
+from lib.ingestion import IngestionQueue
+from lib.timers import timers, TimeWindow, TimeAt, TimeDelay, TimeInterval
+from lib.aggregates import Aggregate
+from lib.events import events, start_event_log
 
 
 # === Node-RED integration settings ===
-from config.config import RUN_MODE
+from config.config import RUN_MODE, RUNTIME, EVAL_MODE, EVAL_BACKEND, SHARDS, DISPATCH_ASYNC, DISPATCH_QUEUE_SIZE, \
+    DISPATCH_OVERFLOW, INGEST_QUEUE, INGEST_QUEUE_SIZE, INGEST_OVERFLOW, INGEST_MERGE, MODEL_CACHE, MODEL_CACHE_DIR, \
+    MODEL_CACHE_SIZE, METRICS, METRICS_EXPORT, METRICS_PORT, METRICS_FILE, METRICS_INTERVAL, PROFILE, PROFILE_BUDGET, \
+    PROFILE_TOP, PROFILE_REPORT, PROFILE_TRACE, PROFILE_SAMPLE_INTERVAL, RECORD_PATH, EVENT_LOG_TARGET, \
+    EVENT_LOG_LEVEL, EVENT_LOG_SAMPLING, EVENT_LOG_SIZE, EVENT_LOG_INTERVAL, EVENT_LOG_HTTP, STATE_PATH, STATE_INTERVAL
 
 # Import the configuration for the broker used to receive the HA-Auto configuration model
 if RUN_MODE != "Local":
     from config.config import nr_mqtt as nr
 
 
-# Function used as a callback by the commlib subscriber when receiving the HA-Auto configuration from a broker.
-# It extracts the configuration and writes it to a file.
-def rn_start_scheduler(data):
-    logging.info("Configuration Received")
-    with open(f"config/config_remote.model", 'w') as f:
-        f.write(data["config"])
-        f.close()
+# Returns the commlib-py connection parameters of the MQTT broker used by the Node-RED integration
+def nr_connection_parameters():
+    nr_credentials = MQTT_Credentials(nr["username"], nr["password"])
+    return MQTT_ConnectionParameters(host=nr["host"], port=nr["port"], creds=nr_credentials)
 
 
-if __name__ == '__main__':
+# Evaluates an Automation, runs its actions if triggered and records the result in the event log. result is the
+# condition result computed by a batch evaluation backend, if any
+def run_automation(automation, result=None):
+    previous = automation.last_result
+    try:
+        # Evaluate, timing the evaluation if metrics are enabled
+        if metrics.enabled:
+            start = time.perf_counter()
+            triggered, msg = automation.evaluate(result)
+            duration = time.perf_counter() - start
+            metrics.evaluate_duration.observe(automation.name, duration)
+            metrics.evaluations.inc(automation.name)
+            # Flag evaluations over the profiling budget
+            profiler.check(automation, duration)
+        else:
+            triggered, msg = automation.evaluate(result)
+    except Exception as e:
+        events.emit('error', 'error', automation=automation.name, error=repr(e))
+        raise
+    # Record changes of the condition result, and every evaluation at the debug level
+    if automation.last_result != previous:
+        events.emit('change', automation=automation.name, result=automation.last_result)
+    events.emit('evaluation', 'debug', automation=automation.name, triggered=triggered)
+    # Check if action is triggered
+    if triggered:
+        events.emit('trigger', automation=automation.name)
+        # If automation triggered run its actions
+        if metrics.enabled:
+            start = time.perf_counter()
+            automation.trigger()
+            metrics.trigger_duration.observe(automation.name, time.perf_counter() - start)
+            metrics.triggers.inc(automation.name)
+        else:
+            automation.trigger()
+
 
-    # Initialize full metamodel
-    metamodel = metamodel_from_file('lang/full_metamodel.tx', classes=[Entity, Attribute, IntAttribute, FloatAttribute,
-                                                                       StringAttribute, BoolAttribute, ListAttribute,
-                                                                       DictAttribute, Broker, MQTTBroker, AMQPBroker,
-                                                                       RedisBroker, BrokerAuthPlain, Automation, Action,
-                                                                       IntAction, FloatAction, StringAction, BoolAction,
-                                                                       List, Dict])
+# Returns the event log settings, as arguments of start_event_log()
+def event_log_settings():
+    return {'target': EVENT_LOG_TARGET, 'level': EVENT_LOG_LEVEL, 'sample_rates': EVENT_LOG_SAMPLING,
+            'capacity': EVENT_LOG_SIZE, 'interval': EVENT_LOG_INTERVAL}
 
-    # Determine the configuration file path: remote or local
+
+# Runs the model using broker callback threads and a blocking evaluation loop
+def run_threaded(metamodel):
+    # Determine the configuration model source: remote or local
     if RUN_MODE == "MQTT":
+        # Receives the models sent by the Node-RED integration and saves them. The subscriber keeps running so that
+        # models deployed later are applied to the running model
+        reloader = ModelReloader(metamodel, save_path="config/config_remote.model")
+
         # Create and run subscriber to connect to MQTT broker to receive the model sent by the Node-RED integration
-        nr_credentials = MQTT_Credentials(nr["username"], nr["password"])
-        nr_conn_params = MQTT_ConnectionParameters(host=nr["host"], port=nr["port"], creds=nr_credentials)
         subscriber = endpoint_factory(EndpointType.Subscriber, TransportType.MQTT)(
             topic=nr["topic"],
-            conn_params=nr_conn_params,
-            on_message=rn_start_scheduler
+            conn_params=nr_connection_parameters(),
+            on_message=reloader.receive
         )
         subscriber.run()
 
-        # Wait to receive the model
-        while not os.path.exists("config/config_remote.model"):
-            time.sleep(1)
+        # Start with the last received model if there is one, or wait to receive the model
+        if os.path.exists("config/config_remote.model"):
+            with open("config/config_remote.model") as f:
+                model_str = f.read()
+        else:
+            model_str = reloader.wait()
 
-        # Stop the subscriber
-        subscriber.stop()
-
-        # The path where the subscriber callback saved the received model
-        model_path = "config/config_remote.model"
+        # Evaluation cycles and reloads exclude each other
+        cycle_lock = reloader.lock
 
     else:
-        # Define the default local configuration path
-        model_path = "config/config_local.model"
+        reloader = None
+        # Read the default local configuration path
+        with open("config/config_local.model") as f:
+            model_str = f.read()
+        cycle_lock = contextlib.nullcontext()
 
     # Parse model
-    model = metamodel.model_from_file(model_path)
+    model = metamodel.model_from_str(model_str)
 
     # Build entities dictionary in model. Needed for evaluating conditions
     model.entities_dict = {entity.name: entity for entity in model.entities}
 
+    # Record the received traffic, closing the log on exit
+    if RECORD_PATH:
+        model.recorder = TrafficRecorder(RECORD_PATH)
+        atexit.register(model.recorder.close)
+
+    # Definition of the model as parsed, which reloaded models are compared with. Taken before the enabled flags are
+    # restored, so restored flags do not count as changes
+    model_data = serialize_model(model) if reloader is not None else None
+
+    # Restore the last saved state before the connections start and the conditions are built, then keep saving it.
+    # Shard workers keep their own enabled flags, so only the Attribute values are persisted with SHARDS
+    if STATE_PATH:
+        persistence = StatePersistence(model, STATE_PATH, STATE_INTERVAL, flags=SHARDS == 0)
+        persistence.restore()
+        persistence.start()
+
+    # Start the Broker connections shared by the parsed Entities
+    start_connections()
+
     # Build Conditions for all Automations
     for automation in model.automations:
         automation.build_condition()
-        print(f"{automation.name} condition:\n{automation.condition.cond_lambda}\n")
-
-    # Evaluation loop
-    while True:
-        # Evaluate automations, run applicable actions and print results
-        for automation in model.automations:
-            # Evaluate
-            triggered, msg = automation.evaluate()
-            # Check if action is triggered
-            if triggered:
-                print(f"{Fore.MAGENTA}{automation.name}: {triggered}{Style.RESET_ALL}")
-                # If automation triggered run its actions
-                automation.trigger()
-            else:
-                print(f"{automation.name}: {triggered}")
-
-        # Sleep
-        time.sleep(1)
+        logging.debug(f"{automation.name} condition: {automation.condition.cond_lambda}")
+
+    # Apply models received from now on to the running model
+    if reloader is not None:
+        reloader.attach(model, model_str, model_data)
+
+    # Measure the model's queues and connections when metrics are exported
+    watch_model(model)
+
+    # Sharded evaluation: worker processes evaluate the Automations, this process forwards them the Entity messages
+    if SHARDS > 0:
+        model.router = ShardRouter(model, SHARDS, run_automation, eval_mode=EVAL_MODE, eval_backend=EVAL_BACKEND,
+                                   dispatch_async=DISPATCH_ASYNC, dispatch_queue_size=DISPATCH_QUEUE_SIZE,
+                                   dispatch_overflow=DISPATCH_OVERFLOW, event_log=event_log_settings())
+        model.router.start()
+        # Reloaded models are partitioned again
+        if reloader is not None:
+            reloader.on_apply = model.router.restart
+
+        # Run until a worker exits, e.g: because evaluating an Automation raised an exception
+        while True:
+            exited = model.router.wait()
+            if exited:
+                logging.error(f"Shard workers {exited} exited. Stopping")
+                model.router.stop()
+                return
+
+    # Asynchronous dispatch: Automations submit their actions to the dispatcher, which publishes them in the background
+    if DISPATCH_ASYNC:
+        model.dispatcher = Dispatcher(maxsize=DISPATCH_QUEUE_SIZE, overflow=DISPATCH_OVERFLOW)
+
+    # Ingestion queue: Broker callbacks queue the received messages and each evaluation cycle applies them first
+    if INGEST_QUEUE:
+        model.ingestion = IngestionQueue(maxsize=INGEST_QUEUE_SIZE, overflow=INGEST_OVERFLOW, merge=INGEST_MERGE)
+
+    # Event-driven evaluation: Entities schedule the Automations that depend on their updated Attributes
+    if EVAL_MODE == "Event":
+        model.scheduler = Scheduler()
+
+        # Evaluate all Automations once, since Entities may have received messages before the scheduler existed
+        model.scheduler.schedule(model.automations)
+
+        # Queued messages wake up the evaluation loop, which applies them to schedule the Automations they affect
+        if INGEST_QUEUE:
+            model.ingestion.notify = model.scheduler.wake
+
+        # Shared condition network: updated once per cycle, recomputing only the conditions reading changed Attributes
+        network = ConditionNetwork(model) if EVAL_BACKEND == "Network" else None
+
+        # Evaluation loop. Blocks until an Automation is scheduled, a message is queued or a timer is due, then
+        # evaluates all scheduled Automations as a single cycle
+        while True:
+            automation = model.scheduler.next(timeout=timers.timeout())
+            with cycle_lock, profiler.cycle():
+                # Fire the due timers and apply the queued messages, scheduling the Automations they affect
+                timers.advance()
+                if INGEST_QUEUE:
+                    model.ingestion.drain()
+                if automation is None:
+                    automation = model.scheduler.next(timeout=0)
+
+                # Evaluate a consistent snapshot of the Attributes, including the updates that scheduled the cycle
+                state_store.snapshot()
+                if network is not None:
+                    network.update()
+                while automation is not None:
+                    run_automation(automation, network.result(automation) if network is not None else None)
+                    automation = model.scheduler.next(timeout=0)
+
+                # Publish the actions of the cycle
+                if DISPATCH_ASYNC:
+                    model.dispatcher.flush()
+
+    # Polling evaluation
+    else:
+        # Batch evaluation: the conditions of all Automations are computed in one vectorized pass per cycle, or by
+        # updating the shared condition network
+        evaluator = None
+        if EVAL_BACKEND == "Vectorized":
+            evaluator = VectorEvaluator(model)
+        elif EVAL_BACKEND == "Network":
+            evaluator = ConditionNetwork(model)
+
+        # Evaluation loop
+        while True:
+            with cycle_lock, profiler.cycle():
+                # Fire the due timers and apply the queued messages, then evaluate a consistent snapshot of the
+                # Attributes
+                timers.advance()
+                if INGEST_QUEUE:
+                    model.ingestion.drain()
+                state_store.snapshot()
+
+                # Evaluate automations, run applicable actions and print results
+                if evaluator is not None:
+                    for automation, result in evaluator.evaluate():
+                        run_automation(automation, result)
+                else:
+                    for automation in model.automations:
+                        run_automation(automation)
+
+                # Publish the actions of the cycle
+                if DISPATCH_ASYNC:
+                    model.dispatcher.flush()
+
+            # Sleep
+            time.sleep(1)
+
+
+# Runs the model on a single asyncio event loop
+def run_asyncio(metamodel):
+    runtime = AsyncRuntime(metamodel, run_automation, eval_mode=EVAL_MODE, eval_backend=EVAL_BACKEND,
+                           dispatch_queue_size=DISPATCH_QUEUE_SIZE, dispatch_overflow=DISPATCH_OVERFLOW,
+                           record_path=RECORD_PATH, state_path=STATE_PATH, state_interval=STATE_INTERVAL)
+    # Receive the model from the Node-RED integration, or read the local configuration model
+    if RUN_MODE == "MQTT":
+        asyncio.run(runtime.run_remote(nr_connection_parameters(), nr["topic"]))
+    else:
+        asyncio.run(runtime.run_local("config/config_local.model"))
+
+
+if __name__ == '__main__':
+
+    # Initialize full metamodel loader. The metamodel is only created, and models only parsed, when the cached runtime
+    # form of a model is missing or outdated
+    metamodel = ModelLoader('lang/full_metamodel.tx', classes=[Entity, Attribute, IntAttribute, FloatAttribute,
+                                                               StringAttribute, BoolAttribute, ListAttribute,
+                                                               DictAttribute, Broker, MQTTBroker, AMQPBroker,
+                                                               RedisBroker, BrokerAuthPlain, Automation, Action,
+                                                               IntAction, FloatAction, StringAction, BoolAction,
+                                                               List, Dict, TimeWindow, TimeAt, TimeDelay,
+                                                               TimeInterval, Aggregate],
+                            cache_dir=MODEL_CACHE_DIR if MODEL_CACHE else None, max_entries=MODEL_CACHE_SIZE)
+
+    # Serve or dump the runtime's metrics. Without metrics, instrumented code only checks metrics.enabled
+    if METRICS:
+        start_metrics(METRICS_EXPORT, port=METRICS_PORT, path=METRICS_FILE, interval=METRICS_INTERVAL)
+
+    # Record triggers, condition result changes and errors in the event log, written in batches by a background thread
+    start_event_log(**event_log_settings())
+    # Serve the recent events on /events of the metrics endpoint
+    if EVENT_LOG_HTTP and not (METRICS and METRICS_EXPORT == "HTTP"):
+        MetricsServer(METRICS_PORT).start()
+
+    # Profile the runtime: per-cycle time breakdown, slow Automations and a report written on exit
+    if PROFILE:
+        start_profiling(PROFILE_BUDGET, top=PROFILE_TOP, report_path=PROFILE_REPORT, trace_path=PROFILE_TRACE,
+                        sample_interval=PROFILE_SAMPLE_INTERVAL)
+
+    # Run the model using the configured runtime
+    if RUNTIME == "Asyncio":
+        run_asyncio(metamodel)
+    else:
+        run_threaded(metamodel)
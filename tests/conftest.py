@@ -0,0 +1,92 @@
+import os
+import sys
+
+import pytest
+
+# The tests import the repository's packages, whatever directory pytest is run from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from textx import metamodel_from_file
+
+from lib.aggregates import Aggregate
+from lib.automation import Automation, List, Dict, Action, IntAction, FloatAction, StringAction, BoolAction
+from lib.broker import Broker, MQTTBroker, AMQPBroker, RedisBroker, BrokerAuthPlain
+import lib.connection
+from lib.connection import clear_connections
+from lib.entity import Entity, Attribute, \
+    IntAttribute, FloatAttribute, StringAttribute, BoolAttribute, ListAttribute, DictAttribute
+from lib.timers import TimeWindow, TimeAt, TimeDelay, TimeInterval
+
+
+# The full metamodel used by main.py. Building it takes a while, so it is shared by all tests
+@pytest.fixture(scope='session')
+def metamodel():
+    return metamodel_from_file(os.path.join(ROOT, 'lang', 'full_metamodel.tx'),
+                               classes=[Entity, Attribute, IntAttribute, FloatAttribute, StringAttribute, BoolAttribute,
+                                        ListAttribute, DictAttribute, Broker, MQTTBroker, AMQPBroker, RedisBroker,
+                                        BrokerAuthPlain, Automation, Action, IntAction, FloatAction, StringAction,
+                                        BoolAction, List, Dict, TimeWindow, TimeAt, TimeDelay, TimeInterval, Aggregate])
+
+
+# Returns a function parsing a model and building its conditions, like main.py does
+@pytest.fixture
+def load_model(metamodel):
+    def load(model_str):
+        model = metamodel.model_from_str(model_str)
+        model.entities_dict = {entity.name: entity for entity in model.entities}
+        for automation in model.automations:
+            automation.build_condition()
+        return model
+    return load
+
+
+# Parsed Entities register with the shared Broker connections. Forget them after every test
+@pytest.fixture(autouse=True)
+def connections():
+    yield
+    clear_connections()
+
+
+# A multi-topic subscriber recording its subscriptions, see lib.transports
+class FakeSubscriber:
+    created = []
+
+    def __init__(self, conn_params=None, on_message=None):
+        self.on_message = on_message
+        self.topics = set()
+        self.running = False
+        FakeSubscriber.created.append(self)
+
+    def subscribe(self, topic):
+        self.topics.add(topic)
+
+    def unsubscribe(self, topic):
+        self.topics.discard(topic)
+
+    def run(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+
+# A publisher recording the published messages
+class FakePublisher:
+    published = []
+
+    def __init__(self, **kwargs):
+        pass
+
+    def publish(self, msg, topic=None):
+        FakePublisher.published.append((topic, msg))
+
+
+# Connections started by the test use the fakes instead of connecting to Brokers. Returns the created subscribers
+@pytest.fixture
+def fake_transport(monkeypatch):
+    FakeSubscriber.created = []
+    FakePublisher.published = []
+    monkeypatch.setattr(lib.connection, 'active_subscriber_factory', lambda transport: FakeSubscriber)
+    monkeypatch.setattr(lib.connection, 'active_endpoint_factory', lambda etype, transport: FakePublisher)
+    return FakeSubscriber.created
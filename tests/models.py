@@ -0,0 +1,36 @@
+# Helpers writing the sources of small test models
+
+BROKER = '''
+mqtt:
+    name: home
+    host: '127.0.0.1'
+    port: 1883
+    credentials:
+        username: 'home'
+        password: 'home'
+'''
+
+
+# Source of an Entity of the home Broker on the topic 'home.<name>'
+def entity(name, attributes='- t: float'):
+    return f'''
+entity:
+    name: {name}
+    topic: "home.{name}"
+    broker: home
+    attributes:
+        {attributes}
+'''
+
+
+# Source of an Automation. options are extra lines, e.g: 'trigger: rising'
+def automation(name, condition, action, *options):
+    return f'''
+automation:
+    name: {name}
+    condition: {condition}
+    enabled: true
+    continuous: true
+    actions:
+        - {action}
+''' + ''.join(f'    {option}\n' for option in options)
@@ -0,0 +1,124 @@
+import logging
+
+import pytest
+
+from lib.aggregates import History
+from lib.automation import is_aggregate
+from lib.timers import TimerWheel
+from models import BROKER, entity, automation
+
+
+# A clock the test sets
+class Clock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+# Records the Automations scheduled for evaluation
+class Scheduler:
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, automations):
+        self.scheduled += automations
+
+
+# A timer wheel on a clock the test sets, timing the samples and the windows of the Aggregates
+@pytest.fixture
+def wheel(monkeypatch):
+    wheel = TimerWheel(clock=Clock(100.0))
+    monkeypatch.setattr('lib.aggregates.timers', wheel)
+    return wheel
+
+
+# Loads a model aggregating the kitchen temperature over 10s. Returns the kitchen and its Aggregates by function
+@pytest.fixture
+def kitchen(wheel, load_model):
+    model = load_model(BROKER + entity('kitchen') + ''.join(
+        automation(function, f'{function}(kitchen.t, 10s) > 25', 'kitchen.t: 20.0')
+        for function in ('avg', 'min', 'max', 'count')))
+    model.scheduler = Scheduler()
+    aggregates = {automation.name: automation.condition.operand1 for automation in model.automations}
+    assert all(map(is_aggregate, aggregates.values()))
+    return model.entities[0], aggregates
+
+
+# Sets the kitchen temperature at a time
+def receive(wheel, kitchen, now, t):
+    wheel.clock.now = now
+    kitchen.update_state({'t': t})
+
+
+# The values of the Aggregates, with NaN as None
+def values(aggregates):
+    return {name: None if aggregate.value != aggregate.value else aggregate.value
+            for name, aggregate in aggregates.items()}
+
+
+def test_aggregates_follow_the_window(wheel, kitchen):
+    kitchen, aggregates = kitchen
+    assert values(aggregates) == {'avg': None, 'min': None, 'max': None, 'count': 0}
+    for now, t in ((100.0, 20.0), (102.0, 30.0), (104.0, 10.0)):
+        receive(wheel, kitchen, now, t)
+    assert values(aggregates) == {'avg': 20.0, 'min': 10.0, 'max': 30.0, 'count': 3}
+    # Values that are not numbers are not samples
+    kitchen.update_state({'t': 'warm'})
+    assert aggregates['count'].value == 3
+
+    # One timer per Aggregate removes each sample as it leaves the window
+    scheduler = kitchen.parent.scheduler
+    scheduler.scheduled.clear()
+    wheel.clock.now = 110.0
+    assert wheel.advance() == 4
+    assert values(aggregates) == {'avg': 20.0, 'min': 10.0, 'max': 30.0, 'count': 2}
+    # Only the Automations reading an Aggregate whose value changed are scheduled. The average is still 20
+    assert [automation.name for automation in scheduler.scheduled] == ['count']
+    wheel.clock.now = 112.0
+    wheel.advance()
+    assert values(aggregates) == {'avg': 10.0, 'min': 10.0, 'max': 10.0, 'count': 1}
+    wheel.clock.now = 114.0
+    wheel.advance()
+    assert values(aggregates) == {'avg': None, 'min': None, 'max': None, 'count': 0}
+    assert wheel.count == 0
+
+
+def test_restarted_aggregates_keep_the_samples_in_their_window(wheel, kitchen):
+    kitchen, aggregates = kitchen
+    for now, t in ((100.0, 20.0), (108.0, 30.0)):
+        receive(wheel, kitchen, now, t)
+    # e.g: a model reload rebuilding the condition
+    wheel.clock.now = 111.0
+    aggregates['avg'].start()
+    assert aggregates['avg'].value == 30.0
+    aggregates['avg'].stop()
+    assert aggregates['avg'].history is None and aggregates['avg'].expiry is None
+    assert len(kitchen.attributes[0].history.aggregates) == 3
+
+
+def test_history_grows_then_truncates_at_its_limit(wheel, kitchen, caplog):
+    kitchen, aggregates = kitchen
+    attribute = kitchen.attributes[0]
+    # A small history, so that the window outgrows it
+    history = attribute.history = History(attribute, size=2, limit=4)
+    kitchen.histories[:] = [history]
+    for aggregate in aggregates.values():
+        aggregate.start()
+    with caplog.at_level(logging.WARNING):
+        for index in range(3):
+            receive(wheel, kitchen, 100.0 + index, float(index))
+        assert history.size == 4 and history.truncated == 0
+        for index in range(3, 6):
+            receive(wheel, kitchen, 100.0 + index, float(index))
+    # The two oldest samples left the window early
+    assert history.size == 4 and history.truncated == 2
+    assert values(aggregates) == {'avg': 3.5, 'min': 2.0, 'max': 5.0, 'count': 4}
+    assert len([record for record in caplog.records if 'reached 4 samples' in record.getMessage()]) == 1
+
+    # Samples older than the window are overwritten without truncating, even before their timers remove them
+    for index in range(6, 10):
+        receive(wheel, kitchen, 200.0 + index, float(index))
+    assert history.truncated == 2 and history.size == 4
+    assert values(aggregates) == {'avg': 7.5, 'min': 6.0, 'max': 9.0, 'count': 4}
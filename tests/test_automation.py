@@ -0,0 +1,154 @@
+import pytest
+
+from lib.state import state_store
+from lib.timers import TimerWheel
+
+MODEL = '''
+mqtt:
+    name: home
+    host: '127.0.0.1'
+    port: 1883
+    credentials:
+        username: 'home'
+        password: 'home'
+
+entity:
+    name: kitchen
+    topic: "home.kitchen"
+    broker: home
+    attributes:
+        - t: float
+        - fan: bool
+
+automation:
+    name: fan
+    condition: kitchen.t > 25
+    enabled: true
+    continuous: true
+    actions:
+        - kitchen.fan: true
+'''
+
+
+# Returns the kitchen fan Automation of a model with the given options. e.g: 'trigger: rising'
+@pytest.fixture
+def fan(load_model):
+    def load(options=''):
+        model = load_model(MODEL + (f'    {options}\n' if options else ''))
+        return model.entities[0], model.automations[0]
+    return load
+
+
+# Sets the kitchen temperature and evaluates the Automation like an evaluation cycle does
+def step(entity, automation, t):
+    entity.update_state({'t': t})
+    state_store.snapshot()
+    return automation.evaluate()[0]
+
+
+def test_level_triggers_while_true(fan):
+    kitchen, automation = fan()
+    assert automation.trigger_mode == 'level'
+    assert [step(kitchen, automation, t) for t in (20.0, 30.0, 31.0, 32.0, 20.0, 30.0)] == \
+        [False, True, True, True, False, True]
+
+
+def test_rising_triggers_once_per_true_period(fan):
+    kitchen, automation = fan('trigger: rising')
+    assert [step(kitchen, automation, t) for t in (20.0, 30.0, 31.0, 32.0, 20.0, 30.0)] == \
+        [False, True, False, False, False, True]
+    # A condition true from the start triggers on the first evaluation
+    kitchen, automation = fan('trigger: rising')
+    assert [step(kitchen, automation, t) for t in (30.0, 30.5)] == [True, False]
+
+
+def test_unchanged_inputs_are_not_evaluated(fan):
+    kitchen, automation = fan()
+    calls = []
+    cond_func = automation.condition.cond_func
+    automation.condition.cond_func = lambda: calls.append(1) or cond_func()
+    step(kitchen, automation, 30.0)
+    # Evaluating again without a new value reuses the last result
+    assert automation.evaluate()[0]
+    # Receiving the same value changes nothing either
+    assert step(kitchen, automation, 30.0)
+    assert len(calls) == 1
+    assert not step(kitchen, automation, 20.0)
+    assert len(calls) == 2
+    # A batch backend's result is used as is
+    assert automation.evaluate(result=True)[0]
+    assert len(calls) == 2
+
+
+def test_disabled_automation_does_not_trigger(fan):
+    kitchen, automation = fan()
+    automation.enabled = False
+    assert not step(kitchen, automation, 30.0)
+
+
+# Records the Automations scheduled for evaluation
+class Scheduler:
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, automations):
+        self.scheduled += automations
+
+
+# A clock the test sets
+class Clock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+# A timer wheel on a clock the test sets, used by the Automations for their deferred triggers
+@pytest.fixture
+def wheel(monkeypatch):
+    wheel = TimerWheel(clock=Clock(100.0))
+    monkeypatch.setattr('lib.automation.timers', wheel)
+    return wheel
+
+
+def test_debounce_defers_the_trigger_until_the_condition_held(fan, wheel):
+    kitchen, automation = fan('debounce: 30s')
+    scheduler = automation.parent.scheduler = Scheduler()
+    assert not step(kitchen, automation, 30.0)
+    wheel.clock.now = 110.0
+    assert not step(kitchen, automation, 31.0)
+    # A single timer, due 30s after the condition became true
+    assert wheel.count == 1 and automation.wake.deadline == 130.0
+    scheduler.scheduled.clear()
+    wheel.clock.now = 130.0
+    wheel.advance()
+    assert scheduler.scheduled == [automation]
+    assert automation.evaluate()[0]
+    # Level mode keeps triggering while the condition stays true
+    wheel.clock.now = 140.0
+    assert step(kitchen, automation, 32.0)
+    # Becoming false restarts the debounce and cancels the deferred trigger
+    assert not step(kitchen, automation, 20.0)
+    wheel.clock.now = 150.0
+    assert not step(kitchen, automation, 30.0)
+    assert automation.wake.deadline == 180.0
+    assert not step(kitchen, automation, 20.0)
+    assert automation.wake is None and wheel.count == 0
+
+
+def test_min_interval_limits_the_trigger_rate(fan, wheel):
+    kitchen, automation = fan('min_interval: 5m')
+    automation.parent.scheduler = Scheduler()
+    assert step(kitchen, automation, 30.0)
+    assert not step(kitchen, automation, 20.0)
+    wheel.clock.now = 200.0
+    assert not step(kitchen, automation, 30.0)
+    assert automation.wake.deadline == 400.0
+    wheel.clock.now = 400.0
+    assert wheel.advance() == 1
+    assert automation.evaluate()[0]
+    # Level mode triggers again once the interval passed
+    wheel.clock.now = 401.0
+    assert not automation.evaluate()[0]
+    assert automation.wake.deadline == 700.0
@@ -0,0 +1,90 @@
+import random
+
+import pytest
+
+from benchmarks.generator import generate_model, random_payload
+from lib.automation import operator_functions, is_condition_group
+from lib.network import ConditionNetwork
+from lib.state import state_store
+from lib.vectorized import VectorEvaluator, np
+
+# All ConditionGroup operators
+GROUP_OPERATORS = ('AND', 'OR', 'NOT', 'XOR', 'NOR', 'XNOR', 'NAND')
+
+# Operators whose Python expression short-circuits its right side
+short_circuits = {
+    'AND': lambda left, right: left() and right(),
+    'OR': lambda left, right: left() or right(),
+    'NOR': lambda left, right: not (left() or right()),
+    'NAND': lambda left, right: not (left() and right())
+}
+
+
+# Evaluates a condition tree node by node, like the Python expressions conditions were compiled from before the IR
+def reference(node):
+    if is_condition_group(node):
+        left, right = (lambda: reference(node.r1)), (lambda: reference(node.r2))
+        if node.operator in short_circuits:
+            return short_circuits[node.operator](left, right)
+        return operator_functions[node.operator](left(), right())
+    return node.cond_func()
+
+
+# The result of a condition, or None if evaluating it raises
+def outcome(function, *args):
+    try:
+        return bool(function(*args))
+    except Exception:
+        return None
+
+
+# A random message, sometimes with values of the wrong type, which conditions reading them fail on
+def random_message(rng):
+    message = random_payload(rng)
+    if rng.random() < 0.1:
+        message['i'] = 'n/a'
+    if rng.random() < 0.1:
+        message['b'] = 'unknown'
+    return message
+
+
+@pytest.mark.parametrize('mix, depth, seed', [
+    (None, 1, 0),
+    (None, 3, 1),
+    ({'Numeric': 3, 'Bool': 1}, 2, 2),
+    ({'Bool': 1}, 3, 3)
+])
+def test_backends_agree(load_model, mix, depth, seed):
+    model = load_model(generate_model(entities=6, automations=80, depth=depth, mix=mix, group_operators=GROUP_OPERATORS,
+                                      seed=seed))
+    rng = random.Random(seed)
+    for entity in model.entities:
+        entity.update_state(random_payload(rng))
+    state_store.snapshot()
+
+    network = ConditionNetwork(model)
+    network.build()
+    evaluator = VectorEvaluator(model) if np is not None else None
+    if evaluator is not None:
+        evaluator.build()
+
+    vectorized = 0
+    for _ in range(30):
+        for entity in rng.sample(model.entities, 2):
+            entity.update_state(random_message(rng))
+        state_store.snapshot()
+
+        expected = {automation: outcome(reference, automation.condition) for automation in model.automations}
+        # Compiled IR
+        for automation in model.automations:
+            assert outcome(automation.condition.cond_func) == expected[automation], automation.condition.cond_lambda
+        # Condition network. Failed conditions have no result
+        for automation, result in network.evaluate():
+            assert result == expected[automation], automation.name
+        # Vectorized. Conditions it cannot compute have no result and fall back to the compiled condition
+        if evaluator is not None:
+            for automation, result in evaluator.evaluate():
+                if result is not None:
+                    assert result == expected[automation], automation.name
+                    vectorized += 1
+    assert evaluator is None or vectorized > 0
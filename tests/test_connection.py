@@ -0,0 +1,98 @@
+import lib.transports
+from benchmarks.generator import generate_model
+from benchmarks.memory_transport import memory_endpoint_factory, bus
+from lib.connection import connection_index, start_connections, stop_connections, live_connections, \
+    set_endpoint_factory
+
+
+def test_one_subscriber_per_broker(load_model, fake_transport):
+    # Brokers with the same address share a connection, so the second one listens on another port
+    model_str = generate_model(entities=8, brokers=2, automations=0)
+    model = load_model(model_str.replace('port: 1883', 'port: 1884').replace('port: 1884', 'port: 1883', 1))
+    start_connections()
+    assert len(fake_transport) == 2
+    # Each subscriber is subscribed to the exact topic of every Entity of its Broker
+    for connection in connection_index.values():
+        assert connection.subscriber.running
+        assert connection.subscriber.topics == {entity.topic for entity in model.entities
+                                                if entity.broker is connection.broker}
+    assert list(live_connections().values()) == [2, 2]
+
+    # Messages are demultiplexed to the Entities by topic, raw payloads included
+    entity = model.entities[0]
+    entity.connection.subscriber.on_message(b'{"i": 3}', entity.topic.replace('.', '/'))
+    assert entity.attributes_dict['i'].value == 3
+    assert all(other.attributes_dict['i'].value is None for other in model.entities[1:])
+    stop_connections()
+    assert not any(subscriber.running for subscriber in fake_transport)
+
+
+def test_running_subscriber_follows_registered_topics(load_model, fake_transport):
+    model = load_model(generate_model(entities=3, automations=0))
+    start_connections()
+    connection = model.entities[0].connection
+    subscriber = connection.subscriber
+
+    model.entities[0].detach()
+    start_connections()
+    assert connection.subscriber is subscriber and len(fake_transport) == 1
+    assert subscriber.topics == {entity.topic for entity in model.entities[1:]}
+    model.entities[0].attach()
+    start_connections()
+    assert subscriber.topics == {entity.topic for entity in model.entities}
+
+
+def test_mqtt_subscriber_shares_one_client(monkeypatch):
+    # A paho client recording the subscriptions it sends
+    class Client:
+        def __init__(self, **kwargs):
+            self.subscriptions = []
+
+        def username_pw_set(self, username, password):
+            pass
+
+        def connect(self, host, port, keepalive):
+            self.on_connect(self, None, {}, 0)
+
+        def subscribe(self, topic):
+            self.subscriptions.append(topic)
+
+        def unsubscribe(self, topic):
+            self.subscriptions.append(('unsubscribe', topic))
+
+        def loop_start(self):
+            pass
+
+    monkeypatch.setattr(lib.transports.mqtt, 'Client', Client)
+    received = []
+    conn_params = type('ConnectionParameters', (), {'host': 'localhost', 'port': 1883,
+                                                    'creds': type('Credentials', (), {'username': '', 'password': ''})})
+    subscriber = lib.transports.MQTTSubscriber(conn_params=conn_params,
+                                               on_message=lambda payload, topic: received.append((payload, topic)))
+    subscriber.subscribe('home.kitchen')
+    subscriber.subscribe('home.bedroom')
+    subscriber.run()
+    # Topics subscribed before connecting are sent in one request once connected
+    assert len(subscriber.client.subscriptions) == 1
+    assert sorted(subscriber.client.subscriptions[0]) == [('home/bedroom', 0), ('home/kitchen', 0)]
+    subscriber.subscribe('porch')
+    subscriber.unsubscribe('home.kitchen')
+    assert subscriber.client.subscriptions[1:] == ['porch', ('unsubscribe', 'home/kitchen')]
+
+    message = type('MQTTMessage', (), {'payload': b'{}', 'topic': 'porch'})
+    subscriber.receive(subscriber.client, None, message)
+    assert received == [(b'{}', 'porch')]
+
+
+def test_endpoint_factory_subscribers(load_model):
+    set_endpoint_factory(memory_endpoint_factory)
+    try:
+        model = load_model(generate_model(entities=2, automations=0))
+        start_connections()
+        for entity in model.entities:
+            bus.publish(entity.topic, {'i': 5})
+        assert [entity.attributes_dict['i'].value for entity in model.entities] == [5, 5]
+        stop_connections()
+        assert not bus.subscribers
+    finally:
+        set_endpoint_factory(None)
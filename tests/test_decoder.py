@@ -0,0 +1,109 @@
+import pytest
+
+from benchmarks.generator import generate_model
+from lib.decoder import PayloadDecoder, to_int, to_float, to_bool, to_str
+from lib.state import state_store
+
+
+# Two Entities declaring an int, float, string, bool, list and dict Attribute. See benchmarks.generator
+@pytest.fixture
+def entities(load_model):
+    model = load_model(generate_model(entities=2, automations=0))
+    return model.entities
+
+
+def values(entity):
+    return {attribute.name: attribute.value for attribute in entity.attributes}
+
+
+@pytest.mark.parametrize('coerce, value, expected', [
+    (to_int, 2.0, 2), (to_int, '-3', -3),
+    (to_float, 1, 1.0), (to_float, '1.5', 1.5),
+    (to_bool, 1, True), (to_bool, 0, False), (to_bool, 'On', True), (to_bool, 'false', False), (to_bool, '1', True),
+    (to_str, 12, '12'), (to_str, 0.5, '0.5')
+])
+def test_coercions(coerce, value, expected):
+    result = coerce(value)
+    assert result == expected and type(result) is type(expected)
+
+
+@pytest.mark.parametrize('coerce, value', [
+    (to_int, 2.5), (to_int, 'two'), (to_int, True), (to_int, float('inf')), (to_int, [1]),
+    (to_float, True), (to_float, 'warm'), (to_float, None),
+    (to_bool, 2), (to_bool, 'yes'), (to_bool, 1.0),
+    (to_str, True), (to_str, [1]), (to_str, {'x': 1})
+])
+def test_lossy_coercions_raise(coerce, value):
+    with pytest.raises((ValueError, TypeError, OverflowError)):
+        coerce(value)
+
+
+def test_decode_declared_types(entities):
+    entity = entities[0]
+    message = {'i': 5, 'f': 1.5, 's': 'on', 'b': True, 'l': [1, 2], 'd': {'x': 3}}
+    changed = entity.decoder.decode(message)
+    assert [attribute.name for attribute in changed] == ['i', 'f', 's', 'b', 'l', 'd']
+    assert values(entity) == message
+    # Nothing changes when the same values are received again
+    assert entity.decoder.decode(dict(message)) == []
+    assert [attribute.name for attribute in entity.decoder.decode({'f': 2.5, 'd': {'x': 4}})] == ['f', 'd']
+
+
+def test_decode_coerces_values(entities):
+    entity = entities[0]
+    entity.decoder.decode({'i': '7', 'f': 3, 's': 12, 'b': 'off', 'd': {'x': 2.0}})
+    assert values(entity) == {'i': 7, 'f': 3.0, 's': '12', 'b': False, 'l': None, 'd': {'x': 2}}
+    assert type(entity.attributes_dict['f'].value) is float
+    assert entity.decoder.mismatched == 0
+
+
+def test_decode_keeps_values_that_cannot_be_coerced(entities):
+    entity = entities[0]
+    entity.decoder.decode({'i': 2.5, 'b': 'maybe', 'f': 2 ** 70, 'd': 'closed'})
+    assert values(entity) == {'i': 2.5, 'f': float(2 ** 70), 's': None, 'b': 'maybe', 'l': None, 'd': {'x': None}}
+    # The dict value is ignored, the others are stored as received
+    assert entity.decoder.mismatched == 3
+    entity.decoder.decode({'i': 2 ** 70})
+    assert entity.attributes_dict['i'].value == 2 ** 70
+    entity.decoder.decode({'i': 4, 'b': True})
+    assert entity.attributes_dict['i'].value == 4 and entity.attributes_dict['b'].value is True
+
+
+def test_decode_ignores_undeclared_keys(entities):
+    entity = entities[0]
+    changed = entity.decoder.decode({'i': 1, 'humidity': 40, 'd': {'x': 1, 'y': 2}})
+    assert [attribute.name for attribute in changed] == ['i', 'd']
+    assert entity.decoder.unknown == 2
+    assert 'humidity' not in entity.attributes_dict
+
+
+def test_decode_parses_raw_payloads(entities):
+    decoder = entities[0].decoder
+    assert decoder.parse(b'{"i": 1}') == {'i': 1}
+    assert decoder.parse('{"s": "on"}') == {'s': 'on'}
+    with pytest.raises(ValueError):
+        decoder.parse('[1, 2]')
+
+
+def test_decoders_are_shared_and_write_their_own_slots(entities):
+    first, second = entities
+    # Entities declaring the same keys share the generated code, not the slots it writes
+    assert first.decoder.decode_fields.__code__ is second.decoder.decode_fields.__code__
+    first.decoder.decode({'i': 1, 'd': {'x': 1}})
+    second.decoder.decode({'i': 2, 'd': {'x': 2}})
+    assert first.attributes_dict['i'].value == 1 and second.attributes_dict['i'].value == 2
+    assert first.attributes_dict['d'].value == {'x': 1} and second.attributes_dict['d'].value == {'x': 2}
+    # A new decoder for an Entity reuses the compiled code
+    assert PayloadDecoder(first).decode_fields.__code__ is first.decoder.decode_fields.__code__
+
+
+def test_decoded_values_reach_the_snapshot(entities):
+    entity = entities[0]
+    state_store.snapshot()
+    entity.decoder.decode({'i': 9, 's': 'idle', 'b': True, 'd': {'x': 5}})
+    attributes = [entity.attributes_dict[name] for name in ('i', 's', 'b')] + entity.attributes_dict['d'].items
+    for attribute in attributes:
+        assert attribute.slot in attribute.column.dirty
+    state_store.snapshot()
+    assert [attribute.reader()() for attribute in attributes] == [9, 'idle', True, 5]
+    assert not any(attribute.column.marked[attribute.slot] for attribute in attributes)
@@ -0,0 +1,111 @@
+import time
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from lib.dispatcher import BrokerQueue, Dispatcher
+
+
+def broker(name='home', port=1883):
+    return SimpleNamespace(name=name, host='localhost', port=port,
+                           credentials=SimpleNamespace(username='', password=''))
+
+
+# An Entity recording the messages published to it. Publishing waits for release when blocked
+class Entity:
+    def __init__(self, name, broker):
+        self.name = name
+        self.broker = broker
+        self.published = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def publish(self, message):
+        self.release.wait()
+        self.published.append(message)
+
+
+def queued(broker_queue):
+    return [message['n'] for _, message, _ in broker_queue.items]
+
+
+@pytest.mark.parametrize('overflow, expected, dropped', [
+    ('drop_oldest', [2, 3, 4], 2),
+    ('drop_newest', [0, 1, 2], 2)
+])
+def test_overflow_drops(overflow, expected, dropped):
+    # Without workers, nothing leaves the queue
+    broker_queue = BrokerQueue(broker(), maxsize=3, overflow=overflow)
+    entity = Entity('lamp', broker_queue.broker)
+    results = [broker_queue.put(entity, {'n': n}) for n in range(5)]
+    assert queued(broker_queue) == expected
+    assert broker_queue.dropped == dropped
+    assert results == [True] * 3 + [overflow == 'drop_oldest'] * 2
+
+
+def test_overflow_blocks_until_published():
+    broker_queue = BrokerQueue(broker(), maxsize=2, overflow='block')
+    entity = Entity('lamp', broker_queue.broker)
+    entity.release.clear()
+    broker_queue.run(workers=1)
+    try:
+        # The worker holds one message, the queue the next two
+        for n in range(3):
+            broker_queue.put(entity, {'n': n})
+        producer = threading.Thread(target=broker_queue.put, args=(entity, {'n': 3}))
+        producer.start()
+        producer.join(0.1)
+        assert producer.is_alive() and len(broker_queue) == 2
+        entity.release.set()
+        producer.join(5)
+        assert not producer.is_alive()
+    finally:
+        broker_queue.stop()
+    for worker in broker_queue.workers:
+        worker.join(5)
+    assert [message['n'] for message in entity.published] == [0, 1, 2, 3]
+    assert broker_queue.dropped == 0
+
+
+def test_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        Dispatcher(overflow='drop_all')
+
+
+def test_cycle_messages_are_merged_per_entity():
+    dispatcher = Dispatcher()
+    lamp = Entity('lamp', broker())
+    dispatcher.submit(lamp, {'on': True, 'level': 1})
+    dispatcher.submit(lamp, {'level': 5})
+    assert dispatcher.pending == {lamp: {'on': True, 'level': 5}}
+    assert dispatcher.coalesced == 1
+
+
+def test_stats_and_queues_per_broker_connection():
+    dispatcher = Dispatcher(maxsize=1, overflow='drop_newest')
+    lamp, heater = Entity('lamp', broker()), Entity('heater', broker('garage', port=1884))
+    lamp.release.clear()
+    heater.release.clear()
+    try:
+        for entity in (lamp, heater):
+            dispatcher.submit(entity, {'n': 0})
+        dispatcher.flush()
+        # Wait for the workers to take the messages, blocking on publishing them
+        while any(len(broker_queue) for broker_queue in dispatcher.queues.values()):
+            time.sleep(0.001)
+        # A reloaded Broker object with the same connection parameters reuses the queue and its worker
+        reloaded = Entity('lamp', broker('house'))
+        for n in range(1, 4):
+            dispatcher.submit(reloaded, {'n': n})
+            dispatcher.flush()
+        assert len(dispatcher.queues) == 2
+        stats = dispatcher.stats()
+        assert stats['coalesced'] == 0
+        assert set(stats['queues']) == {'house', 'garage'}
+        assert stats['queues']['house']['depth'] + stats['queues']['house']['dropped'] == 3
+        assert dispatcher.queue_depths() == {name: queue['depth'] for name, queue in stats['queues'].items()}
+    finally:
+        lamp.release.set()
+        heater.release.set()
+        dispatcher.stop()
@@ -0,0 +1,102 @@
+import threading
+
+import pytest
+
+from lib.ingestion import IngestionQueue, merge_message
+from models import BROKER, entity
+
+
+# An Entity recording the messages applied to it
+class Entity:
+    def __init__(self, name):
+        self.name = name
+        self.applied = []
+
+    def update_state(self, message):
+        if message.get('fail'):
+            raise ValueError(message['fail'])
+        self.applied.append(message)
+
+
+def test_pending_messages_are_merged_by_default():
+    queue = IngestionQueue()
+    lamp = Entity('lamp')
+    first = {'on': True, 'color': {'r': 1, 'g': 2}}
+    queue.put(lamp, first)
+    queue.put(lamp, {'level': 3, 'color': {'g': 5}})
+    queue.put(lamp, {'on': False})
+    assert queue.pending == {lamp: {'on': False, 'level': 3, 'color': {'r': 1, 'g': 5}}}
+    # The received message is left untouched
+    assert first == {'on': True, 'color': {'r': 1, 'g': 2}}
+    assert queue.drain() == 1
+    assert lamp.applied == [{'on': False, 'level': 3, 'color': {'r': 1, 'g': 5}}]
+    assert queue.stats() == {'pending': 0, 'received': 3, 'coalesced': 2, 'dropped': 0, 'applied': 1, 'errors': 0,
+                             'batches': 1}
+
+
+def test_merged_messages_apply_like_the_messages_in_turn(load_model):
+    model = load_model(BROKER + entity('lamp', '- on: bool\n        - level: int\n        - color: {\n'
+                                               '            - r: int\n            - g: int\n        }'))
+    lamp = model.entities[0]
+    messages = [{'on': True, 'color': {'r': 1, 'g': 2}}, {'level': 3, 'color': {'g': 5}}, {'on': False}]
+    for message in messages:
+        lamp.update_state(message)
+    values = {attribute.name: attribute.value for attribute in lamp.attributes}
+    merged = {}
+    for message in messages:
+        merge_message(merged, message)
+    lamp.update_state({'on': None, 'level': None, 'color': {'r': None, 'g': None}})
+    lamp.update_state(merged)
+    assert {attribute.name: attribute.value for attribute in lamp.attributes} == values
+
+
+def test_newest_message_replaces_the_pending_one_without_merge():
+    queue = IngestionQueue(merge=False)
+    lamp = Entity('lamp')
+    queue.put(lamp, {'on': True})
+    queue.put(lamp, {'level': 3})
+    assert queue.pending == {lamp: {'level': 3}} and queue.coalesced == 1
+
+
+@pytest.mark.parametrize('overflow, pending, dropped', [
+    ('drop_oldest', ['hall', 'porch'], ['lamp']),
+    ('drop_newest', ['lamp', 'hall'], ['porch'])
+])
+def test_overflow_drops_entities(overflow, pending, dropped):
+    queue = IngestionQueue(maxsize=2, overflow=overflow)
+    lamp, hall, porch = Entity('lamp'), Entity('hall'), Entity('porch')
+    for sender in (lamp, hall, porch):
+        queue.put(sender, {'on': True})
+    # Messages of Entities already pending are merged, even while the queue is full
+    assert queue.put(hall, {'level': 1})
+    assert [sender.name for sender in queue.pending] == pending
+    assert queue.dropped == len(dropped)
+
+
+def test_overflow_blocks_until_drained():
+    queue = IngestionQueue(maxsize=1, overflow='block')
+    lamp, hall = Entity('lamp'), Entity('hall')
+    queue.put(lamp, {'on': True})
+    producer = threading.Thread(target=queue.put, args=(hall, {'on': True}))
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+    queue.drain()
+    producer.join(5)
+    assert not producer.is_alive() and list(queue.pending) == [hall]
+
+
+def test_drain_isolates_failing_entities():
+    wakeups = []
+    queue = IngestionQueue(notify=lambda: wakeups.append(len(queue)))
+    lamp, hall, porch = Entity('lamp'), Entity('hall'), Entity('porch')
+    queue.put(lamp, {'fail': 'bad payload'})
+    queue.put(hall, {'on': True})
+    queue.put(porch, {'on': True})
+    queue.discard(porch)
+    # Only the first message into an empty queue wakes up the evaluation loop
+    assert wakeups == [1]
+    assert queue.drain() == 2
+    assert hall.applied == [{'on': True}] and porch.applied == []
+    assert queue.errors == 1 and queue.applied == 2
+    assert queue.drain() == 0
@@ -0,0 +1,153 @@
+import itertools
+
+import pytest
+
+from lib.automation import operator_functions
+from lib.ir import IRBuilder, compile_ir, format_ir, read_attributes, ir_functions
+
+
+# A primitive condition whose value the test sets. Stands for the conditions built by Automation.build_condition()
+class Primitive:
+    def __init__(self, name, operator='==', value=False):
+        self.operator = operator
+        self.cond_lambda = f"({name})"
+        self.value = value
+        self.cond_func = lambda: self.value
+
+
+# A primitive condition raising when evaluated, e.g: a comparison of an int Attribute holding a string
+class Failing(Primitive):
+    def __init__(self, name):
+        super().__init__(name, '>')
+
+        def fail():
+            raise TypeError(f"{name} failed")
+        self.cond_func = fail
+
+
+def test_identical_nodes_are_shared():
+    builder = IRBuilder()
+    condition = Primitive('a')
+    left = builder.operation('or', builder.test(condition), builder.test(Primitive('b')))
+    right = builder.operation('or', builder.test(condition), builder.test(Primitive('b')))
+    assert left is right
+    assert builder.const(1) is not builder.const(True)
+
+
+def test_constant_folding():
+    builder = IRBuilder()
+    node = builder.operation('xor', builder.const(True), builder.operation('not', builder.const(True)))
+    assert node.op == 'const' and node.value is True
+    # Operations raising on their constants are kept, so the compiled condition raises too
+    node = builder.operation('xor', builder.const('on'), builder.const(True))
+    assert node.op == 'xor'
+
+
+def test_dead_branch_removal():
+    builder = IRBuilder()
+    failing = builder.test(Failing('f'))
+    assert builder.operation('and', builder.const(False), failing).value is False
+    assert builder.operation('or', builder.const(True), failing).value is True
+    assert builder.operation('and', builder.const(True), failing) is failing
+    # Python evaluates the left side first, so it is kept when it may raise
+    assert builder.operation('and', failing, builder.const(False)).op == 'and'
+    # A safe left side is dropped
+    safe = builder.test(Primitive('a'))
+    assert builder.operation('and', safe, builder.const(False)).value is False
+    assert builder.operation('or', safe, builder.const(False)) is safe
+
+
+def test_boolean_simplifications():
+    builder = IRBuilder()
+    a = builder.test(Primitive('a'))
+    not_a = builder.operation('not', a)
+    assert builder.operation('not', not_a) is a
+    assert builder.operation('and', a, a) is a
+    assert builder.operation('xor', a, a).value is False
+    assert builder.operation('or', a, not_a).value is True
+    assert builder.operation('and', not_a, a).value is False
+    assert builder.operation('xor', a, builder.const(True)) is not_a
+
+
+def test_non_boolean_operands_are_not_simplified():
+    builder = IRBuilder()
+    # Boolean primitive conditions apply 'and' to Attribute values as they are, so their value may be e.g: a string
+    a = builder.test(Primitive('a', 'AND'))
+    assert not a.boolean
+    assert builder.operation('not', builder.operation('not', a)).op == 'not'
+    assert builder.operation('and', a, builder.const(True)).op == 'and'
+    assert builder.operation('xor', a, a).op == 'xor'
+
+
+def test_xnor_keeps_the_baseline_expression():
+    # The XNOR expression of lib.automation, (l or r) and (not l or not r), is true when exactly one side is. It is kept
+    # as is, so for bool operands XNOR lowers to ^
+    builder = IRBuilder()
+    a, b = Primitive('a'), Primitive('b')
+    node = builder.group('XNOR', builder.test(a), builder.test(b))
+    assert node.op == 'xor'
+    function = compile_ir(node)
+    for a.value, b.value in itertools.product((False, True), repeat=2):
+        assert function() == operator_functions['XNOR'](a.value, b.value) == (a.value != b.value)
+
+    # Other operands keep the expression, printed once per operand
+    c = builder.test(Primitive('c', 'AND'))
+    node = builder.group('XNOR', builder.group('AND', c, c), c)
+    assert node.op == 'xnor'
+    assert format_ir(node) == "((((c) and (c)) or (c)) and (not ((c) and (c)) or not (c)))"
+    for value in (0, 1, '', 'on', None):
+        c.value.value = value
+        expected = operator_functions['XNOR'](operator_functions['AND'](value, value), value)
+        assert compile_ir(node)() == ir_functions['xnor'](value and value, value) == expected
+
+
+def test_printed_conditions_are_single_line_expressions():
+    builder = IRBuilder()
+    a, b = Primitive('a', 'AND'), Primitive('b', 'AND')
+    shared = builder.group('AND', builder.test(a), builder.test(b))
+    node = builder.group('OR', shared, builder.group('NOT', shared, builder.test(b)))
+    text = format_ir(node)
+    assert text == "(((a) and (b)) or (((a) and (b)) is not (b)))"
+    for a.value, b.value in itertools.product((False, True), repeat=2):
+        assert eval(text.replace('(a)', repr(a.value)).replace('(b)', repr(b.value))) == compile_ir(node)()
+
+    # Nested XNORs double their expression at every level, so shared operations are bound to names instead
+    for index in range(12):
+        node = builder.group('XNOR', builder.group('AND', node, builder.test(a)), builder.test(b))
+    lines = format_ir(node).split('\n')
+    assert len(lines) == 14 and all(line.startswith(f"_{index + 1} = ") for index, line in enumerate(lines[:-1]))
+    assert sum(map(len, lines)) < 5000
+
+
+def test_optimized_conditions_match_unoptimized():
+    # Every condition of two groups over a, b and the constants, under all values of a and b
+    primitives = [Primitive('a'), Primitive('b')]
+    optimized, unoptimized = IRBuilder(), IRBuilder(optimize=False)
+
+    def leaves(builder):
+        return [builder.test(primitive, [primitive]) for primitive in primitives] + \
+            [builder.const(False), builder.const(True)]
+
+    operators = ('AND', 'OR', 'NOT', 'XOR', 'NOR', 'XNOR', 'NAND')
+    for first, second in itertools.product(operators, repeat=2):
+        for left, middle, right in itertools.product(range(4), repeat=3):
+            nodes = []
+            for builder in (optimized, unoptimized):
+                operands = leaves(builder)
+                inner = builder.group(first, operands[left], operands[middle])
+                nodes.append(builder.group(second, inner, operands[right]))
+            functions = [compile_ir(node) for node in nodes]
+            for primitives[0].value, primitives[1].value in itertools.product((False, True), repeat=2):
+                assert functions[0]() == functions[1](), format_ir(nodes[1])
+            assert read_attributes(nodes[0]) <= read_attributes(nodes[1])
+
+
+def test_failing_conditions_still_raise():
+    builder = IRBuilder()
+    failing = builder.test(Failing('f'))
+    for node in (builder.operation('and', failing, builder.const(False)),
+                 builder.operation('or', failing, builder.const(True)),
+                 builder.operation('xor', failing, failing),
+                 builder.group('NAND', failing, builder.const(True))):
+        with pytest.raises(TypeError):
+            compile_ir(node)()
@@ -0,0 +1,99 @@
+import os
+import struct
+import logging
+
+import pytest
+
+from lib.persistence import StatePersistence, capture_state, apply_state, write_state, read_state, state_header
+from models import BROKER, entity, automation
+
+MODEL = BROKER + entity('kitchen', '- t: float\n        - on: bool') + \
+    automation('cool', 'kitchen.t > 25', 'kitchen.on: true') + \
+    automation('heat', 'kitchen.t < 15', 'kitchen.on: false')
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path / 'state.bin')
+
+
+def test_state_round_trips_through_the_state_file(load_model, state_path):
+    model = load_model(MODEL)
+    model.entities[0].update_state({'t': 30.0})
+    model.automations[1].enabled = False
+    data = capture_state(model)
+    assert data['entities'] == {'kitchen': {'t': 30.0}}
+    assert write_state(state_path, data) == os.path.getsize(state_path)
+    assert os.listdir(os.path.dirname(state_path)) == ['state.bin']
+    assert read_state(state_path) == data
+
+    # The values are restored, and the flags of Automations whose definition is unchanged
+    restored = load_model(MODEL.replace('kitchen.t > 25', 'kitchen.t > 28'))
+    assert apply_state(restored, read_state(state_path)) == (1, 1)
+    assert restored.entities[0].attributes_dict['t'].value == 30.0
+    assert [automation.enabled for automation in restored.automations] == [True, False]
+
+
+# Corrupts the state file at a path
+def truncate(path):
+    with open(path, 'r+b') as f:
+        f.truncate(state_header.size - 1)
+
+
+def cut_payload(path):
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 1)
+
+
+def flip_payload_byte(path):
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+
+
+def replace_magic(path):
+    with open(path, 'r+b') as f:
+        f.write(b'NOTSTATE')
+
+
+def bump_version(path):
+    with open(path, 'r+b') as f:
+        f.seek(8)
+        f.write(struct.pack('<I', 99))
+
+
+@pytest.mark.parametrize('corrupt, message', [
+    (truncate, 'is truncated'),
+    (cut_payload, 'is corrupted'),
+    (flip_payload_byte, 'is corrupted'),
+    (replace_magic, 'is not a version 1 state file'),
+    (bump_version, 'is not a version 1 state file')
+])
+def test_corrupted_state_files_are_rejected(load_model, state_path, corrupt, message):
+    write_state(state_path, capture_state(load_model(MODEL)))
+    corrupt(state_path)
+    with pytest.raises(ValueError, match=message):
+        read_state(state_path)
+
+
+def test_unreadable_state_leaves_the_model_as_parsed(load_model, state_path, caplog):
+    model = load_model(MODEL)
+    persistence = StatePersistence(model, state_path)
+    # No state file yet
+    assert read_state(state_path) is None
+    assert persistence.restore() == (0, 0)
+
+    model.entities[0].update_state({'t': 30.0})
+    model.automations[0].enabled = False
+    assert persistence.save()
+    # Nothing changed since the last save
+    assert not persistence.save()
+    assert persistence.stats() == {'saves': 1, 'skipped': 1}
+    flip_payload_byte(state_path)
+    restored = load_model(MODEL)
+    with caplog.at_level(logging.WARNING):
+        assert StatePersistence(restored, state_path).restore() == (0, 0)
+    assert 'Cannot restore the state' in caplog.text
+    assert restored.entities[0].attributes_dict['t'].value is None and restored.automations[0].enabled
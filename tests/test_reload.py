@@ -0,0 +1,97 @@
+import pytest
+
+from lib.reload import ModelReloader, diff_definitions
+from lib.cache import serialize_model
+from lib.state import state_store
+from models import BROKER, entity, automation
+
+MODEL = BROKER + entity('kitchen') + entity('bedroom') + entity('porch') + \
+    automation('cool_kitchen', 'kitchen.t > 25', 'kitchen.t: 20.0') + \
+    automation('cool_bedroom', 'bedroom.t > 25', 'bedroom.t: 20.0') + \
+    automation('porch_light', 'porch.t < 5', 'porch.t: 5.0')
+
+# The bedroom gets another Attribute, the porch is removed and a garage is added
+RELOADED = BROKER + entity('kitchen') + entity('bedroom', '- t: float\n        - h: int') + entity('garage') + \
+    automation('cool_kitchen', 'kitchen.t > 25', 'kitchen.t: 20.0') + \
+    automation('cool_bedroom', 'bedroom.t > 25', 'bedroom.t: 20.0') + \
+    automation('heat_garage', 'garage.t < 5', 'garage.t: 10.0')
+
+
+# Loads models with the metamodel, like ModelLoader without a cache
+class Loader:
+    def __init__(self, metamodel):
+        self.metamodel = metamodel
+
+    def model_from_str(self, model_str):
+        return self.metamodel.model_from_str(model_str)
+
+
+@pytest.fixture
+def reloader(metamodel, load_model, fake_transport):
+    model = load_model(MODEL)
+    reloader = ModelReloader(Loader(metamodel))
+    reloader.attach(model, MODEL)
+    return reloader
+
+
+def test_diff_definitions(metamodel):
+    diff = diff_definitions(serialize_model(metamodel.model_from_str(MODEL)),
+                            serialize_model(metamodel.model_from_str(RELOADED)))
+    assert diff['brokers'] == {'added': [], 'removed': [], 'changed': [], 'unchanged': ['home']}
+    assert diff['entities'] == {'added': ['garage'], 'removed': ['porch'], 'changed': ['bedroom'],
+                                'unchanged': ['kitchen']}
+    assert diff['automations'] == {'added': ['heat_garage'], 'removed': ['porch_light'], 'changed': [],
+                                   'unchanged': ['cool_kitchen', 'cool_bedroom']}
+
+
+def test_reload_keeps_unchanged_entities_and_automations(reloader):
+    model = reloader.model
+    kitchen, bedroom, porch = (model.entities_dict[name] for name in ('kitchen', 'bedroom', 'porch'))
+    cool_kitchen, cool_bedroom, porch_light = model.automations
+    kitchen.update_state({'t': 30.0})
+    bedroom.update_state({'t': 30.0})
+    cool_kitchen.enabled = False
+
+    diff = reloader.reload(RELOADED)
+    assert diff['entities']['changed'] == ['bedroom']
+    assert reloader.model is model
+    # The unchanged Entity and its Automation are carried forward with their state
+    assert model.entities_dict['kitchen'] is kitchen and kitchen.attributes_dict['t'].value == 30.0
+    assert model.automations[0] is cool_kitchen and not cool_kitchen.enabled
+    # The changed Entity is replaced, so the unchanged Automation reading it is rebuilt against the new Entity
+    assert model.entities_dict['bedroom'] is not bedroom
+    assert model.automations[1] is not cool_bedroom
+    assert model.automations[1].condition.operand1 is model.entities_dict['bedroom'].attributes_dict['t']
+    assert [a.name for a in model.automations] == ['cool_kitchen', 'cool_bedroom', 'heat_garage']
+
+    # Removed and replaced Entities are detached, the others receive the messages of their topic
+    connection = kitchen.connection
+    assert connection.entities == {entity.topic: [entity] for entity in model.entities}
+    assert not porch_light.enabled
+    subscriber = connection.subscriber
+    assert subscriber.topics == {'home.kitchen', 'home.bedroom', 'home.garage'}
+    subscriber.on_message({'t': 2.0}, 'home/garage')
+    assert model.entities_dict['garage'].attributes_dict['t'].value == 2.0
+    state_store.snapshot()
+    assert model.automations[2].evaluate()[0]
+
+
+def test_invalid_model_keeps_the_live_model(reloader):
+    model = reloader.model
+    entities = list(model.entities)
+    assert reloader.reload(MODEL.replace('kitchen.t > 25', 'kitchen.missing > 25')) is None
+    assert model.entities == entities
+    assert reloader.data == serialize_model(model)
+
+
+def test_restored_flags_are_not_reloaded_as_changes(metamodel, load_model, fake_transport):
+    model = load_model(MODEL)
+    data = serialize_model(model)
+    # e.g: flags restored from the state file after the model was parsed
+    model.automations[0].enabled = False
+    reloader = ModelReloader(Loader(metamodel))
+    reloader.attach(model, MODEL, data)
+    cool_kitchen = model.automations[0]
+    diff = reloader.reload(MODEL.replace('porch.t < 5', 'porch.t < 4'))
+    assert diff['automations']['unchanged'] == ['cool_kitchen', 'cool_bedroom']
+    assert model.automations[0] is cool_kitchen and not cool_kitchen.enabled
@@ -0,0 +1,122 @@
+import datetime
+
+import pytest
+
+from lib.connection import set_endpoint_factory, start_connections, clear_connections
+from lib.timers import timers
+from lib.recording import TrafficRecorder, TrafficLog
+from lib.replay import ReplayDriver, replay_endpoint_factory, compare_reports
+from models import BROKER, entity, automation
+
+MODEL = BROKER + entity('kitchen', '- t: float\n        - fan: bool') + entity('porch') + \
+    automation('fan', 'kitchen.t > 25', 'kitchen.fan: true')
+
+# Messages received by the kitchen and the porch
+TRAFFIC = [('kitchen', {'t': 20.0}), ('porch', {'t': 3.5}), ('kitchen', {'t': 30.0}), ('kitchen', {'t': 31.0}),
+           ('kitchen', {'t': 20.0}), ('kitchen', {'t': 26.0})]
+
+
+# Loads a model whose connections publish to the running replay
+@pytest.fixture
+def replay_model(load_model):
+    set_endpoint_factory(replay_endpoint_factory)
+
+    def load(model_str=MODEL):
+        clear_connections()
+        model = load_model(model_str)
+        start_connections(subscribe=False)
+        return model
+    yield load
+    set_endpoint_factory(None)
+
+
+@pytest.fixture
+def log_path(tmp_path, replay_model):
+    # Record the traffic as received by the Entities of a model
+    model = replay_model()
+    path = str(tmp_path / 'traffic.log')
+    model.recorder = TrafficRecorder(path)
+    for name, message in TRAFFIC[:4]:
+        model.entities_dict[name].receive(message)
+    model.recorder.close()
+    # Recording again appends to the log
+    model.recorder = TrafficRecorder(path)
+    for name, message in TRAFFIC[4:]:
+        model.entities_dict[name].receive(message)
+    model.recorder.close()
+    return path
+
+
+def test_recorded_traffic_reads_back(log_path):
+    with TrafficLog(log_path) as log:
+        messages = list(log.messages())
+        assert [(name, message) for _, name, message in messages] == TRAFFIC
+        assert [timestamp for timestamp, _, _ in messages] == sorted(timestamp for timestamp, _, _ in messages)
+        assert log.entity_ids()[0] == {'kitchen': 0, 'porch': 1}
+        assert [payload for _, _, payload in log.messages(raw=True)][0] == b'{"t":20.0}'
+
+
+def test_cut_records_end_the_log(log_path):
+    with open(log_path, 'ab') as f:
+        f.write(b'\x01\x00\x00')
+    with TrafficLog(log_path) as log:
+        assert len(list(log.messages())) == len(TRAFFIC)
+    # A recorder appending to the log drops the cut record
+    recorder = TrafficRecorder(log_path)
+    recorder.record(type('Entity', (), {'name': 'porch'}), {'t': 4.0})
+    recorder.close()
+    with TrafficLog(log_path) as log:
+        assert [message for _, _, message in log.messages()][-2:] == [{'t': 26.0}, {'t': 4.0}]
+
+
+def replay(model, log_path, **settings):
+    with TrafficLog(log_path) as log:
+        return ReplayDriver(model, **settings).run(log.messages(raw=True))
+
+
+@pytest.mark.parametrize('eval_mode', ['Event', 'Polling'])
+def test_replay_reproduces_the_actions(replay_model, log_path, eval_mode):
+    report = replay(replay_model(), log_path, eval_mode=eval_mode)
+    assert report['messages'] == len(TRAFFIC) and report['errors'] == 0
+    if eval_mode == 'Event':
+        # The actions follow the message making the kitchen warm. The fan is never reported on, so every trigger sends
+        assert report['triggers'] == {'fan': 3}
+        assert report['actions'] == [[index, 'home.kitchen', {'fan': True}] for index in (3, 4, 6)]
+        # Evaluating before the kitchen reported compares None
+        assert report['evaluation_errors'] == 1
+    else:
+        # The traffic was recorded within a poll interval, so it is evaluated by the final cycle only
+        assert report['actions'] == [[6, 'home.kitchen', {'fan': True}]]
+
+    # Replaying again gives the same actions, while another threshold diverges at its first missing action
+    comparison = compare_reports(replay(replay_model(), log_path, eval_mode=eval_mode), report)
+    assert comparison['identical']
+    changed = replay(replay_model(MODEL.replace('kitchen.t > 25', 'kitchen.t > 30')), log_path, eval_mode=eval_mode)
+    comparison = compare_reports(changed, report)
+    assert not comparison['identical']
+    if eval_mode == 'Event':
+        assert comparison['matching_actions'] == 0
+        assert comparison['first_divergence'] == {'action': [4, 'home.kitchen', {'fan': True}],
+                                                  'baseline_action': [3, 'home.kitchen', {'fan': True}]}
+        assert comparison['triggers'] == {'fan': [1, 3]}
+
+
+def test_replay_skips_unknown_entities(replay_model, log_path):
+    report = replay(replay_model(MODEL.replace(entity('porch'), '')), log_path)
+    assert report['skipped'] == {'porch': 1} and report['messages'] == len(TRAFFIC) - 1
+
+
+@pytest.mark.parametrize('eval_mode', ['Event', 'Polling'])
+def test_time_conditions_fire_on_the_recorded_time(replay_model, eval_mode):
+    model = replay_model(BROKER + entity('kitchen', '- t: float\n        - fan: bool') + entity('porch') +
+                         automation('wake', 'time at 07:30', 'kitchen.fan: true') +
+                         automation('late', '(after 30s) AND (kitchen.t > 25)', 'porch.t: 0.0', 'trigger: rising'))
+    start = datetime.datetime(2024, 3, 1, 7, 29).timestamp()
+    messages = [(start, 'kitchen', b'{"t":30.0}'), (start + 10, 'porch', b'{"t":1.0}'),
+                (start + 120, 'kitchen', b'{"t":20.0}')]
+    clocks = timers.clock, timers.wall_clock
+    report = ReplayDriver(model, eval_mode=eval_mode).run(messages)
+    # The delay passes 30s after the first message and the time of day is reached a minute after it, both between the
+    # second and the third message. The pulse of 'time at' lasts a single cycle
+    assert report['actions'] == [[2, 'home.porch', {'t': 0.0}], [2, 'home.kitchen', {'fan': True}]]
+    assert (timers.clock, timers.wall_clock) == clocks and timers.stats()['pending'] == 0
@@ -0,0 +1,145 @@
+import time
+
+import pytest
+
+from lib.sharding import ShardRouter, partition_automations, condition_entities
+from models import BROKER, entity, automation
+
+ROOMS = ('kitchen', 'hall', 'bedroom', 'porch', 'garage')
+
+
+def model_source(*automations):
+    return BROKER + ''.join(entity(room) for room in ROOMS) + ''.join(automations)
+
+
+# The shards of a partition, as lists of Automation names
+def names(partition):
+    return [[automation.name for automation in shard] for shard in partition]
+
+
+def test_automations_reading_the_same_entities_stay_together(load_model):
+    model = load_model(model_source(
+        automation('a1', 'kitchen.t > 25', 'kitchen.t: 20.0'),
+        automation('b1', 'bedroom.t > 25', 'bedroom.t: 20.0'),
+        automation('a2', '(kitchen.t > 25) AND (hall.t > 25)', 'porch.t: 20.0'),
+        automation('c1', 'time between 08:00 and 09:00', 'garage.t: 20.0')
+    ))
+    # Actions do not count as reads, so the porch does not join a1 and a2
+    assert condition_entities(model.automations[2]) == {'kitchen', 'hall'}
+    assert names(partition_automations(model.automations, 2)) == [['a1', 'a2'], ['b1', 'c1']]
+    assert names(partition_automations(model.automations, 1)) == [['a1', 'a2', 'b1', 'c1']]
+    # Shards hold at most their share of the Automations, so more shards than Automations split every component
+    assert sorted(map(len, partition_automations(model.automations, 6))) == [0, 0, 1, 1, 1, 1]
+
+
+def test_large_components_are_split_along_their_entities(load_model):
+    # A chain kitchen - hall - bedroom - porch: one component, too large for one of two shards
+    model = load_model(model_source(
+        automation('a1', 'kitchen.t > 25', 'kitchen.t: 20.0'),
+        automation('a2', '(kitchen.t > 25) AND (hall.t > 25)', 'hall.t: 20.0'),
+        automation('a3', '(bedroom.t > 25) AND (porch.t > 25)', 'porch.t: 20.0'),
+        automation('a4', 'porch.t > 25', 'porch.t: 20.0'),
+        automation('a5', '(hall.t > 25) AND (bedroom.t > 25)', 'bedroom.t: 20.0'),
+    ))
+    partition = partition_automations(model.automations, 2)
+    assert sorted(map(len, partition)) == [2, 3]
+    assert names(partition) == [['a1', 'a2', 'a5'], ['a3', 'a4']]
+
+
+# Stands for a multiprocessing context, recording what the router sends to each worker
+class Channel:
+    def __init__(self):
+        self.batches = []
+
+    def send(self, batch):
+        self.batches.append(batch)
+
+    def close(self):
+        pass
+
+
+class Process:
+    def __init__(self, target=None, name=None, daemon=None, args=(), kwargs=None):
+        self.args = args
+        self.alive = False
+
+    def start(self):
+        self.alive = True
+
+    def join(self, timeout=None):
+        self.alive = False
+
+    def is_alive(self):
+        return self.alive
+
+
+class Context:
+    def __init__(self):
+        self.channels = []
+
+    def Pipe(self, duplex=True):
+        self.channels.append(Channel())
+        return Channel(), self.channels[-1]
+
+    def Process(self, **kwargs):
+        return Process(**kwargs)
+
+
+# Returns the messages sent to each worker, once the sender thread sent them all
+def sent(context, count):
+    deadline = time.monotonic() + 5
+    while sum(len(batch) for channel in context.channels for batch in channel.batches) < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+    messages = [[item for batch in channel.batches for item in batch] for channel in context.channels]
+    for channel in context.channels:
+        channel.batches = []
+    return messages
+
+
+@pytest.fixture
+def router(load_model):
+    model = load_model(model_source(
+        automation('cool', '(kitchen.t > 25) AND (hall.t > 25)', 'kitchen.t: 20.0'),
+        automation('heat', 'bedroom.t < 15', 'bedroom.t: 20.0'),
+        automation('trend', 'avg(kitchen.t, 10m) > 25', 'hall.t: 20.0')
+    ))
+    router = ShardRouter(model, 2, run_automation=None)
+    router.context = Context()
+    model.router = router
+    yield router
+    router.stop()
+
+
+def test_workers_start_from_the_entity_states(router):
+    model = router.model
+    kitchen, hall, bedroom = (model.entities_dict[name] for name in ('kitchen', 'hall', 'bedroom'))
+    kitchen.update_state({'t': 21.0})
+    router.start()
+    assert names(router.partition) == [['cool', 'trend'], ['heat']]
+    assert router.routes == {kitchen: [0], hall: [0], bedroom: [1]}
+    assert router.aggregated == {kitchen: [0]}
+    # Each worker gets the Automations of its shard and the current state of the Entities they read
+    assert [process.args[1] for process in router.processes] == [['cool', 'trend'], ['heat']]
+    first, second = sent(router.context, 3)
+    index = router.entity_index
+    assert sorted(first) == sorted([(index[kitchen], {'t': 21.0}), (index[hall], {'t': None})])
+    assert second == [(index[bedroom], {'t': None})]
+
+
+def test_messages_are_routed_to_the_workers_reading_them(router):
+    model = router.model
+    kitchen, bedroom, porch = (model.entities_dict[name] for name in ('kitchen', 'bedroom', 'porch'))
+    router.start()
+    sent(router.context, 3)
+    index = router.entity_index
+
+    kitchen.update_state({'t': 30.0})
+    bedroom.update_state({'t': 10.0})
+    assert sent(router.context, 2) == [[(index[kitchen], {'t': 30.0})], [(index[bedroom], {'t': 10.0})]]
+    # Messages that change nothing only reach the workers aggregating the Entity, unread Entities reach none
+    kitchen.update_state({'t': 30.0})
+    bedroom.update_state({'t': 10.0})
+    porch.update_state({'t': 5.0})
+    assert sent(router.context, 1) == [[(index[kitchen], {'t': 30.0})], []]
+    assert router.forwarded == 3
@@ -0,0 +1,141 @@
+import threading
+
+import pytest
+
+from lib.state import StateStore, UNSET, TYPED, BOXED
+
+
+@pytest.fixture
+def store():
+    return StateStore()
+
+
+@pytest.mark.parametrize('kind, value', [('int', 3), ('float', 2.5), ('bool', True), ('bool', False),
+                                         ('object', 'on'), ('object', [1, 2])])
+def test_values_read_back_exactly(store, kind, value):
+    column, slot = store.allocate(kind)
+    assert column.read(slot) is None
+    column.write(slot, value)
+    assert column.read(slot) == value and type(column.read(slot)) is type(value)
+
+
+@pytest.mark.parametrize('kind, value', [('int', 2.5), ('int', 'n/a'), ('int', 2 ** 70), ('float', 1),
+                                         ('bool', 1), ('bool', 'unknown')])
+def test_values_of_another_type_are_boxed(store, kind, value):
+    column, slot = store.allocate(kind)
+    column.write(slot, value)
+    assert column.states[slot] == BOXED
+    assert column.read(slot) == value and type(column.read(slot)) is type(value)
+    # A typed value replaces the boxed one
+    typed = column.python_type(1)
+    column.write(slot, typed)
+    assert column.states[slot] == TYPED and slot not in column.boxed and column.read(slot) == typed
+    column.write(slot, None)
+    assert column.states[slot] == UNSET and column.read(slot) is None
+
+
+@pytest.mark.parametrize('kind, values', [
+    ('int', [1, 1, 2, 2.0, 2.0, 2, None, None]),
+    ('bool', [True, True, False, 0, 0, False, None, None]),
+    ('object', ['a', 'a', 'b', ['b'], ['b'], 'b', None, None])
+])
+def test_update_reports_changes(store, kind, values):
+    column, slot = store.allocate(kind)
+    # Values of another type count as a change, even if equal
+    assert [column.update(slot, value) for value in values] == [True, False, True, True, False, True, True, False]
+
+
+def test_released_slots_are_reused_cleared(store):
+    column, first = store.allocate('float')
+    _, second = store.allocate('float')
+    column.write(first, 1.5)
+    column.release(first)
+    assert store.allocate('float') == (column, first)
+    assert column.read(first) is None
+    assert store.stats()['float'] == {'slots': 2, 'free': 0, 'boxed': 0, 'bytes': 2 * (2 * 8 + 2 + 2 * 8)}
+
+
+def test_conditions_read_the_snapshot(store):
+    column, slot = store.allocate('int')
+    read = column.reader(slot)
+    column.write(slot, 1)
+    assert read() is None
+    store.snapshot()
+    assert read() == 1
+    column.write(slot, 'n/a')
+    column.write(slot, 2)
+    assert read() == 1
+    store.snapshot()
+    assert read() == 2
+
+
+def test_snapshots_copy_the_written_slots(store):
+    column = store.columns['float']
+    slots = [column.allocate() for _ in range(64)]
+    readers = [column.reader(slot) for slot in slots]
+    # Writes are listed once per slot until the next snapshot
+    for value in (1.0, 2.0, 'high'):
+        column.write(slots[5], value)
+    column.write(slots[9], 3.0)
+    assert column.dirty == [slots[5], slots[9]]
+    store.snapshot()
+    assert column.dirty == [] and not any(column.marked)
+    assert [reader() for reader in readers] == [None] * 5 + ['high', None, None, None, 3.0] + [None] * 54
+    # Slots not written since are left alone, even if the live buffers change behind the column's back
+    column.data[slots[0]] = 7.0
+    column.states[slots[0]] = 1
+    column.write(slots[1], 4.0)
+    store.snapshot()
+    assert readers[0]() is None and readers[1]() == 4.0
+    # Writing most slots copies the whole column at once
+    for slot in slots[10:]:
+        column.write(slot, 1.0)
+    store.snapshot()
+    assert readers[0]() == 7.0 and column.dirty == []
+
+
+def test_discarded_snapshots_keep_their_slots(store, monkeypatch):
+    column, slot = store.allocate('object')
+    read = column.reader(slot)
+    column.write(slot, 'a')
+    # A message applied by another thread while the copy is taken discards it
+    copy = column.snapshot
+
+    def snapshot_during_a_write():
+        count = copy()
+        if store.retries == 0:
+            writer = store.begin()
+            column.write(slot, 'b')
+            store.end(writer)
+        return count
+    monkeypatch.setattr(column, 'snapshot', snapshot_during_a_write)
+    store.snapshot()
+    assert store.retries == 1 and store.snapshots == 1
+    assert read() == 'b' and column.dirty == []
+
+
+def test_snapshots_see_whole_messages(store):
+    # A writer thread keeps both slots equal, each message writing them one after the other
+    first_column, first = store.allocate('int')
+    second_column, second = store.allocate('int')
+    first_read, second_read = first_column.reader(first), second_column.reader(second)
+    done = threading.Event()
+
+    def write():
+        value = 0
+        while not done.is_set():
+            value += 1
+            writer = store.begin()
+            first_column.write(first, value)
+            second_column.write(second, value)
+            store.end(writer)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+        for _ in range(2000):
+            store.snapshot()
+            assert first_read() == second_read()
+    finally:
+        done.set()
+        thread.join()
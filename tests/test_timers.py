@@ -0,0 +1,154 @@
+import time
+import random
+
+import pytest
+
+from lib.timers import TimerWheel, TimeAt, next_clock_time
+
+# Seconds per tick of the test wheels. A power of two, so tick times are exact
+RESOLUTION = 0.25
+
+
+# A clock the test sets
+class Clock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+# A small wheel, so that timers a few seconds away already go through every level. Levels cover 4, 16 and 64 ticks
+def small_wheel(clock):
+    return TimerWheel(resolution=RESOLUTION, slots=4, levels=3, clock=clock)
+
+
+# Schedules timers recording the wheel time they fire at
+def schedule_all(wheel, deadlines):
+    fired = {}
+    timers = {}
+    for deadline in deadlines:
+        timers[deadline] = wheel.schedule(deadline, lambda deadline=deadline: fired.setdefault(deadline, wheel.time))
+    return fired, timers
+
+
+def test_timers_cascade_through_all_levels():
+    clock = Clock()
+    wheel = small_wheel(clock)
+    rng = random.Random(0)
+    # Up to 200 ticks away, beyond the range of the last level
+    deadlines = sorted({round(rng.uniform(0, 50), 3) for _ in range(300)})
+    fired, _ = schedule_all(wheel, deadlines)
+    assert wheel.count == len(deadlines) and all(wheel.sizes)
+
+    # Advance tick by tick: every timer fires on the first tick reaching its deadline
+    for tick in range(1, 202):
+        clock.now = tick * RESOLUTION
+        wheel.advance()
+    assert sorted(fired) == deadlines
+    for deadline, time in fired.items():
+        assert deadline <= time < deadline + RESOLUTION
+    assert wheel.count == 0 and not any(wheel.sizes)
+    assert wheel.stats() == {'pending': 0, 'fired': len(deadlines)}
+
+
+def test_advance_fires_due_timers_in_deadline_order():
+    wheel = small_wheel(Clock())
+    order = []
+    deadlines = [30.1, 0.3, 12.0, 47.6, 3.9, 16.2]
+    for deadline in deadlines:
+        wheel.schedule(deadline, lambda deadline=deadline: order.append(deadline))
+    assert wheel.advance(20.0) == 4
+    assert order == [0.3, 3.9, 12.0, 16.2]
+    assert wheel.advance(100.0) == 2
+    assert order == sorted(deadlines)
+
+
+def test_timeout_never_oversleeps():
+    # The evaluation loop waits timeout() seconds between advances. Timers must still fire within a tick
+    clock = Clock()
+    wheel = small_wheel(clock)
+    rng = random.Random(1)
+    deadlines = sorted({round(rng.uniform(0, 100), 3) for _ in range(100)})
+    fired, _ = schedule_all(wheel, deadlines)
+    wakeups = 0
+    while wheel.count:
+        timeout = wheel.timeout()
+        assert timeout is not None
+        clock.now += timeout
+        wheel.advance()
+        wakeups += 1
+        assert wakeups < 10000
+    for deadline, time in fired.items():
+        assert deadline <= time < deadline + RESOLUTION
+    assert wheel.timeout() is None
+
+
+def test_cancelled_timers_do_not_fire():
+    clock = Clock()
+    wheel = small_wheel(clock)
+    fired, timers = schedule_all(wheel, [1.0, 10.0, 40.0])
+    timers[10.0].cancel()
+    timers[40.0].cancel()
+    timers[40.0].cancel()
+    assert wheel.count == 1
+    wheel.advance(60.0)
+    assert list(fired) == [1.0]
+    # Cancelling a fired timer does nothing
+    timers[1.0].cancel()
+    assert wheel.count == 0
+
+
+def test_callbacks_schedule_timers_fired_in_the_same_advance():
+    wheel = small_wheel(Clock())
+    times = []
+
+    # A periodic timer, rescheduling itself like TimeInterval
+    def tick():
+        times.append(wheel.time)
+        if len(times) < 5:
+            wheel.schedule(1.0 + len(times), tick)
+
+    wheel.schedule(1.0, tick)
+    assert wheel.advance(10.0) == 5
+    assert len(times) == 5
+
+
+def test_idle_wheel_catches_up_with_the_clock():
+    clock = Clock()
+    wheel = small_wheel(clock)
+    # Nothing scheduled, so the wheel is never advanced
+    clock.now = 1000.0
+    fired, _ = schedule_all(wheel, [1000.5, 999.0])
+    assert wheel.timeout() == RESOLUTION
+    # Deadlines in the past fire on the next tick
+    wheel.advance(1000.0 + RESOLUTION)
+    assert list(fired) == [999.0]
+    assert wheel.timeout(1000.3) == pytest.approx(0.2)
+    wheel.advance(1000.4)
+    assert list(fired) == [999.0]
+    wheel.advance(1000.5)
+    assert fired == {999.0: 1000.0 + RESOLUTION, 1000.5: 1000.5}
+
+
+def test_times_of_day_follow_the_wall_clock():
+    # Durations are measured on a monotonic clock, which the wall clock may drift from
+    assert TimerWheel().clock is time.monotonic
+    clock, wall = Clock(50.0), Clock(1700000000.0)
+    wheel = TimerWheel(resolution=RESOLUTION, clock=clock, wall_clock=wall)
+    assert wheel.from_wall(wall.now + 60) == 110.0
+
+    # A time of day is scheduled at the wall time it occurs at, converted to the wheel's clock
+    condition = TimeAt(None, '07:30')
+    condition.automation = type('Automation', (), {'parent': None})()
+    condition.wheel = wheel
+    condition.set = lambda value: None
+    condition.begin(clock.now)
+    due = next_clock_time(condition.seconds, wall.now)
+    assert condition.timer.deadline == due - wall.now + clock.now
+    # Firing early on the wall clock still moves on to the next day
+    clock.now = condition.timer.deadline
+    wall.now = due - 1
+    condition.pulse = lambda: None
+    assert wheel.advance() == 1
+    assert condition.due == next_clock_time(condition.seconds, due)